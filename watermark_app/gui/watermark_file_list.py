@@ -0,0 +1,193 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+import watermark
+from gui.watermark_preview import get_modified_time, to_qimage
+from watermark_cache import LRUCache
+
+# Largest thumbnail shown next to each file.
+THUMBNAIL_SIZE = (64, 64)
+
+
+def get_thumbnail_folder():
+    # The per user cache folder of the platform, e.g. ~/.cache/<application>/thumbnails on Linux.
+    cache_folder = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.CacheLocation)
+    return os.path.join(cache_folder, "thumbnails")
+
+
+class ThumbnailCache:
+    def __init__(self, folder: str, size: tuple = THUMBNAIL_SIZE):
+        """
+        Thumbnails of image files, kept as PNG files in folder so they survive restarts.
+
+        A thumbnail is keyed by the path and mtime of its image, so it is made again once the image changes.
+        Images are decoded at reduced resolution where the format allows, see watermark.load_preview_image.
+        Safe to share between threads.
+
+        Attributes:
+            folder (str): Where the thumbnails are stored, created when the first one is.
+            size (tuple): Largest thumbnail size.
+            hits (int): Number of thumbnails read from the folder.
+            misses (int): Number of thumbnails that had to be made.
+        """
+        self.folder = folder
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_thumbnail_path(self, image_path: str):
+        # None if image_path does not exist.
+        modified_time = get_modified_time(image_path)
+        if modified_time is None:
+            return None
+        key = "%s\0%d\0%dx%d" % (os.path.abspath(image_path), modified_time, self.size[0], self.size[1])
+        return os.path.join(self.folder, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".png")
+
+    def get(self, image_path: str):
+        """
+        Get the thumbnail of image_path, making and storing it if needed.
+
+        Returns:
+            tuple: The thumbnail (None on failure) and a list of errors.
+        """
+        thumbnail_path = self.get_thumbnail_path(image_path)
+        if thumbnail_path is None:
+            return None, ["Image file %s does not exist" % image_path]
+        try:
+            with Image.open(thumbnail_path) as thumbnail:
+                thumbnail.load()
+            with self._lock:
+                self.hits += 1
+            return thumbnail, []
+        except (OSError, ValueError):
+            # Not cached yet, or a file cut short by a crash. Made again below.
+            pass
+        with self._lock:
+            self.misses += 1
+        thumbnail, _, errors = watermark.load_preview_image(image_path, self.size)
+        if len(errors) > 0:
+            return None, errors
+        if thumbnail.mode not in ("RGB", "RGBA", "L", "LA"):
+            thumbnail = thumbnail.convert("RGBA")
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            # Written aside and renamed, so other threads and processes never read a partial thumbnail.
+            temporary_path = "%s.%d.%d.tmp" % (thumbnail_path, os.getpid(), threading.get_ident())
+            thumbnail.save(temporary_path, "PNG", compress_level=1)
+            os.replace(temporary_path, thumbnail_path)
+        except OSError as e:
+            print("Could not cache the thumbnail of %s: %s" % (image_path, str(e)))
+        return thumbnail, []
+
+
+class FileListModel(QtCore.QAbstractListModel):
+    # Generation of the file list, path and thumbnail (null on failure), from the thumbnail threads.
+    thumbnail_signal = QtCore.pyqtSignal(int, str, QtGui.QImage, name="ThumbnailReady")
+
+    def __init__(self, thumbnail_cache: ThumbnailCache, workers: int = 4, memory_cache_mb: int = 32, parent=None):
+        """
+        The files to watermark, for a QListView.
+
+        Views only ask for the rows they show, so a list of tens of thousands of files costs nothing until it is
+        scrolled through. The thumbnail of a row is made on a pool of `workers` threads the first time it is shown,
+        then kept in memory (up to memory_cache_mb) and in thumbnail_cache.
+
+        Attributes:
+            files (list): Path of every row.
+            generation (int): Number of the current file list. Thumbnails of earlier lists are dropped.
+            thumbnail_cache (ThumbnailCache): On disk thumbnails.
+        """
+        QtCore.QAbstractListModel.__init__(self, parent)
+        self.files = []
+        self.generation = 0
+        self.thumbnail_cache = thumbnail_cache
+        self._rows = {}
+        self._pixmaps = LRUCache(memory_cache_mb * 1024 * 1024)
+        self._pending = set()
+        self._failed = set()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self.thumbnail_signal.connect(self.thumbnail_loaded)
+
+    def set_files(self, files):
+        self.beginResetModel()
+        self.files = list(files)
+        self._rows = {}
+        for row, file_path in enumerate(self.files):
+            self._rows.setdefault(file_path, row)
+        self.generation += 1
+        self._pending.clear()
+        # Files may have been fixed or replaced since, give them another try.
+        self._failed.clear()
+        self.endResetModel()
+
+    def file_at(self, row: int):
+        return self.files[row]
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.files)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.files):
+            return None
+        file_path = self.files[index.row()]
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.ToolTipRole):
+            return file_path
+        if role == QtCore.Qt.DecorationRole:
+            pixmap = self._pixmaps.get(file_path)
+            if pixmap is None and file_path not in self._failed:
+                self.request_thumbnail(file_path)
+            return pixmap
+        return None
+
+    def request_thumbnail(self, file_path: str):
+        if file_path in self._pending:
+            return
+        self._pending.add(file_path)
+        self._executor.submit(self._load_thumbnail, self.generation, file_path)
+
+    def _load_thumbnail(self, generation: int, file_path: str):
+        # On the thumbnail threads. Rows of a replaced file list are skipped.
+        if generation != self.generation:
+            return
+        try:
+            thumbnail, errors = self.thumbnail_cache.get(file_path)
+        except Exception as e:
+            thumbnail, errors = None, [str(e)]
+        if len(errors) > 0:
+            print("No thumbnail for %s: %s" % (file_path, "\n".join(errors)))
+            self.thumbnail_signal.emit(generation, file_path, QtGui.QImage())
+            return
+        self.thumbnail_signal.emit(generation, file_path, to_qimage(thumbnail))
+
+    def thumbnail_loaded(self, generation, file_path, image):
+        self._pending.discard(file_path)
+        if not image.isNull():
+            self._pixmaps.put(file_path, QtGui.QPixmap.fromImage(image), image.width() * image.height() * 4)
+        row = self._rows.get(file_path)
+        if generation != self.generation or row is None:
+            return
+        if image.isNull():
+            # Not retried until the file list is set again.
+            self._failed.add(file_path)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [QtCore.Qt.DecorationRole])
+
+    def close(self):
+        # Drops the thumbnails not started yet and waits for the others.
+        self.generation += 1
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def create_file_list_view(parent, model: FileListModel):
+    # A list view only laying out and querying the rows it shows.
+    view = QtWidgets.QListView(parent)
+    view.setUniformItemSizes(True)
+    view.setIconSize(QtCore.QSize(*model.thumbnail_cache.size))
+    view.setModel(model)
+    return view
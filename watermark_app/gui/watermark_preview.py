@@ -0,0 +1,188 @@
+import copy
+import os
+import threading
+
+from PyQt5 import QtCore, QtGui
+
+import watermark
+from watermark_cache import LRUCache
+
+# Largest preview rendered, and size of the proxies the previews are rendered from.
+PREVIEW_SIZE = (640, 480)
+# Quiet time after the last edit before a preview is rendered.
+PREVIEW_DEBOUNCE_MS = 150
+
+
+def get_output_size(watermark_config, image_size: tuple, watermark_image=None):
+    # Size of the output of an image of image_size, once maybe_resize_image has scaled it.
+    if not watermark_config.do_image_scaling or watermark_image is None:
+        return image_size
+    ratio = watermark.get_resize_ratio(watermark_config, image_size, watermark_image.size)
+    if ratio is None:
+        return image_size
+    return (int(image_size[0] * ratio), int(image_size[1] * ratio))
+
+
+def render_preview(
+    watermark_config,
+    proxy,
+    full_size: tuple,
+    watermark_image=None,
+    text_image=None,
+    text=None,
+    max_size: tuple = PREVIEW_SIZE,
+):
+    """
+    Watermark the proxy of an image the way watermark_config would watermark the image itself, at preview size.
+
+    The output size and the watermark layer are worked out for the full image, then scaled down to the preview,
+    so the watermark covers the same part of the preview as of the output.
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark settings.
+        proxy (Image): The image, downsampled to fit max_size. Not modified.
+        full_size (tuple): Size of the image itself.
+        watermark_image (Image): The watermark image, if any.
+        text_image (Image): Preloaded text layer, if any.
+        text (str): Text to render when there is no preloaded text layer.
+        max_size (tuple): Largest preview size.
+
+    Returns:
+        tuple: The RGBA preview (None on failure) and a list of errors.
+    """
+    output_size = get_output_size(watermark_config, full_size, watermark_image)
+    scale = min(1.0, max_size[0] / output_size[0], max_size[1] / output_size[1])
+    preview_size = (max(1, round(output_size[0] * scale)), max(1, round(output_size[1] * scale)))
+    base_image = proxy if proxy.size == preview_size else proxy.resize(preview_size)
+    return watermark.composite_watermark(
+        watermark_config, base_image, watermark_image, text_image, text, reference_size=output_size
+    )
+
+
+def get_modified_time(file_path: str):
+    # mtime of file_path, None if there is no such file.
+    try:
+        return os.stat(file_path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+
+def to_qimage(image):
+    # Copies a PIL image into a QImage, which can be handed over to the GUI thread.
+    image = image.convert("RGBA")
+    data = image.tobytes("raw", "RGBA")
+    return QtGui.QImage(data, image.width, image.height, image.width * 4, QtGui.QImage.Format_RGBA8888).copy()
+
+
+class PreviewThread(QtCore.QThread):
+    # The generation of the request, and its preview or errors.
+    preview_signal = QtCore.pyqtSignal(int, QtGui.QImage, name="PreviewReady")
+    error_signal = QtCore.pyqtSignal(int, list, name="PreviewFailed")
+
+    def __init__(self, max_size: tuple = PREVIEW_SIZE, proxy_cache_mb: int = 64):
+        """
+        Renders previews in the background, see render_preview.
+
+        Only the latest request is rendered: requests made while a preview is rendering replace each other, and a
+        render that a newer request made stale is dropped between its steps instead of being shown.
+
+        Attributes:
+            max_size (tuple): Largest preview size.
+            generation (int): Number of the latest request.
+            proxy_cache (LRUCache): The downsampled proxy and full size of the recent images, so
+                edits only pay for compositing.
+        """
+        QtCore.QThread.__init__(self)
+        self.max_size = max_size
+        self.generation = 0
+        self.proxy_cache = LRUCache(proxy_cache_mb * 1024 * 1024)
+        self._condition = threading.Condition()
+        self._request = None
+        self._stopping = False
+        self._watermark_key = None
+        self._watermark = None
+
+    def request(self, watermark_config, image_path: str):
+        # Asks for a preview of image_path with a snapshot of watermark_config. Returns the request generation.
+        request_config = copy.copy(watermark_config)
+        request_config.watermark_locations = list(watermark_config.watermark_locations)
+        request_config.show_generated_images = False
+        with self._condition:
+            self.generation += 1
+            self._request = (self.generation, request_config, image_path)
+            self._condition.notify()
+            return self.generation
+
+    def is_stale(self, generation: int):
+        return generation != self.generation
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._request is None and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                generation, request_config, image_path = self._request
+                self._request = None
+            try:
+                self.render(generation, request_config, image_path)
+            except Exception as e:
+                self.error_signal.emit(generation, ["Preview failed. Error was: %s" % str(e)])
+
+    def get_proxy(self, image_path: str):
+        # The proxy and full size of image_path, from the cache unless the file changed.
+        key = (image_path, get_modified_time(image_path))
+        entry = self.proxy_cache.get(key)
+        if entry is not None:
+            return entry[0], entry[1], []
+        proxy, full_size, errors = watermark.load_preview_image(image_path, self.max_size)
+        if len(errors) > 0:
+            return None, None, errors
+        proxy.load()
+        self.proxy_cache.put(key, (proxy, full_size), proxy.width * proxy.height * 4)
+        return proxy, full_size, []
+
+    def get_watermark(self, watermark_config):
+        # The watermark and text layer, reloaded only when their settings or the watermark file change. Keeping the
+        # same watermark image lets prepare_watermark_layer reuse its cached layers.
+        watermark_file = watermark_config.watermark_file
+        key = (
+            watermark_file,
+            get_modified_time(watermark_file),
+            watermark_config.watermark_text,
+            watermark_config.watermark_text_to_image_ratio,
+            tuple(watermark_config.watermark_text_color),
+            watermark_config.watermark_font_path,
+        )
+        if key != self._watermark_key:
+            watermark_image, text_image, text, errors = watermark.preload_watermark_and_text_images(watermark_config)
+            if len(errors) > 0:
+                return None, errors
+            if watermark_image is not None:
+                watermark_image.load()
+            self._watermark_key = key
+            self._watermark = (watermark_image, text_image, text)
+        return self._watermark, []
+
+    def render(self, generation: int, watermark_config, image_path: str):
+        proxy, full_size, errors = self.get_proxy(image_path)
+        if self.is_stale(generation):
+            return
+        if len(errors) == 0:
+            loaded_watermark, errors = self.get_watermark(watermark_config)
+        if self.is_stale(generation):
+            return
+        if len(errors) == 0:
+            preview, errors = render_preview(watermark_config, proxy, full_size, *loaded_watermark, self.max_size)
+        if self.is_stale(generation):
+            return
+        if len(errors) > 0:
+            self.error_signal.emit(generation, errors)
+            return
+        self.preview_signal.emit(generation, to_qimage(preview))
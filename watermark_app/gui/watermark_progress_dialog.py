@@ -1,9 +1,25 @@
+import threading
+import time
+
 from PyQt5 import QtCore, QtGui, QtWidgets
 
 import watermark
+from watermark_report import WatermarkReport
 
 from gui.watermark_progress_ui import Ui_Dialog
 
+# Progress is signalled at most this often, so that large batches don't flood the Qt event loop.
+PROGRESS_INTERVAL_SECONDS = 0.1
+
+
+def format_duration(seconds: float):
+    # h:mm:ss, or m:ss under an hour.
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%d:%02d" % (minutes, seconds)
+
 
 class ProgressDialog(QtWidgets.QDialog, Ui_Dialog):
     def __init__(self, watermark_config, parent=None):
@@ -12,28 +28,86 @@ class ProgressDialog(QtWidgets.QDialog, Ui_Dialog):
         self.watermark_config = watermark_config
         self.watermark_thread = None
         self.files_processed = 0
+        self.start_time = None
         self.totalItems.setText("%d" % len(self.watermark_config.files_to_watermark))
         self.doneButton.clicked.connect(self.accept)
 
+        # Throughput and time left, under the file counts.
+        self.rateLabel = QtWidgets.QLabel(self)
+        self.rateLabel.setAlignment(QtCore.Qt.AlignCenter)
+        self.verticalLayout.insertWidget(self.verticalLayout.indexOf(self.horizontalLayout) + 1, self.rateLabel)
+        self.cancelButton = QtWidgets.QPushButton("Cancel", self)
+        self.verticalLayout.insertWidget(self.verticalLayout.indexOf(self.doneButton), self.cancelButton)
+        self.cancelButton.clicked.connect(self.cancel_watermarks)
+
     def exec_(self):
         self.begin_watermarks()
         QtWidgets.QDialog.exec_(self)
 
     def begin_watermarks(self):
+        self.start_time = time.monotonic()
         self.watermark_thread = WatermarkThread(self.watermark_config)
         self.watermark_thread.signal.connect(self.update_gui)
+        self.watermark_thread.summary_signal.connect(self.show_summary)
         self.watermark_thread.start()
 
+    def cancel_watermarks(self):
+        # The files being watermarked are finished, the others are skipped. See show_summary.
+        if self.watermark_thread is not None:
+            self.watermark_thread.cancel()
+        self.cancelButton.setEnabled(False)
+        self.statusLabel.setText("Cancelling")
+
+    def reject(self):
+        # Closing the dialog (Escape, window close) cancels a running batch.
+        if self.watermark_thread is not None and self.watermark_thread.isRunning():
+            self.watermark_thread.cancel()
+            self.watermark_thread.wait()
+        QtWidgets.QDialog.reject(self)
+
     def update_gui(self, status, progress, errors):
         self.statusLabel.setText(status)
         self.files_processed = progress
         self.completedItems.setText("%d" % progress)
-        self.itemProgress.setProperty("value", progress / len(self.watermark_config.files_to_watermark) * 100)
+        total = len(self.watermark_config.files_to_watermark)
+        self.itemProgress.setProperty("value", progress / total * 100)
+        elapsed = time.monotonic() - self.start_time if self.start_time is not None else 0.0
+        if progress > 0 and elapsed > 0:
+            rate = progress / elapsed
+            self.rateLabel.setText("%.1f files/s, %s left" % (rate, format_duration((total - progress) / rate)))
         if self.files_processed >= len(self.watermark_config.files_to_watermark) or len(errors) > 0:
             self.doneButton.setEnabled(True)
         if len(errors) > 0:
             self.ErrorDialog(errors)
 
+    def show_summary(self, summary, errors):
+        self.doneButton.setEnabled(True)
+        self.cancelButton.setEnabled(False)
+        if summary["cancelled"]:
+            summary_box = QtWidgets.QMessageBox()
+            summary_box.setIcon(QtWidgets.QMessageBox.Information)
+            summary_box.setText("Cancelled, %d files were not processed" % summary["skipped"])
+            summary_box.setInformativeText(
+                "%d files were watermarked, %d failed." % (summary["succeeded"], summary["failed"])
+            )
+            if len(errors) > 0:
+                summary_box.setDetailedText("\n".join(errors))
+            summary_box.setWindowTitle("Cancelled")
+            summary_box.setStandardButtons(QtWidgets.QMessageBox.Ok)
+            summary_box.exec_()
+            return
+        if summary["failed"] == 0:
+            return
+        # Files that failed while the batch kept going, see WatermarkConfig.continue_on_error.
+        summary_box = QtWidgets.QMessageBox()
+        summary_box.setIcon(QtWidgets.QMessageBox.Warning)
+        summary_box.setText("%d of %d files failed" % (summary["failed"], summary["total"]))
+        summary_box.setInformativeText("%d files were watermarked." % summary["succeeded"])
+        summary_box.setDetailedText("\n".join(errors))
+        summary_box.setWindowTitle("Some files failed")
+        summary_box.setStandardButtons(QtWidgets.QMessageBox.Ok)
+        summary_box.exec_()
+
     def ErrorDialog(self, messages):
         print("errors", "\n".join(messages))
         error_box = QtWidgets.QMessageBox()
@@ -47,13 +121,26 @@ class ProgressDialog(QtWidgets.QDialog, Ui_Dialog):
 
 class WatermarkThread(QtCore.QThread):
     signal = QtCore.pyqtSignal(str, int, list, name="StatusChange")
+    # The summary of the report, whether the batch was cancelled and how many files it skipped, and the errors of
+    # the failed files, once the batch is over.
+    summary_signal = QtCore.pyqtSignal(dict, list, name="Summary")
+
+    def __init__(self, watermark_config, progress_interval: float = PROGRESS_INTERVAL_SECONDS):
+        """
+        Watermarks the files of watermark_config, with its worker pool, report and profiler (see
+        watermark.WatermarkBatch).
 
-    def __init__(self, watermark_config):
+        Progress is signalled at most every progress_interval seconds, besides errors and the end of the batch.
+        """
         QtCore.QThread.__init__(self)
         self.watermark_config = watermark_config
+        self.progress_interval = progress_interval
         self.step_text = ""
         self.files_processed = 0
         self.errors = []
+        self.report = WatermarkReport(watermark_config.output_variants)
+        self.cancelled = False
+        self._cancel_event = threading.Event()
 
     def __del__(self):
         self.wait()
@@ -62,31 +149,57 @@ class WatermarkThread(QtCore.QThread):
         self.step_text = status
         self.signal.emit(status, completed_files, errors)
 
+    def cancel(self):
+        # Safe to call from any thread. No more files are handed out, the ones already handed out are finished and
+        # reported, see files_until_cancelled.
+        self._cancel_event.set()
+
+    def files_until_cancelled(self):
+        # The files to watermark, until the batch is cancelled. watermark_files takes them as it goes (a few ahead
+        # of the workers), so every output written still has its result.
+        for input_file in self.watermark_config.files_to_watermark:
+            if self._cancel_event.is_set():
+                self.cancelled = True
+                return
+            yield input_file
+
     def run(self):
         self.set_run_status("Loading watermark", 0, self.errors)
         watermark_image, text_image, text, errors = watermark.preload_watermark_and_text_images(self.watermark_config)
 
         if len(errors) > 0:
             self.errors += errors
-
-        for image in self.watermark_config.files_to_watermark:
-            if len(self.errors) > 0:
-                break
-
-            self.set_run_status("processing %s" % image, self.files_processed, self.errors)
-            print("processing %s" % image)
-            base_image, errors = watermark.load_image(image)
-            if len(errors) > 0:
-                self.errors += errors
-
-            output_image, errors = watermark.apply_watermark_to_image(
-                self.watermark_config, base_image, watermark_image, text_image, text=text
-            )
-            if len(errors) > 0:
-                self.errors += errors
-                pass
-            self.files_processed += 1
-        if len(self.errors) == 0:
-            self.set_run_status("Done", self.files_processed, self.errors)
-        else:
             self.set_run_status("Error", self.files_processed, self.errors)
+            return
+
+        # On a pool of watermark_config.workers processes, or serially (with pipeline_mode, decoding, compositing and
+        # encoding on separate threads).
+        batch = watermark.WatermarkBatch(self.watermark_config, watermark_image, text_image, text)
+        self.report = batch.report
+        results = batch.run(self.files_until_cancelled())
+        # The first file is always signalled.
+        last_status_time = float("-inf")
+        try:
+            for result in results:
+                self.files_processed += 1
+                if len(result.errors) > 0 and not self.watermark_config.continue_on_error:
+                    self.errors += result.errors
+                    break
+                now = time.monotonic()
+                if now - last_status_time >= self.progress_interval:
+                    last_status_time = now
+                    status = "Cancelling, processed %s" if self._cancel_event.is_set() else "processed %s"
+                    self.set_run_status(status % result.input_file, self.files_processed, self.errors)
+        finally:
+            results.close()
+            batch.close()
+        if len(self.errors) > 0:
+            self.set_run_status("Error", self.files_processed, self.errors)
+        elif self.cancelled:
+            self.set_run_status("Cancelled. %s" % self.report.format_summary(), self.files_processed, self.errors)
+        else:
+            self.set_run_status("Done. %s" % self.report.format_summary(), self.files_processed, self.errors)
+        summary = self.report.summary()
+        summary["cancelled"] = self.cancelled
+        summary["skipped"] = len(self.watermark_config.files_to_watermark) - summary["total"]
+        self.summary_signal.emit(summary, self.report.get_errors())
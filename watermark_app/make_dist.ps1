@@ -6,3 +6,4 @@ New-Item -ItemType Directory -Force -path build
 
 poetry run pyinstaller -F $SCRIPT_DIR\watermark_gui.py --specpath build
 poetry run pyinstaller -F $SCRIPT_DIR\watermark_cli.py --specpath build
+poetry run pyinstaller -F $SCRIPT_DIR\watermark_watch.py --specpath build
@@ -9,3 +9,4 @@ mkdir -p build
 
 poetry run pyinstaller -F $SCRIPT_DIR/watermark_gui.py --specpath build
 poetry run pyinstaller -F $SCRIPT_DIR/watermark_cli.py --specpath build
+poetry run pyinstaller -F $SCRIPT_DIR/watermark_watch.py --specpath build
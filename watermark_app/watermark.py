@@ -1,23 +1,52 @@
+import copy
+import io
 import os
+import time
+from collections import deque
 from random import randint
 from tempfile import TemporaryDirectory
+from types import SimpleNamespace
 
-from PIL import Image, ImageChops
-from PIL import ImageDraw, ImageFont
-from pillow_heif import register_heif_opener
+from PIL import Image, ImageChops, ImageFile
+from PIL import ImageDraw
 
-register_heif_opener()
+from watermark_cache import PreparedWatermarkCache
+from watermark_codecs import HEADER_SIZE, prepare_codecs_for_file, prepare_codecs_for_header
+from watermark_config import VALID_HORIZONTAL, VALID_VERTICAL, WatermarkConfig
+from watermark_fonts import DEFAULT_FONT_SIZE, fit_font_size, get_default_font_path, get_font
+from watermark_heic import configure_heif_decoder, draft_heif_thumbnail, get_decode_threads
+from watermark_jpeg import (
+    align_box,
+    can_drop_regions,
+    drop_regions,
+    find_jpegtran,
+    get_mcu_size,
+    get_source_encoder_options,
+    merge_boxes,
+)
+from watermark_profile import (
+    WatermarkProfiler,
+    get_cprofile_stats,
+    notify_profile_hooks,
+    profile_file,
+    profile_stage,
+)
+from watermark_report import WatermarkReport
 
-from watermark_config import WatermarkConfig
+# File extension of each output format we can encode.
+OUTPUT_EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
 
-VALID_VERTICAL = ["bottom", "top", "center", "random"]
-VALID_HORIZONTAL = ["right", "left", "center", "random"]
+# Prepared watermark layers shared by every call in this process. See prepare_watermark_layer.
+PREPARED_WATERMARK_CACHE = PreparedWatermarkCache()
 
 
 def load_image(image_path: str):
     # Loads the watermark image.
     image = None
-    error_messages = []
+    # Codecs such as HEIF are only registered once a file needs them.
+    error_messages = prepare_codecs_for_file(image_path)
+    if len(error_messages) > 0:
+        return (None, error_messages)
     try:
         image = Image.open(image_path)
     except:
@@ -26,35 +55,53 @@ def load_image(image_path: str):
     return (image, error_messages)
 
 
-def maybe_resize_image(watermark_config: WatermarkConfig, input_image: Image, watermark_image: Image = None):
+def load_preview_image(image_path: str, max_size: tuple):
     """
-    Resize the input image to ensure the watermark meets a desired size ratio if needed.
+    Load an image no larger than max_size, for previews.
 
-    The watermark should be at-least the specified ratio of the input image. If resize is needed, do so.
-    Args:
-        watermark_config (WatermarkConfig): Configuration object containing watermark settings, including whether
-            scaling is enabled and the width and height percentages.
-        input_image (Image): The input image to potentially resize.
-        watermark_image (Image): The watermark image used to determine if resizing is necessary.
+    Only as much of the image as the preview needs is decoded: an embedded HEIF thumbnail, or a reduced scale JPEG
+    decode, when they are large enough.
 
     Returns:
-        tuple: A tuple containing the potentially resized input image and an empty list.
+        tuple: The image (None on failure), the size of the full image and a list of errors.
     """
+    image, errors = load_image(image_path)
+    if len(errors) > 0:
+        return None, None, errors
+    full_size = image.size
+    try:
+        scale = min(1.0, max_size[0] / image.width, max_size[1] / image.height)
+        draft_heif_thumbnail(image, (max(1, round(image.width * scale)), max(1, round(image.height * scale))))
+        image.thumbnail(max_size)
+    except (OSError, ValueError) as e:
+        return None, None, ["Image failed to load. Is %s a valid file? Error was: %s" % (image_path, str(e))]
+    return image, full_size, []
 
-    if not watermark_config.do_image_scaling or watermark_image is None:
-        return (input_image, [])
 
+def get_resize_ratio(watermark_config: WatermarkConfig, image_size: tuple, watermark_size: tuple):
+    """
+    Compute how much an image must shrink for the watermark to meet the configured size ratios.
+
+    Only sizes are needed, so this can run on the header dimensions before the image is decoded.
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing the width and height percentages.
+        image_size (tuple): Size of the input image.
+        watermark_size (tuple): Size of the watermark image.
+
+    Returns:
+        float: The scaling ratio to apply, or None if no scaling is needed.
+    """
     scaling_needed = False
     minimal_ratio = 1.0
-    watermark_x_ratio = watermark_image.size[1] / input_image.size[1]
-    watermark_y_ratio = watermark_image.size[0] / input_image.size[0]
+    watermark_x_ratio = watermark_size[1] / image_size[1]
+    watermark_y_ratio = watermark_size[0] / image_size[0]
     if (
         watermark_config.minimal_watermark_width_percentage is not None
         and watermark_x_ratio < watermark_config.minimal_watermark_width_percentage
     ):
         scaling_needed = True
-        x_target = watermark_image.size[1] / watermark_config.minimal_watermark_width_percentage
-        x_scaling = x_target / input_image.size[1]
+        x_target = watermark_size[1] / watermark_config.minimal_watermark_width_percentage
+        x_scaling = x_target / image_size[1]
         if x_scaling < minimal_ratio:
             minimal_ratio = x_scaling
     if (
@@ -62,18 +109,145 @@ def maybe_resize_image(watermark_config: WatermarkConfig, input_image: Image, wa
         and watermark_y_ratio < watermark_config.minimal_watermark_height_percentage
     ):
         scaling_needed = True
-        y_target = watermark_image.size[0] / watermark_config.minimal_watermark_height_percentage
-        y_scaling = y_target / input_image.size[0]
+        y_target = watermark_size[0] / watermark_config.minimal_watermark_height_percentage
+        y_scaling = y_target / image_size[0]
         if y_scaling < minimal_ratio:
             minimal_ratio = y_scaling
     if scaling_needed:
+        return minimal_ratio
+    return None
+
+
+def reduced_resize(input_image: Image, new_image_size: tuple):
+    """
+    Resize input_image using the cheapest reduced-scale decode available, then an exact resample.
+
+    JPEG inputs that have not been decoded yet are decoded with DCT scaling (Image.draft) to the smallest scale
+    that is still at least new_image_size. The remaining integer part of the reduction is done with Image.reduce
+    (through reducing_gap) before the final resample to the exact size.
+    Args:
+        input_image (Image): The input image, ideally not yet loaded.
+        new_image_size (tuple): The exact size to produce.
+
+    Returns:
+        Image: The resized image.
+    """
+    with profile_stage("decode"):
+        if input_image.tile:
+            # Only has an effect on formats supporting reduced decoding and before the image is loaded.
+            input_image.draft(input_image.mode, new_image_size)
+        input_image.load()
+    with profile_stage("resize"):
+        return input_image.resize(new_image_size, reducing_gap=2.0)
+
+
+def maybe_resize_image(watermark_config: WatermarkConfig, input_image: Image, watermark_image: Image = None):
+    """
+    Resize the input image to ensure the watermark meets a desired size ratio if needed.
+
+    The watermark should be at-least the specified ratio of the input image. If resize is needed, do so.
+    The resize factor only depends on the header dimensions, so with resize_mode "speed" the image is decoded at a
+    reduced scale where the format allows it, see reduced_resize. HEIF images decode their embedded thumbnail
+    instead when it is large enough, in either mode.
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark settings, including whether
+            scaling is enabled, the width and height percentages and the resize mode.
+        input_image (Image): The input image to potentially resize.
+        watermark_image (Image): The watermark image used to determine if resizing is necessary.
+
+    Returns:
+        tuple: A tuple containing the potentially resized input image and an empty list.
+    """
+
+    if not watermark_config.do_image_scaling or watermark_image is None:
+        return (input_image, [])
+
+    minimal_ratio = get_resize_ratio(watermark_config, input_image.size, watermark_image.size)
+    if minimal_ratio is not None:
         print("scaling image", minimal_ratio)
         new_image_size = (int(input_image.size[0] * minimal_ratio), int(input_image.size[1] * minimal_ratio))
-        output_image = input_image.resize(new_image_size)
+        if watermark_config.resize_mode == "speed":
+            output_image = reduced_resize(input_image, new_image_size)
+        else:
+            with profile_stage("decode"):
+                # Embedded HEIF thumbnails at least new_image_size are as good a source as the full image.
+                draft_heif_thumbnail(input_image, new_image_size)
+                input_image.load()
+            with profile_stage("resize"):
+                output_image = input_image.resize(new_image_size)
         return (output_image, [])
     return (input_image, [])
 
 
+# Bytes per pixel Pillow uses in memory for each mode. Modes missing here, including RGB, take 4 bytes.
+_MODE_BYTES_PER_PIXEL = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16L": 2, "I;16B": 2}
+
+
+def get_image_bytes(mode: str, size: tuple):
+    return size[0] * size[1] * _MODE_BYTES_PER_PIXEL.get(mode, 4)
+
+
+def is_large_image(watermark_config: WatermarkConfig, image_size: tuple):
+    threshold = watermark_config.large_image_pixel_threshold
+    return threshold > 0 and image_size[0] * image_size[1] > threshold
+
+
+def get_tiled_mode(image: Image):
+    # Mode large images are composited in: their own when it can hold a colored watermark, else RGB(A).
+    if image.mode in ["RGB", "RGBA"]:
+        return image.mode
+    if "A" in image.getbands() or "transparency" in image.info:
+        return "RGBA"
+    return "RGB"
+
+
+def estimate_image_memory(watermark_config: WatermarkConfig, input_image: Image, watermark_image: Image = None):
+    """
+    Estimate the peak pixel memory of watermarking input_image, from its header only.
+
+    Counts the decoded image, its resized copy, and the copies and layers of the compositing path that will be
+    taken. Codec buffers and Python objects are not included.
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark settings.
+        input_image (Image): The input image, opened but not decoded.
+        watermark_image (Image): The watermark image, if any.
+
+    Returns:
+        int: The estimate in bytes.
+    """
+    size = input_image.size
+    total = get_image_bytes(input_image.mode, size)
+    if watermark_config.do_image_scaling and watermark_image is not None:
+        ratio = get_resize_ratio(watermark_config, size, watermark_image.size)
+        if ratio is not None:
+            size = (int(size[0] * ratio), int(size[1] * ratio))
+            total += get_image_bytes(input_image.mode, size)
+    if is_large_image(watermark_config, size):
+        tiled_mode = get_tiled_mode(input_image)
+        if tiled_mode != input_image.mode:
+            total += get_image_bytes(tiled_mode, size)
+        # The tile, its RGBA conversion and its overlay.
+        tile_size = watermark_config.large_image_tile_size
+        total += 3 * get_image_bytes("RGBA", (tile_size, tile_size))
+    else:
+        # The RGBA copy and the watermark layer, which is full-size without region compositing.
+        total += 2 * get_image_bytes("RGBA", size)
+    return total
+
+
+def check_image_memory(watermark_config: WatermarkConfig, input_image: Image, watermark_image: Image = None):
+    # Returns an error if input_image would need more memory than allowed, before anything is decoded.
+    if watermark_config.max_image_memory_mb <= 0:
+        return []
+    estimate_mb = estimate_image_memory(watermark_config, input_image, watermark_image) / (1024 * 1024)
+    if estimate_mb > watermark_config.max_image_memory_mb:
+        return [
+            "%s needs about %d MB to watermark, more than the %d MB allowed"
+            % (getattr(input_image, "filename", None) or "Image", estimate_mb, watermark_config.max_image_memory_mb)
+        ]
+    return []
+
+
 def get_watermark_position(anchor: str, image_size: tuple, watermark_size: tuple):
     vertical_anchor, horizontal_anchor = anchor.split("-")
 
@@ -110,28 +284,46 @@ def create_text_layer(
     text_color: tuple = (255, 255, 255, 128),
     width_ratio: float = None,
     height_ratio: float = None,
+    font_path: str = None,
 ):
+    """
+    Render watermark_text on a transparent layer.
+
+    With ratios, the font size is the largest at which the text fits in that share of image_size, see
+    watermark_fonts.fit_font_size.
+    Args:
+        watermark_text (str): The text to render.
+        image_size (tuple): Size of the image the text is for.
+        text_color (tuple): RGBA color of the text.
+        width_ratio (float): Maximal share of the image width the text may take.
+        height_ratio (float): Maximal share of the image height the text may take.
+        font_path (str): TrueType font to use. Defaults to a bold system font.
+
+    Returns:
+        tuple: The RGBA text layer (None on failure) and a list of errors.
+    """
     if watermark_text is None:
         return None, ["No text specified"]
 
-    if os.name == "nt":
-        font_path = "c:\WINDOWS\Fonts\ARIALBD.TTF"
-    else:
-        font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+    if font_path is None:
+        font_path = get_default_font_path()
 
-    if width_ratio is None and height_ratio is None:
-        font_size = 36
-    else:
-        target_height = image_size[0]
-        target_width = image_size[1]
-        if width_ratio is not None:
-            target_width = int(float(image_size[0]) * width_ratio)
+    try:
+        if width_ratio is None and height_ratio is None:
+            font_size = DEFAULT_FONT_SIZE
+        else:
+            target_width = image_size[0]
+            target_height = image_size[1]
+            if width_ratio is not None:
+                target_width = int(float(image_size[0]) * width_ratio)
 
-        if height_ratio is not None:
-            target_height = int(float(image_size[1]) * height_ratio)
-        font_size = min(target_width // len(watermark_text) * 2, target_height)
+            if height_ratio is not None:
+                target_height = int(float(image_size[1]) * height_ratio)
+            font_size = fit_font_size(watermark_text, font_path, target_width, target_height)
 
-    font = ImageFont.truetype(font_path, font_size)
+        font = get_font(font_path, font_size)
+    except OSError:
+        return None, ["Unable to load font %s" % font_path]
     text_width, text_height = font.getbbox(watermark_text)[2:]
     text_layer = Image.new("RGBA", (text_width, text_height), (0, 0, 0, 0))
 
@@ -149,59 +341,872 @@ def composite_sidebyside(left: Image, right: Image):
     return new_image
 
 
-def apply_watermark_to_image(
+def get_prepared_watermark_cache(watermark_config: WatermarkConfig):
+    # Returns the process wide cache of prepared watermark layers, sized according to watermark_config.
+    max_bytes = int(watermark_config.watermark_cache_max_mb * 1024 * 1024)
+    if PREPARED_WATERMARK_CACHE.max_bytes != max_bytes:
+        PREPARED_WATERMARK_CACHE.set_max_bytes(max_bytes)
+    return PREPARED_WATERMARK_CACHE
+
+
+def prepare_watermark_layer(
+    watermark_config: WatermarkConfig,
+    image_size: tuple,
+    watermark_image: Image = None,
+    text: str = None,
+    scale: float = 1.0,
+):
+    """
+    Build the watermark layer for an image of image_size, along with its alpha mask scaled by alpha_scale.
+
+    Prepared layers are kept in a bounded LRU cache, so images sharing the same geometry reuse the same layer.
+    Text layers depend on the image size, image-only watermarks do not.
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing the text colour, ratios and alpha scale.
+        image_size (tuple): Size of the (possibly resized) image the watermark will be applied to.
+        watermark_image (Image): The watermark image, if any.
+        text (str): Text to render next to (or instead of) the watermark image, if any.
+        scale (float): Scale the layer of image_size by this, for downscaled variants of the image. Each scaled
+            size is cached too.
+
+    Returns:
+        tuple: A SimpleNamespace with the RGBA `image` and its `alpha` mask (None on failure) and a list of errors.
+    """
+    cache = get_prepared_watermark_cache(watermark_config)
+    if scale != 1.0:
+        prepared, errors = prepare_watermark_layer(watermark_config, image_size, watermark_image, text)
+        if len(errors) > 0:
+            return (None, errors)
+        layer_size = (max(1, round(prepared.image.width * scale)), max(1, round(prepared.image.height * scale)))
+        # The scaled entry keeps the full size one alive, so its id() is not reused while the key exists.
+        key = (id(prepared), layer_size)
+        scaled = cache.get(key)
+        if scaled is not None:
+            return (scaled, [])
+        with profile_stage("prepare_layer"):
+            scaled = SimpleNamespace(
+                image=prepared.image.resize(layer_size),
+                alpha=prepared.alpha.resize(layer_size),
+                source=prepared,
+            )
+        cache.put(key, scaled, layer_size[0] * layer_size[1] * (len(scaled.image.getbands()) + 1))
+        return (scaled, [])
+
+    key = (
+        id(watermark_image),
+        text,
+        tuple(image_size) if text is not None else None,
+        tuple(watermark_config.watermark_text_color),
+        watermark_config.watermark_font_path,
+        watermark_config.minimal_watermark_width_percentage,
+        watermark_config.minimal_watermark_height_percentage,
+        watermark_config.alpha_scale,
+    )
+    prepared = cache.get(key)
+    if prepared is not None:
+        return (prepared, [])
+
+    layer = watermark_image
+    if text is not None:
+        with profile_stage("text"):
+            text_image, errors = create_text_layer(
+                text,
+                image_size,
+                text_color=watermark_config.watermark_text_color,
+                width_ratio=watermark_config.minimal_watermark_width_percentage,
+                height_ratio=watermark_config.minimal_watermark_height_percentage,
+                font_path=watermark_config.watermark_font_path,
+            )
+        if len(errors) > 0:
+            return (None, errors)
+        if watermark_image:
+            layer = composite_sidebyside(watermark_image, text_image)
+        else:
+            layer = text_image
+
+    if layer is None:
+        return (None, ["Watermark was None. Either no image or no text specified"])
+
+    with profile_stage("prepare_layer"):
+        alpha_scale_value = int(255 * watermark_config.alpha_scale)
+        watermark_alpha = layer.split()[-1]
+        if alpha_scale_value < 255:
+            alpha_scale = ImageChops.constant(watermark_alpha, alpha_scale_value)
+            watermark_alpha = ImageChops.multiply(watermark_alpha, alpha_scale)
+
+    # The source image is kept alive by the entry so its id() in the key can not be reused by another image.
+    prepared = SimpleNamespace(image=layer, alpha=watermark_alpha, source=watermark_image)
+    layer_bytes = layer.width * layer.height * (len(layer.getbands()) + 1)
+    cache.put(key, prepared, layer_bytes)
+    return (prepared, [])
+
+
+def get_watermark_regions(watermark_positions: list, watermark_size: tuple):
+    """
+    Group watermark placements into non-overlapping regions.
+
+    Placements whose boxes overlap end up in the same region so they can be blended together, in their original
+    order, exactly like they would be on a full-size layer.
+    Args:
+        watermark_positions (list): Top left corner of each placement.
+        watermark_size (tuple): Size of the watermark layer.
+
+    Returns:
+        list: (box, positions) tuples, where box is the (left, top, right, bottom) bounding box of the positions.
+    """
+    regions = []
+    for index, position in enumerate(watermark_positions):
+        box = [position[0], position[1], position[0] + watermark_size[0], position[1] + watermark_size[1]]
+        indices = [index]
+        # Merge with every region we overlap. Merging can create new overlaps, so keep going until nothing changes.
+        merged = True
+        while merged:
+            merged = False
+            for region_box, region_indices in regions:
+                if (
+                    box[0] < region_box[2]
+                    and region_box[0] < box[2]
+                    and box[1] < region_box[3]
+                    and region_box[1] < box[3]
+                ):
+                    regions.remove((region_box, region_indices))
+                    box = [
+                        min(box[0], region_box[0]),
+                        min(box[1], region_box[1]),
+                        max(box[2], region_box[2]),
+                        max(box[3], region_box[3]),
+                    ]
+                    indices = region_indices + indices
+                    merged = True
+                    break
+        regions.append((box, indices))
+    return [(tuple(box), [watermark_positions[index] for index in sorted(indices)]) for box, indices in regions]
+
+
+def composite_watermark_full_frame(base_image: Image, prepared, watermark_positions: list):
+    # Pastes every placement into a transparent full-size layer, then blends the whole frame onto the image.
+    output_image = Image.new("RGBA", base_image.size, (0, 0, 0, 0))
+    for watermark_position in watermark_positions:
+        output_image.paste(prepared.image, watermark_position, mask=prepared.alpha)
+    return Image.alpha_composite(base_image.convert("RGBA"), output_image)
+
+
+def composite_watermark_regions(base_image: Image, prepared, watermark_positions: list):
+    """
+    Blend the watermark into the image, touching only the regions covered by a placement.
+
+    Gives the same pixels as composite_watermark_full_frame, since blending a fully transparent pixel leaves the
+    base pixel unchanged, without allocating and blending a second full-size layer.
+    Args:
+        base_image (Image): The image to watermark.
+        prepared (SimpleNamespace): The prepared watermark layer, see prepare_watermark_layer.
+        watermark_positions (list): Top left corner of each placement.
+
+    Returns:
+        Image: The RGBA watermarked image.
+    """
+    output_image = base_image.convert("RGBA")
+    for box, positions in get_watermark_regions(watermark_positions, prepared.image.size):
+        output_image.alpha_composite(make_region_overlay(prepared, box, positions), dest=box[:2])
+    return output_image
+
+
+def make_region_overlay(prepared, box: tuple, positions: list):
+    # Pastes the placements of a region, in order, into a transparent layer the size of box.
+    overlay = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]), (0, 0, 0, 0))
+    for position in positions:
+        overlay.paste(prepared.image, (position[0] - box[0], position[1] - box[1]), mask=prepared.alpha)
+    return overlay
+
+
+def composite_watermark_tiles(base_image: Image, prepared, watermark_positions: list, tile_size: int):
+    """
+    Blend the watermark into a large image one tile at a time, touching only the tiles a placement overlaps.
+
+    RGB and RGBA images are modified in place, in their own mode, so besides the image itself only a few tiles are
+    held in memory. Other modes are converted to RGB, or RGBA if they have transparency, first. The pixels are
+    those of composite_watermark_regions, without its alpha channel for RGB images.
+    Args:
+        base_image (Image): The decoded image to watermark. Modified if it is RGB or RGBA.
+        prepared (SimpleNamespace): The prepared watermark layer, see prepare_watermark_layer.
+        watermark_positions (list): Top left corner of each placement.
+        tile_size (int): Width and height of the tiles.
+
+    Returns:
+        Image: The watermarked image.
+    """
+    tiled_mode = get_tiled_mode(base_image)
+    output_image = base_image if base_image.mode == tiled_mode else base_image.convert(tiled_mode)
+    width, height = output_image.size
+    for box, positions in get_watermark_regions(watermark_positions, prepared.image.size):
+        left = max(box[0], 0) - max(box[0], 0) % tile_size
+        top = max(box[1], 0) - max(box[1], 0) % tile_size
+        for tile_top in range(top, min(box[3], height), tile_size):
+            for tile_left in range(left, min(box[2], width), tile_size):
+                tile_box = (tile_left, tile_top, min(tile_left + tile_size, width), min(tile_top + tile_size, height))
+                overlay = Image.new("RGBA", (tile_box[2] - tile_left, tile_box[3] - tile_top), (0, 0, 0, 0))
+                for position in positions:
+                    overlay.paste(
+                        prepared.image, (position[0] - tile_left, position[1] - tile_top), mask=prepared.alpha
+                    )
+                tile = output_image.crop(tile_box)
+                if tiled_mode != "RGBA":
+                    tile = tile.convert("RGBA")
+                tile.alpha_composite(overlay)
+                if tiled_mode != "RGBA":
+                    tile = tile.convert(tiled_mode)
+                output_image.paste(tile, tile_box[:2])
+    return output_image
+
+
+def get_output_format(watermark_config: WatermarkConfig, source_format: str = None):
+    # Resolves the "source" output format. Sources we can't encode fall back to png.
+    if watermark_config.output_format != "source":
+        return watermark_config.output_format
+    source_format = (source_format or "").lower()
+    if source_format in ["jpeg", "mpo"]:
+        # MPO is the multi-picture JPEG variant written by many cameras and phones.
+        return "jpeg"
+    if source_format in OUTPUT_EXTENSIONS:
+        return source_format
+    return "png"
+
+
+def get_encoder_options(watermark_config: WatermarkConfig, output_format: str):
+    # Pillow save() options of output_format, as configured by watermark_config.
+    if output_format == "jpeg":
+        return {"quality": watermark_config.jpeg_quality, "subsampling": watermark_config.jpeg_subsampling}
+    if output_format == "webp":
+        return {
+            "lossless": watermark_config.webp_lossless,
+            "quality": watermark_config.webp_quality,
+            "method": watermark_config.webp_method,
+        }
+    return {"optimize": watermark_config.png_optimize, "compress_level": watermark_config.png_compress_level}
+
+
+def get_jpeg_source_options(watermark_config: WatermarkConfig, base_image: Image):
+    # With jpeg_lossless_regions, the encoder options keeping the quantization and subsampling of a jpeg input in
+    # its jpeg output, see watermark_jpeg.get_source_encoder_options. Read them before decoding, resized images
+    # don't have them.
+    if not watermark_config.jpeg_lossless_regions or get_output_format(watermark_config, base_image.format) != "jpeg":
+        return {}
+    return get_source_encoder_options(base_image)
+
+
+def save_watermarked_image(
+    watermark_config: WatermarkConfig,
+    output_image: Image,
+    output_name: str,
+    source_format: str = None,
+    exif=None,
+    variant: int = None,
+    encoder_options: dict = None,
+):
+    """
+    Encode a watermarked image into watermark_config.output_folder with the configured output format.
+
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing the output folder, format and encoder
+            settings.
+        output_image (Image): The RGBA watermarked image.
+        output_name (str): Name of the source file, without its extension.
+        source_format (str): Pillow format of the source image, used by the "source" output format.
+        exif (Image.Exif): EXIF data to carry over to the output.
+        variant (int): Longest side of the output variant being saved, which suffixes the filename. None for the
+            full size output.
+        encoder_options (dict): Encoder settings overriding the configured ones, see get_jpeg_source_options.
+
+    Returns:
+        tuple: The output filename (None on failure) and a list of errors.
+    """
+    output_format = get_output_format(watermark_config, source_format)
+    variant_suffix = "" if variant is None else "_%d" % variant
+    output_filename = os.path.join(
+        watermark_config.output_folder,
+        "%s_watermarked%s%s" % (output_name, variant_suffix, OUTPUT_EXTENSIONS[output_format]),
+    )
+    try:
+        if os.path.exists(output_filename) and os.stat(output_filename).st_nlink > 1:
+            # Hardlinked to the output of a duplicate input (see watermark_dedup), which must not change with it.
+            os.remove(output_filename)
+        encode_watermarked_image(watermark_config, output_image, output_filename, output_format, exif, encoder_options)
+    except (OSError, ValueError) as e:
+        return (None, ["Unable to save %s. Error was: %s" % (output_filename, str(e))])
+    return (output_filename, [])
+
+
+def encode_watermarked_image(
+    watermark_config: WatermarkConfig,
+    output_image: Image,
+    destination,
+    output_format: str,
+    exif=None,
+    encoder_options: dict = None,
+):
+    # Encodes output_image to destination, a filename or a binary file object, with the configured settings of
+    # output_format, or encoder_options where given. Raises OSError or ValueError when encoding fails.
+    options = get_encoder_options(watermark_config, output_format)
+    if encoder_options:
+        if "qtables" in encoder_options:
+            # Pillow scales the tables by the quality when there is one.
+            options.pop("quality", None)
+        options.update(encoder_options)
+    if output_format == "jpeg":
+        # JPEG has no alpha channel. Converting an RGB image would only copy it.
+        if output_image.mode != "RGB":
+            output_image = output_image.convert("RGB")
+    with profile_stage("encode"):
+        output_image.save(
+            destination,
+            format=output_format,
+            exif=exif if exif is not None else Image.Exif(),
+            **options,
+        )
+
+
+def composite_watermark(
     watermark_config: WatermarkConfig,
     base_image: Image,
     watermark_image: Image = None,
     text_image: Image = None,
     text: str = None,
+    reference_size: tuple = None,
 ):
-    # Applies the watermark to base_image in the locations specified by watermark_config.
-    # with TemporaryDirectory() as temp_dir:
-    # ... do something with temp_dir
-    base_filename = base_image.filename
-    base_exif = base_image.getexif()
+    """
+    Composite the watermark onto an already resized base image, in the locations specified by watermark_config.
+
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark settings.
+        base_image (Image): The (resized) image to watermark.
+        watermark_image (Image): The watermark image, if any.
+        text_image (Image): Preloaded text layer, if any.
+        text (str): Text to render for this image when there is no preloaded text layer.
+        reference_size (tuple): Size of the full image when base_image is a downscaled variant of it. The layer of
+            the full image is scaled down with it, see composite_watermark_variants.
+
+    Returns:
+        tuple: The watermarked image (None on failure) and a list of errors. RGBA, unless the image is large
+            enough to be composited in tiles, see composite_watermark_tiles.
+    """
+    # If we don't have a text layer, the prepared layer will render the text for this image size.
+    scale = 1.0
+    if reference_size is not None:
+        scale = base_image.width / reference_size[0]
+    prepared, errors = prepare_watermark_layer(
+        watermark_config,
+        reference_size or base_image.size,
+        watermark_image,
+        text if text_image is None else None,
+        scale,
+    )
+    if len(errors) > 0:
+        return None, errors
+
+    watermark_positions, errors = get_watermark_positions(watermark_config, base_image.size, prepared.image.size)
+    if len(errors) > 0:
+        return None, errors
+
+    with profile_stage("composite"):
+        if is_large_image(watermark_config, base_image.size):
+            return (
+                composite_watermark_tiles(
+                    base_image, prepared, watermark_positions, watermark_config.large_image_tile_size
+                ),
+                [],
+            )
+        if watermark_config.region_compositing:
+            return composite_watermark_regions(base_image, prepared, watermark_positions), []
+        return composite_watermark_full_frame(base_image, prepared, watermark_positions), []
+
+
+def get_watermark_positions(watermark_config: WatermarkConfig, image_size: tuple, watermark_size: tuple):
+    # Top left corner of the watermark at each configured location, and a list of errors.
+    watermark_positions = []
+    for anchor in watermark_config.watermark_locations:
+        watermark_position, errors = get_watermark_position(anchor, image_size, watermark_size)
+        if len(errors) > 0:
+            return None, errors
+        watermark_positions.append(watermark_position)
+    return watermark_positions, []
+
+
+def get_variant_size(image_size: tuple, longest_side: int):
+    # Size of the variant of an image whose longest side is longest_side, keeping its aspect ratio. Variants are
+    # never larger than the image itself.
+    scale = min(1.0, longest_side / max(image_size))
+    return (max(1, round(image_size[0] * scale)), max(1, round(image_size[1] * scale)))
+
+
+def downscale_variants(watermark_config: WatermarkConfig, base_image: Image):
+    """
+    Build the output_variants of a decoded image, before it is watermarked.
+
+    Each variant is resized from the previous, larger one rather than from the full image, so the image is decoded
+    once and every step only reduces by the ratio of two consecutive sizes.
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing the output variants and resize mode.
+        base_image (Image): The decoded, not yet watermarked, image.
+
+    Returns:
+        list: (longest side, Image) of every variant, largest first.
+    """
+    variants = []
+    previous = base_image
+    if len(watermark_config.output_variants) > 0 and base_image.mode not in ["RGB", "RGBA", "L", "LA"]:
+        # Palette and bilevel images can only be resized with nearest neighbour.
+        previous = base_image.convert(get_tiled_mode(base_image))
+    for longest_side in sorted(set(watermark_config.output_variants), reverse=True):
+        size = get_variant_size(base_image.size, longest_side)
+        with profile_stage("resize"):
+            if size == previous.size:
+                # Compositing may work in place, see composite_watermark_tiles.
+                variant_image = previous.copy()
+            elif watermark_config.resize_mode == "speed":
+                variant_image = previous.resize(size, reducing_gap=2.0)
+            else:
+                variant_image = previous.resize(size)
+        variants.append((longest_side, variant_image))
+        previous = variant_image
+    return variants
+
+
+def composite_watermark_variants(
+    watermark_config: WatermarkConfig,
+    base_image: Image,
+    watermark_image: Image = None,
+    text_image: Image = None,
+    text: str = None,
+    include_full_size: bool = True,
+):
+    """
+    Composite the watermark onto a decoded image and each of its output_variants.
+
+    The variants are downscaled from the image before it is watermarked, and get the watermark layer of the full
+    image scaled down with them (one cached layer per size), so each variant is placed like the full size output.
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark settings.
+        base_image (Image): The decoded (resized) image to watermark.
+        watermark_image (Image): The watermark image, if any.
+        text_image (Image): Preloaded text layer, if any.
+        text (str): Text to render for this image when there is no preloaded text layer.
+        include_full_size (bool): Also watermark base_image itself. Without it, only the variants are.
+
+    Returns:
+        tuple: (longest side, watermarked Image) pairs, starting with the full size image whose longest side is
+            None (None on failure), and a list of errors.
+    """
+    variants = downscale_variants(watermark_config, base_image)
+    outputs = []
+    if include_full_size:
+        output_image, errors = composite_watermark(watermark_config, base_image, watermark_image, text_image, text)
+        if len(errors) > 0:
+            return None, errors
+        outputs.append((None, output_image))
+    for longest_side, variant_image in variants:
+        output_image, errors = composite_watermark(
+            watermark_config, variant_image, watermark_image, text_image, text, reference_size=base_image.size
+        )
+        if len(errors) > 0:
+            return None, errors
+        outputs.append((longest_side, output_image))
+    return outputs, []
+
+
+def save_watermarked_variants(
+    watermark_config: WatermarkConfig,
+    outputs: list,
+    output_name: str,
+    source_format: str = None,
+    exif=None,
+    encoder_options: dict = None,
+):
+    # Saves the outputs of composite_watermark_variants, see save_watermarked_image. encoder_options only apply to
+    # the full size output. Returns the full size output filename (None on failure) and a list of errors.
+    output_filename = None
+    for longest_side, output_image in outputs:
+        filename, errors = save_watermarked_image(
+            watermark_config,
+            output_image,
+            output_name,
+            source_format,
+            exif,
+            variant=longest_side,
+            encoder_options=encoder_options if longest_side is None else None,
+        )
+        if len(errors) > 0:
+            return None, errors
+        if longest_side is None:
+            output_filename = filename
+    return output_filename, []
+
+
+def get_output_name(image_path: str):
+    # Name of the source file without its extension, used to build the output filename.
+    return ".".join(os.path.basename(image_path).split(".")[:-1])
+
+
+def decode_watermark_base(watermark_config: WatermarkConfig, base_image: Image, watermark_image: Image = None):
+    """
+    Check, resize and decode an opened image, ready to be watermarked.
+
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark settings.
+        base_image (Image): The opened, ideally not yet decoded, image to watermark.
+        watermark_image (Image): The watermark image, if any.
+
+    Returns:
+        tuple: The decoded (possibly resized) image (None on failure), the EXIF data of base_image and a list of
+            errors.
+    """
+    # Before reading exif, which decodes the whole image for some formats (png).
+    errors = check_image_memory(watermark_config, base_image, watermark_image)
+    if len(errors) > 0:
+        return None, None, errors
+    with profile_stage("exif"):
+        base_exif = base_image.getexif()
 
     # Resize the image if necessary based on the watermark_image file.
     base_image, errors = maybe_resize_image(watermark_config, base_image, watermark_image)
-    output_image = Image.new("RGBA", base_image.size, (0, 0, 0, 0))
+    if len(errors) > 0:
+        return None, None, errors
+    with profile_stage("decode"):
+        # Already done if the image was resized.
+        base_image.load()
+    return base_image, base_exif, []
 
-    # If we don't have a text layer, we must compute it now.
-    if text_image is None and text is not None:
-        text_image, errors = create_text_layer(
-            text,
-            base_image.size,
-            text_color=watermark_config.watermark_text_color,
-            width_ratio=watermark_config.minimal_watermark_width_percentage,
-            height_ratio=watermark_config.minimal_watermark_height_percentage,
+
+def apply_watermark_to_image(
+    watermark_config: WatermarkConfig,
+    base_image: Image,
+    watermark_image: Image = None,
+    text_image: Image = None,
+    text: str = None,
+):
+    # Applies the watermark to base_image in the locations specified by watermark_config, and saves it along with
+    # its output variants. Returns the full size output filename and a list of errors.
+    base_filename = base_image.filename
+    base_format = base_image.format
+    base_size = base_image.size
+    encoder_options = get_jpeg_source_options(watermark_config, base_image)
+    mcu_size = get_jpeg_region_mcu_size(encoder_options, base_image)
+    base_image, base_exif, errors = decode_watermark_base(watermark_config, base_image, watermark_image)
+    if len(errors) > 0:
+        return None, errors
+
+    if mcu_size is not None and base_image.size == base_size:
+        return apply_watermark_to_jpeg_regions(
+            watermark_config, base_filename, base_image, base_exif, mcu_size, watermark_image, text_image, text
         )
-        if watermark_image:
-            watermark_image = composite_sidebyside(watermark_image, text_image)
-        else:
-            watermark_image = text_image
 
+    outputs, errors = composite_watermark_variants(watermark_config, base_image, watermark_image, text_image, text)
     if len(errors) > 0:
         return None, errors
 
-    if watermark_image is None:
-        return None, ["Watermark was None. Either no image or no text specified"]
+    if watermark_config.show_generated_images:
+        outputs[0][1].show()
+    return save_watermarked_variants(
+        watermark_config, outputs, get_output_name(base_filename), base_format, base_exif, encoder_options
+    )
 
-    alpha_scale_value = int(255 * watermark_config.alpha_scale)
-    watermark_alpha = watermark_image.split()[-1]
-    alpha_scale = ImageChops.constant(watermark_alpha, alpha_scale_value)
-    if alpha_scale_value < 255:
-        watermark_alpha = ImageChops.multiply(watermark_alpha, alpha_scale)
-    for anchor in watermark_config.watermark_locations:
-        watermark_position, errors = get_watermark_position(anchor, base_image.size, watermark_image.size)
-        output_image.paste(watermark_image, watermark_position, mask=watermark_alpha)
-    output_image = Image.alpha_composite(base_image.convert("RGBA"), output_image)
+
+def get_jpeg_region_mcu_size(encoder_options: dict, base_image: Image):
+    """
+    MCU size of a JPEG whose full size output can be written by re-encoding only the regions the watermark covers.
+
+    Call it before base_image is decoded, and only use the regions if the image is not resized.
+    Args:
+        encoder_options (dict): Encoder options of base_image, see get_jpeg_source_options.
+        base_image (Image): The opened image to watermark.
+
+    Returns:
+        tuple: The MCU size, see watermark_jpeg.get_mcu_size, or None if the output must be re-encoded in full.
+    """
+    if len(encoder_options) > 0 and can_drop_regions(base_image) and find_jpegtran() is not None:
+        return get_mcu_size(base_image)
+    return None
+
+
+def composite_jpeg_regions(
+    watermark_config: WatermarkConfig,
+    base_image: Image,
+    mcu_size: tuple,
+    watermark_image: Image = None,
+    text_image: Image = None,
+    text: str = None,
+):
+    """
+    Composite the watermark onto the parts of a decoded JPEG it covers, grown to whole MCUs.
+
+    Gives the pixels composite_watermark gives for those parts, without touching the rest of the image.
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark settings.
+        base_image (Image): The decoded, not resized, JPEG.
+        mcu_size (tuple): MCU size of the JPEG, see watermark_jpeg.get_mcu_size.
+        watermark_image (Image): The watermark image, if any.
+        text_image (Image): Preloaded text layer, if any.
+        text (str): Text to render for this image when there is no preloaded text layer.
+
+    Returns:
+        tuple: (left, top, watermarked region) of every region (None on failure), in the mode of base_image, and a
+            list of errors.
+    """
+    prepared, errors = prepare_watermark_layer(
+        watermark_config, base_image.size, watermark_image, text if text_image is None else None
+    )
+    if len(errors) > 0:
+        return None, errors
+    watermark_positions, errors = get_watermark_positions(watermark_config, base_image.size, prepared.image.size)
+    if len(errors) > 0:
+        return None, errors
+
+    width, height = prepared.image.size
+    # Placements sharing an MCU must be dropped in together, or the second would undo the first.
+    boxes = [align_box((x, y, x + width, y + height), mcu_size, base_image.size) for x, y in watermark_positions]
+    regions = []
+    with profile_stage("composite"):
+        for box, indices in merge_boxes(boxes):
+            region = base_image.crop(box).convert("RGBA")
+            region.alpha_composite(make_region_overlay(prepared, box, [watermark_positions[i] for i in indices]))
+            regions.append((box[0], box[1], region.convert(base_image.mode)))
+    return regions, []
+
+
+def save_watermarked_jpeg_regions(
+    watermark_config: WatermarkConfig,
+    source_path: str,
+    regions: list,
+    encoder_options: dict,
+    outputs: list,
+    output_name: str,
+    exif=None,
+):
+    """
+    Save a JPEG watermarked region by region: the full size output by dropping the regions into source_path, see
+    watermark_jpeg.drop_regions, and its output variants as usual, see save_watermarked_variants.
+
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark and encoder settings.
+        source_path (str): The source JPEG.
+        regions (list): The watermarked regions, see composite_jpeg_regions.
+        encoder_options (dict): Encoder options of the source, see get_jpeg_source_options.
+        outputs (list): The output variants, see composite_watermark_variants with include_full_size False.
+        output_name (str): Name of the output files, see get_output_name.
+        exif: EXIF data for the output variants. The full size output keeps the markers of the source.
+
+    Returns:
+        tuple: The full size output filename (None on failure) and a list of errors.
+    """
+    output_filename = os.path.join(
+        watermark_config.output_folder, "%s_watermarked%s" % (output_name, OUTPUT_EXTENSIONS["jpeg"])
+    )
+    try:
+        if os.path.exists(output_filename) and os.stat(output_filename).st_nlink > 1:
+            # Hardlinked to the output of a duplicate input (see watermark_dedup), which must not change with it.
+            os.remove(output_filename)
+    except OSError as e:
+        return None, ["Unable to save %s. Error was: %s" % (output_filename, str(e))]
+    with profile_stage("encode"):
+        errors = drop_regions(source_path, regions, output_filename, encoder_options)
+    if len(errors) > 0:
+        return None, errors
+    _, errors = save_watermarked_variants(watermark_config, outputs, output_name, "JPEG", exif)
+    if len(errors) > 0:
+        return None, errors
+    return output_filename, []
+
+
+def apply_watermark_to_jpeg_regions(
+    watermark_config: WatermarkConfig,
+    source_path: str,
+    base_image: Image,
+    base_exif,
+    mcu_size: tuple,
+    watermark_image: Image = None,
+    text_image: Image = None,
+    text: str = None,
+):
+    """
+    Save the watermarked JPEG source_path by re-encoding only the MCUs the watermark covers, and its output variants
+    as usual, see save_watermarked_jpeg_regions.
+
+    Returns:
+        tuple: The full size output filename (None on failure) and a list of errors.
+    """
+    regions, errors = composite_jpeg_regions(watermark_config, base_image, mcu_size, watermark_image, text_image, text)
+    if len(errors) > 0:
+        return None, errors
+    outputs, errors = composite_watermark_variants(
+        watermark_config, base_image, watermark_image, text_image, text, include_full_size=False
+    )
+    if len(errors) > 0:
+        return None, errors
+    output_filename, errors = save_watermarked_jpeg_regions(
+        watermark_config,
+        source_path,
+        regions,
+        get_source_encoder_options(base_image),
+        outputs,
+        get_output_name(source_path),
+        base_exif,
+    )
+    if len(errors) > 0:
+        return None, errors
     if watermark_config.show_generated_images:
-        output_image.show()
-    output_filename = ".".join(os.path.basename(base_filename).split(".")[:-1])
-    output_filename = os.path.join(watermark_config.output_folder, "%s_watermarked.png" % (output_filename))
-    output_filename = os.path.splitext(output_filename)[0] + ".png"
-    output_image.save(output_filename, format="png", optimize=True, exif=base_exif)
-    return (output_filename, [])
+        Image.open(output_filename).show()
+    return output_filename, []
+
+
+def encode_jpeg_regions(
+    watermark_config: WatermarkConfig,
+    source,
+    base_image: Image,
+    mcu_size: tuple,
+    watermark_image: Image = None,
+    text_image: Image = None,
+    text: str = None,
+):
+    """
+    Encode the watermarked JPEG source by re-encoding only the MCUs the watermark covers, see
+    apply_watermark_to_jpeg_regions, and return it rather than saving it.
+
+    jpegtran works on files, so they go through a temporary folder.
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark settings.
+        source: Path or bytes of the encoded source JPEG.
+        base_image (Image): The decoded, not resized, source.
+        mcu_size (tuple): MCU size of the source, see get_jpeg_region_mcu_size.
+        watermark_image (Image): The watermark image, if any.
+        text_image (Image): Preloaded text layer, if any.
+        text (str): Text to render for this image when there is no preloaded text layer.
+
+    Returns:
+        tuple: The encoded watermarked JPEG (None on failure) and a list of errors.
+    """
+    regions, errors = composite_jpeg_regions(watermark_config, base_image, mcu_size, watermark_image, text_image, text)
+    if len(errors) > 0:
+        return None, errors
+    with TemporaryDirectory() as temporary_folder:
+        source_path = source
+        if not isinstance(source, str):
+            source_path = os.path.join(temporary_folder, "source.jpg")
+            with open(source_path, "wb") as source_file:
+                source_file.write(source)
+        output_path = os.path.join(temporary_folder, "watermarked.jpg")
+        with profile_stage("encode"):
+            errors = drop_regions(source_path, regions, output_path, get_source_encoder_options(base_image))
+        if len(errors) > 0:
+            return None, errors
+        with open(output_path, "rb") as output_file:
+            return output_file.read(), []
+
+
+def open_image_source(source):
+    """
+    Open an image held in memory.
+
+    Args:
+        source: A PIL Image, encoded image bytes, or a binary file-like object such as a BytesIO or sys.stdin.buffer.
+            Streams that can't seek are read into memory first.
+
+    Returns:
+        tuple: The image (None on failure) and a list of errors.
+    """
+    if isinstance(source, Image.Image):
+        return source, []
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    elif not (hasattr(source, "seekable") and source.seekable()):
+        # Pipes can't seek, which Pillow needs to identify and decode the image.
+        source = io.BytesIO(source.read())
+    position = source.tell()
+    errors = prepare_codecs_for_header(source.read(HEADER_SIZE))
+    source.seek(position)
+    if len(errors) > 0:
+        return None, errors
+    try:
+        return Image.open(source), []
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None, ["Image failed to load. Is it a valid image?"]
+
+
+def is_unloaded_image_file(image: Image):
+    # Whether image was opened from a file and not decoded (nor changed) since.
+    return isinstance(image, ImageFile.ImageFile) and image.fp is not None and bool(getattr(image, "filename", None))
+
+
+def watermark_in_memory(
+    watermark_config: WatermarkConfig,
+    source,
+    watermark_image: Image = None,
+    text_image: Image = None,
+    text: str = None,
+    encode: bool = True,
+):
+    """
+    Watermark an image held in memory, without touching the filesystem.
+
+    Load the watermark once with preload_watermark_and_text_images and pass it to every call. The source image is
+    never modified. The one exception to the filesystem rule is jpeg_lossless_regions, where JPEG sources go through
+    a temporary folder for jpegtran, see encode_jpeg_regions. A PIL Image source is only written that way if it was
+    opened from a file and not decoded since, otherwise it is re-encoded in full.
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark and encoder settings. The
+            output folder is not used.
+        source: The image to watermark, see open_image_source.
+        watermark_image (Image): The watermark image, if any.
+        text_image (Image): Preloaded text layer, if any.
+        text (str): Text to render for this image when there is no preloaded text layer.
+        encode (bool): Return the encoded image rather than the watermarked Image.
+
+    Returns:
+        tuple: The encoded bytes, or the watermarked Image without encode (None on failure), the output format
+            and a list of errors.
+    """
+    encoded_source = None
+    if encode and watermark_config.jpeg_lossless_regions and not isinstance(source, Image.Image):
+        # Kept for encode_jpeg_regions, which copies the blocks the watermark doesn't cover from the encoded source.
+        encoded_source = bytes(source) if isinstance(source, (bytes, bytearray, memoryview)) else source.read()
+        source = encoded_source
+    base_image, errors = open_image_source(source)
+    if len(errors) > 0:
+        return None, None, errors
+    if encoded_source is None and is_unloaded_image_file(base_image):
+        # Its pixels are still those of the file it was opened from.
+        encoded_source = base_image.filename
+    if base_image is source and is_large_image(watermark_config, base_image.size):
+        # Large images are watermarked in place, see composite_watermark_tiles.
+        base_image = base_image.copy()
+    output_format = get_output_format(watermark_config, base_image.format)
+    encoder_options = get_jpeg_source_options(watermark_config, base_image)
+    mcu_size = None
+    if encode and encoded_source is not None:
+        mcu_size = get_jpeg_region_mcu_size(encoder_options, base_image)
+    base_size = base_image.size
+    try:
+        base_image, base_exif, errors = decode_watermark_base(watermark_config, base_image, watermark_image)
+        if len(errors) > 0:
+            return None, None, errors
+        if mcu_size is not None and base_image.size == base_size:
+            output_data, errors = encode_jpeg_regions(
+                watermark_config, encoded_source, base_image, mcu_size, watermark_image, text_image, text
+            )
+            if len(errors) > 0:
+                return None, None, errors
+            return output_data, output_format, []
+
+        output_image, errors = composite_watermark(watermark_config, base_image, watermark_image, text_image, text)
+        if len(errors) > 0:
+            return None, None, errors
+        if watermark_config.show_generated_images:
+            output_image.show()
+        if not encode:
+            return output_image, output_format, []
+        output_data = io.BytesIO()
+        encode_watermarked_image(watermark_config, output_image, output_data, output_format, base_exif, encoder_options)
+    except (OSError, ValueError) as e:
+        return None, None, ["Failed to watermark image. Error was: %s" % str(e)]
+    return output_data.getvalue(), output_format, []
 
 
 def preload_watermark_and_text_images(watermark_config):
@@ -209,6 +1214,11 @@ def preload_watermark_and_text_images(watermark_config):
     text_image = None
     errors = []
     text = watermark_config.watermark_text
+    # Every batch, worker and service loads the watermark first, before decoding any HEIF image.
+    configure_heif_decoder(
+        get_decode_threads(watermark_config.heif_decode_threads, get_worker_count(watermark_config)),
+        watermark_config.heif_thumbnails,
+    )
 
     if watermark_config.watermark_file is not None:
         watermark_image, errors = load_image(watermark_config.watermark_file)
@@ -216,14 +1226,15 @@ def preload_watermark_and_text_images(watermark_config):
     if len(errors) > 0:
         return None, None, None, errors
 
-    if watermark_image is not None and watermark_config.watermark_text_to_image_ratio is not None:
+    if watermark_image is not None and text is not None and watermark_config.watermark_text_to_image_ratio is not None:
         # We can take the easy path and load both images at the same time. No further text computation will be needed.
         text_image, errors = create_text_layer(
-            watermark_config,
+            text,
             image_size=watermark_image.size,
             text_color=watermark_config.watermark_text_color,
-            minimal_width_ratio=watermark_config.watermark_text_to_image_ratio,
-            minimal_height_ratio=watermark_config.watermark_text_to_image_ratio,
+            width_ratio=watermark_config.watermark_text_to_image_ratio,
+            height_ratio=watermark_config.watermark_text_to_image_ratio,
+            font_path=watermark_config.watermark_font_path,
         )
         if len(errors) > 0:
             return (None, None, None, errors)
@@ -235,25 +1246,313 @@ def preload_watermark_and_text_images(watermark_config):
     return watermark_image, text_image, text, errors
 
 
+def watermark_file(
+    watermark_config: WatermarkConfig,
+    image_path: str,
+    watermark_image: Image = None,
+    text_image: Image = None,
+    text: str = None,
+):
+    """
+    Loads a single file and applies the watermark to it.
+
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark settings.
+        image_path (str): Path of the image to watermark.
+        watermark_image (Image): Preloaded watermark image, if any.
+        text_image (Image): Preloaded text layer, if any.
+        text (str): Text to render per image when no text layer was preloaded.
+
+    Returns:
+        SimpleNamespace: The input file, the output file (None on failure), any error messages, the duration and
+            the seconds spent per stage, see watermark_profile.
+    """
+    print("processing: %s" % image_path)
+    result = SimpleNamespace(input_file=image_path, output_file=None, errors=[], duration=None, stages={})
+    start = time.perf_counter()
+    with profile_file(image_path, result.stages):
+        with profile_stage("open"):
+            base_image, errors = load_image(image_path)
+        if len(errors) > 0:
+            result.errors = errors
+        else:
+            try:
+                result.output_file, result.errors = apply_watermark_to_image(
+                    watermark_config, base_image, watermark_image, text_image, text=text
+                )
+            except Exception as e:
+                # Truncated or corrupt files may only fail once decoded.
+                result.errors = ["Failed to watermark %s. Error was: %s" % (image_path, str(e))]
+    result.duration = time.perf_counter() - start
+    return result
+
+
+# Per process state of the batch engine workers. Set once by _initialize_worker.
+_worker_state = None
+
+
+def _initialize_worker(watermark_config: WatermarkConfig):
+    # Loads the watermark and text layer once per worker process rather than once per file.
+    global _worker_state
+    watermark_image, text_image, text, errors = preload_watermark_and_text_images(watermark_config)
+    _worker_state = SimpleNamespace(
+        watermark_config=watermark_config,
+        watermark_image=watermark_image,
+        text_image=text_image,
+        text=text,
+        errors=errors,
+    )
+
+
+def _watermark_file_in_worker(image_path: str):
+    state = _worker_state
+    if len(state.errors) > 0:
+        return SimpleNamespace(input_file=image_path, output_file=None, errors=state.errors, duration=None, stages={})
+    watermark_config = state.watermark_config
+    if watermark_config.profile_report_file is None or watermark_config.profile_cprofile_file is None:
+        return watermark_file(watermark_config, image_path, state.watermark_image, state.text_image, state.text)
+    # The cProfile capture of the batch only sees the parent process, the statistics of each file are sent back with
+    # its result, see WatermarkProfiler.record.
+    import cProfile
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        result = watermark_file(watermark_config, image_path, state.watermark_image, state.text_image, state.text)
+    finally:
+        profile.disable()
+    result.cprofile_stats = get_cprofile_stats(profile)
+    return result
+
+
+def ordered_map(executor, function, items, window: int):
+    # Like executor.map, but only keeps `window` items in flight so that long (or lazily generated) file lists
+    # are neither submitted nor read all at once. Results are yielded in input order.
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def get_worker_count(watermark_config: WatermarkConfig):
+    # 0 (or None) means one worker per available core.
+    if not watermark_config.workers:
+        return os.cpu_count() or 1
+    return watermark_config.workers
+
+
+def create_worker_pool(watermark_config: WatermarkConfig):
+    # A pool of get_worker_count processes, each loading the watermark and text layer once, see watermark_files.
+    # Imported here, multiprocessing is slow to import and only needed with several workers.
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Workers get the files one at a time, and the list may be a (not picklable) lazy iterable.
+    worker_config = copy.copy(watermark_config)
+    worker_config.files_to_watermark = []
+    return ProcessPoolExecutor(
+        max_workers=get_worker_count(watermark_config), initializer=_initialize_worker, initargs=(worker_config,)
+    )
+
+
+def watermark_files(
+    watermark_config: WatermarkConfig,
+    watermark_image=None,
+    text_image=None,
+    text=None,
+    files=None,
+    executor=None,
+):
+    """
+    Watermarks every file in files, or in watermark_config.files_to_watermark by default.
+
+    With more than one worker, decoding, compositing and encoding run in a process pool. Each worker loads the
+    watermark and text layer once. With a single worker and pipeline_mode, the three stages run on their own threads
+    instead, see watermark_pipeline. Results are yielded in the same order as the input files.
+
+    Args:
+        watermark_config (WatermarkConfig): Configuration object containing watermark settings.
+        watermark_image (Image): Preloaded watermark image, used by the serial path.
+        text_image (Image): Preloaded text layer, used by the serial path.
+        text (str): Text to render per image, used by the serial path.
+        files (iterable): Files to watermark instead of watermark_config.files_to_watermark. May be lazy.
+        executor (ProcessPoolExecutor): Pool of several workers to use, see create_worker_pool. Without it, a pool
+            is started for this call.
+
+    Yields:
+        SimpleNamespace: One result per input file, see watermark_file.
+    """
+    if files is None:
+        files = watermark_config.files_to_watermark
+    workers = get_worker_count(watermark_config)
+    if workers <= 1 and watermark_config.pipeline_mode:
+        # Imported here, the pipeline module builds on this one.
+        from watermark_pipeline import WatermarkPipeline
+
+        pipeline = WatermarkPipeline(watermark_config, watermark_image, text_image, text)
+        yield from pipeline.run(files)
+        return
+    if workers <= 1:
+        for image in files:
+            yield watermark_file(watermark_config, image, watermark_image, text_image, text)
+        return
+
+    if executor is not None:
+        yield from ordered_map(executor, _watermark_file_in_worker, files, workers * 2)
+        return
+    with create_worker_pool(watermark_config) as executor:
+        try:
+            yield from ordered_map(executor, _watermark_file_in_worker, files, workers * 2)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _with_duplicates(results, dedup):
+    # The results of the watermarked files, each followed by the results of the copies it resolves.
+    for result in results:
+        yield result
+        yield from dedup.resolve(result)
+    yield from dedup.flush()
+
+
+class WatermarkBatch:
+    def __init__(self, watermark_config: WatermarkConfig, watermark_image=None, text_image=None, text=None):
+        """
+        Watermarks files and keeps track of their results. Shared by apply_watermark, the GUI and watermark_watch.
+
+        Files go through the manifest (with resume) and the dedup index (with deduplicate), then watermark_files.
+        Every result is passed to the profile hooks and recorded in the report, the profiler and the manifest before
+        it is yielded. run can be called again with more files, the worker pool is kept until close.
+
+        Attributes:
+            report (WatermarkReport): Outcome of every file so far.
+            profiler (WatermarkProfiler): Stage timings, None without watermark_config.profile_report_file.
+            manifest (WatermarkManifest): None without watermark_config.resume.
+            dedup (WatermarkDedup): None without watermark_config.deduplicate.
+        """
+        self.watermark_config = watermark_config
+        self.report = WatermarkReport(watermark_config.output_variants)
+        # With resume, inputs whose output is already current are skipped and finished files are recorded as we go.
+        self.manifest = None
+        if watermark_config.resume:
+            # Imported here, only needed when resuming.
+            from watermark_manifest import WatermarkManifest
+
+            self.manifest = WatermarkManifest(watermark_config)
+        # With deduplicate, copies of an input already watermarked (in this batch or an earlier one) get its outputs.
+        self.dedup = None
+        if watermark_config.deduplicate:
+            # Imported here, only needed when deduplicating.
+            from watermark_dedup import WatermarkDedup
+
+            self.dedup = WatermarkDedup(watermark_config)
+        self.profiler = None
+        if watermark_config.profile_report_file is not None:
+            self.profiler = WatermarkProfiler(watermark_config.profile_cprofile_file, watermark_config.profile_memory)
+            self.profiler.start()
+        self._executor = None
+        self.set_watermark(watermark_image, text_image, text)
+
+    def set_watermark(self, watermark_image=None, text_image=None, text=None):
+        # The preloaded watermark of the following files. Worker processes load their own, so they are restarted.
+        self.watermark_image = watermark_image
+        self.text_image = text_image
+        self.text = text
+        self._shutdown_pool()
+        # A new version of the watermark file changes the settings outputs are made with.
+        if self.manifest is not None or self.dedup is not None:
+            from watermark_manifest import get_config_hash
+
+            config_hash = get_config_hash(self.watermark_config)
+            for index in [self.manifest, self.dedup]:
+                if index is not None:
+                    index.config_hash = config_hash
+
+    def run(self, files=None):
+        """
+        Watermark files (watermark_config.files_to_watermark by default), yielding each result once recorded.
+
+        Results are in input order, each followed by the results of its copies with deduplicate. Closing the
+        generator early stops the batch.
+        """
+        if files is None:
+            files = self.watermark_config.files_to_watermark
+        if self.manifest is not None:
+            files = self.manifest.filter_files(files)
+        if self.dedup is not None:
+            files = self.dedup.filter_files(files)
+        if self._executor is None and get_worker_count(self.watermark_config) > 1:
+            self._executor = create_worker_pool(self.watermark_config)
+        results = watermark_files(
+            self.watermark_config, self.watermark_image, self.text_image, self.text, files, self._executor
+        )
+        try:
+            for result in results if self.dedup is None else _with_duplicates(results, self.dedup):
+                self.record(result)
+                yield result
+        finally:
+            results.close()
+
+    def record(self, result):
+        notify_profile_hooks(result.input_file, result.stages)
+        if self.profiler is not None:
+            self.profiler.record(
+                result.input_file, result.duration, result.stages, getattr(result, "cprofile_stats", None)
+            )
+        self.report.record(result)
+        if len(result.errors) == 0 and self.manifest is not None:
+            self.manifest.record(result.input_file, result.output_file)
+
+    def write_reports(self):
+        # Writes the result and profile reports the configuration asks for, with the files so far.
+        if self.profiler is not None:
+            self.profiler.write_report(self.watermark_config.profile_report_file)
+        if self.watermark_config.result_report_file is not None:
+            self.report.write(self.watermark_config.result_report_file)
+
+    def close(self):
+        self._shutdown_pool()
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.manifest is not None:
+            self.manifest.compact()
+        if self.dedup is not None:
+            self.dedup.compact()
+            print("duplicates linked: %d" % self.dedup.duplicates)
+        if get_worker_count(self.watermark_config) <= 1:
+            print("watermark cache: %s" % PREPARED_WATERMARK_CACHE.stats())
+        self.write_reports()
+
+    def _shutdown_pool(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
 def apply_watermark(watermark_config: WatermarkConfig):
     watermark_image, text_image, text, errors = preload_watermark_and_text_images(watermark_config)
 
     if len(errors) > 0:
         return (False, errors)
 
-    for image in watermark_config.files_to_watermark:
-        print("processing: %s" % image)
-        base_image, errors = load_image(image)
-        if len(errors) > 0:
-            return (False, errors)
-
-        output_image, errors = apply_watermark_to_image(
-            watermark_config,
-            base_image,
-            watermark_image,
-            text_image,
-            text=watermark_config.watermark_text if text_image is None else None,
-        )
-        if len(errors) > 0:
-            return (False, errors)
-    return True, []
+    batch = WatermarkBatch(watermark_config, watermark_image, text_image, text)
+    results = batch.run()
+    try:
+        for result in results:
+            if len(result.errors) > 0:
+                if not watermark_config.continue_on_error:
+                    return (False, result.errors)
+                print("failed: %s" % result.input_file)
+    finally:
+        results.close()
+        batch.close()
+    print(batch.report.format_summary())
+    # Only failed files are left with continue_on_error.
+    errors = batch.report.get_errors()
+    return len(errors) == 0, errors
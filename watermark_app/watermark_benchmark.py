@@ -0,0 +1,363 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import statistics
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+import PIL
+from PIL import Image, ImageChops
+
+import watermark
+from watermark_codecs import register_heif_opener
+from watermark_config import WatermarkConfig
+from watermark_heic import configure_heif_decoder, draft_heif_thumbnail, get_decode_threads, get_heif_opener_options
+
+VALID_FORMATS = ["jpeg", "png", "heic"]
+VALID_MODES = ["RGB", "RGBA", "L"]
+FILE_EXTENSIONS = {"jpeg": ".jpg", "png": ".png", "heic": ".heic"}
+
+# Functions of watermark.py that are timed. Throughput is reported per image, so higher is better.
+BENCHMARKED_FUNCTIONS = [
+    "load_image",
+    "maybe_resize_image",
+    "create_text_layer",
+    "apply_watermark_to_image",
+    "apply_watermark",
+]
+
+
+def make_synthetic_image(size: tuple, mode: str):
+    """
+    Create a deterministic test image of size and mode.
+
+    A gradient with a noise texture, so codecs have realistic (not trivially compressible) data to work on.
+    """
+    noise_tile = Image.effect_noise((512, 512), 48)
+    texture = Image.new("L", size)
+    for x in range(0, size[0], noise_tile.width):
+        for y in range(0, size[1], noise_tile.height):
+            texture.paste(noise_tile, (x, y))
+    bands = [
+        ImageChops.add(Image.linear_gradient("L").resize(size), texture, scale=2.0),
+        ImageChops.add(Image.radial_gradient("L").resize(size), texture, scale=2.0),
+        ImageChops.add(Image.linear_gradient("L").rotate(90).resize(size), texture, scale=2.0),
+    ]
+    if mode == "L":
+        return bands[0]
+    if mode == "RGBA":
+        return Image.merge("RGBA", bands + [Image.radial_gradient("L").resize(size)])
+    return Image.merge("RGB", bands)
+
+
+def get_image_size(megapixels: float):
+    # 4:3 image of about megapixels million pixels.
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    return (width, int(width * 3 / 4))
+
+
+def get_case_name(image_format: str, mode: str, megapixels: float):
+    return "%s-%s-%gMP" % (image_format, mode, megapixels)
+
+
+def get_peak_rss_mb():
+    # Peak resident set size of this process, None where the resource module is missing (Windows).
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+
+def _time_calls(function, repeats: int):
+    # Returns the median duration of repeats calls of function.
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def time_heic_decode(image_path: str, repeats: int = 3, preview_side: int = 256):
+    """
+    Time decoding a HEIC/HEIF file in full, and through its embedded thumbnail for a preview of preview_side.
+
+    Returns:
+        dict: The median seconds of both decodes (the thumbnail ones None when no thumbnail is large enough), the
+            image and thumbnail sizes, and the decoder threads. Contains an "error" instead if the file can't be read.
+    """
+    image, errors = watermark.load_image(image_path)
+    if len(errors) > 0:
+        return {"file": image_path, "error": "\n".join(errors)}
+    preview_size = watermark.get_variant_size(image.size, preview_side)
+    results = {
+        "file": image_path,
+        "size": list(image.size),
+        "decode_threads": get_heif_opener_options()["decode_threads"],
+        "decode_seconds": None,
+        "thumbnail_size": None,
+        "thumbnail_decode_seconds": None,
+    }
+
+    def decode(use_thumbnail):
+        image, errors = watermark.load_image(image_path)
+        if use_thumbnail:
+            draft_heif_thumbnail(image, preview_size)
+        image.load()
+        return image.size
+
+    results["decode_seconds"] = _time_calls(lambda: decode(False), repeats)
+    image, errors = watermark.load_image(image_path)
+    if draft_heif_thumbnail(image, preview_size):
+        results["thumbnail_size"] = list(image.size)
+        results["thumbnail_decode_seconds"] = _time_calls(lambda: decode(True), repeats)
+    return results
+
+
+def run_case(image_format: str, mode: str, megapixels: float, images: int = 3, repeats: int = 3):
+    """
+    Benchmark every function of BENCHMARKED_FUNCTIONS on synthetic inputs of one format, mode and size.
+
+    Returns:
+        dict: Per function median seconds per image and images per second, plus the peak RSS of the process.
+            Contains an "error" instead if the inputs could not be created.
+    """
+    if image_format == "heic":
+        errors = register_heif_opener()
+        if len(errors) > 0:
+            return {"error": "\n".join(errors)}
+
+    size = get_image_size(megapixels)
+    with TemporaryDirectory() as temp_dir:
+        input_image = make_synthetic_image(size, mode)
+        files = []
+        for index in range(images):
+            image_path = os.path.join(temp_dir, "input_%d%s" % (index, FILE_EXTENSIONS[image_format]))
+            try:
+                input_image.save(image_path)
+            except (OSError, ValueError) as e:
+                return {"error": "Unable to write %s %s images: %s" % (image_format, mode, str(e))}
+            files.append(image_path)
+        del input_image
+
+        watermark_file = os.path.join(temp_dir, "watermark.png")
+        watermark_image = Image.new("RGBA", (max(size[0] // 20, 1), max(size[1] // 20, 1)), (255, 255, 255, 128))
+        watermark_image.save(watermark_file)
+        output_folder = os.path.join(temp_dir, "output")
+        os.makedirs(output_folder)
+
+        config = WatermarkConfig()
+        config.watermark_file = watermark_file
+        config.watermark_text = "Benchmark"
+        config.files_to_watermark = files
+        config.output_folder = output_folder
+        config.watermark_locations = ["top-left", "bottom-right"]
+        # Scaling to a watermark of a quarter of the image exercises the resize path.
+        config.minimal_watermark_width_percentage = 0.25
+        config.minimal_watermark_height_percentage = 0.25
+        preloaded_watermark, text_image, text, errors = watermark.preload_watermark_and_text_images(config)
+
+        def load():
+            image, errors = watermark.load_image(files[0])
+            image.load()
+
+        def resize():
+            image, errors = watermark.load_image(files[0])
+            watermark.maybe_resize_image(config, image, preloaded_watermark)
+
+        def text_layer():
+            # Bypasses the font size cache, so that fitting is measured too.
+            watermark.create_text_layer("Benchmark %d" % time.perf_counter_ns(), size, width_ratio=0.25)
+
+        def apply_to_image():
+            image, errors = watermark.load_image(files[0])
+            watermark.apply_watermark_to_image(config, image, preloaded_watermark, text_image, text)
+
+        def apply_to_batch():
+            watermark.apply_watermark(config)
+
+        calls = {
+            "load_image": (load, 1),
+            "maybe_resize_image": (resize, 1),
+            "create_text_layer": (text_layer, 1),
+            "apply_watermark_to_image": (apply_to_image, 1),
+            "apply_watermark": (apply_to_batch, images),
+        }
+        results = {"size": list(size), "images": images}
+        for function_name in BENCHMARKED_FUNCTIONS:
+            function, images_per_call = calls[function_name]
+            seconds = _time_calls(function, repeats) / images_per_call
+            results[function_name] = {"seconds": seconds, "images_per_second": 1.0 / seconds if seconds > 0 else None}
+        if image_format == "heic":
+            results["heic_decode"] = [time_heic_decode(image_path, repeats) for image_path in files]
+    results["peak_rss_mb"] = get_peak_rss_mb()
+    return results
+
+
+def _run_case_in_process(arguments, results_queue):
+    results_queue.put(run_case(*arguments))
+
+
+def run_case_isolated(image_format: str, mode: str, megapixels: float, images: int = 3, repeats: int = 3):
+    # Runs the case in a fresh process, so its peak RSS isn't the peak of an earlier, larger case.
+    results_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_run_case_in_process, args=((image_format, mode, megapixels, images, repeats), results_queue)
+    )
+    process.start()
+    while True:
+        try:
+            results = results_queue.get(timeout=1)
+            break
+        except queue.Empty:
+            # Killed, for example by running out of memory on the largest sizes.
+            if not process.is_alive():
+                results = {"error": "Benchmark process died with exit code %s" % process.exitcode}
+                break
+    process.join()
+    return results
+
+
+def run_benchmarks(
+    formats: list,
+    modes: list,
+    megapixels: list,
+    images: int = 3,
+    repeats: int = 3,
+    isolate=True,
+    heic_files: list = None,
+):
+    """
+    Benchmark every combination of formats, modes and sizes, and the decoding of each of heic_files.
+
+    Returns:
+        dict: The environment the benchmark ran in, the results of each case (see run_case) and the decode timings
+            of heic_files (see time_heic_decode).
+    """
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "cases": {},
+    }
+    for image_format in formats:
+        for mode in modes:
+            for case_megapixels in megapixels:
+                case_name = get_case_name(image_format, mode, case_megapixels)
+                print("benchmarking: %s" % case_name)
+                run = run_case_isolated if isolate else run_case
+                results["cases"][case_name] = run(image_format, mode, case_megapixels, images, repeats)
+    if heic_files:
+        # Decoded as a batch with the default settings would.
+        config = WatermarkConfig()
+        configure_heif_decoder(get_decode_threads(config.heif_decode_threads), config.heif_thumbnails)
+        errors = register_heif_opener()
+        for image_path in heic_files:
+            print("benchmarking: %s" % image_path)
+            if len(errors) > 0:
+                results.setdefault("heic_files", []).append({"file": image_path, "error": "\n".join(errors)})
+                continue
+            results.setdefault("heic_files", []).append(time_heic_decode(image_path, repeats))
+    return results
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float = 0.1):
+    """
+    Compare benchmark results against a baseline.
+
+    A regression is a throughput more than tolerance below the baseline, or a peak RSS or HEIC file decode time more
+    than tolerance above. Cases and files missing from either side are ignored.
+
+    Returns:
+        list: A message per regression.
+    """
+    regressions = []
+    for case_name, case in results["cases"].items():
+        baseline_case = baseline.get("cases", {}).get(case_name)
+        if baseline_case is None or "error" in case or "error" in baseline_case:
+            continue
+        for function_name in BENCHMARKED_FUNCTIONS:
+            if function_name not in case or function_name not in baseline_case:
+                continue
+            throughput = case[function_name]["images_per_second"]
+            baseline_throughput = baseline_case[function_name]["images_per_second"]
+            if throughput is not None and baseline_throughput is not None:
+                if throughput < baseline_throughput * (1.0 - tolerance):
+                    regressions.append(
+                        "%s %s: %.3f images/s, baseline %.3f images/s"
+                        % (case_name, function_name, throughput, baseline_throughput)
+                    )
+        peak_rss = case.get("peak_rss_mb")
+        baseline_peak_rss = baseline_case.get("peak_rss_mb")
+        if peak_rss is not None and baseline_peak_rss is not None:
+            if peak_rss > baseline_peak_rss * (1.0 + tolerance):
+                regressions.append("%s peak RSS: %.1f MB, baseline %.1f MB" % (case_name, peak_rss, baseline_peak_rss))
+    baseline_files = {entry["file"]: entry for entry in baseline.get("heic_files", [])}
+    for entry in results.get("heic_files", []):
+        baseline_entry = baseline_files.get(entry["file"])
+        if baseline_entry is None or "error" in entry or "error" in baseline_entry:
+            continue
+        for timing in ["decode_seconds", "thumbnail_decode_seconds"]:
+            seconds = entry.get(timing)
+            baseline_seconds = baseline_entry.get(timing)
+            if seconds is not None and baseline_seconds is not None and seconds > baseline_seconds * (1.0 + tolerance):
+                regressions.append("%s %s: %.3fs, baseline %.3fs" % (entry["file"], timing, seconds, baseline_seconds))
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmarks the watermark pipeline on synthetic images.")
+    parser.add_argument("output", type=str, help="JSON file the results are written to")
+    parser.add_argument(
+        "--megapixels", type=float, nargs="+", default=[2, 12, 48, 100], help="Sizes of the synthetic images"
+    )
+    parser.add_argument("--formats", type=str, nargs="+", choices=VALID_FORMATS, default=VALID_FORMATS)
+    parser.add_argument("--modes", type=str, nargs="+", choices=VALID_MODES, default=VALID_MODES)
+    parser.add_argument("--images", type=int, default=3, help="Number of images in the apply_watermark batch")
+    parser.add_argument("--repeats", type=int, default=3, help="Timings are the median of this many runs")
+    parser.add_argument(
+        "--heic_files", type=str, nargs="+", default=[], help="Real HEIC/HEIF files whose decoding is timed too"
+    )
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="Allowed relative slow down (or memory growth) over the baseline"
+    )
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    results = run_benchmarks(
+        arguments.formats,
+        arguments.modes,
+        arguments.megapixels,
+        arguments.images,
+        arguments.repeats,
+        heic_files=arguments.heic_files,
+    )
+    with open(arguments.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_results(results, baseline, arguments.tolerance)
+        if len(regressions) > 0:
+            print("Regressions against %s:" % arguments.baseline)
+            print("\n".join(regressions))
+            sys.exit(1)
+        print("No regressions against %s" % arguments.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        """
+        Bounded least recently used cache, sized by the bytes each entry is said to take in put.
+
+        Entries are evicted oldest first once the summed size of the cached entries goes over max_bytes.
+        Safe to share between threads.
+
+        Attributes:
+            max_bytes (int): Memory cap for all cached entries. 0 disables caching.
+            hits (int): Number of lookups that found an entry.
+            misses (int): Number of lookups that did not.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._current_bytes = 0
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size_bytes: int):
+        with self._lock:
+            if key in self._entries:
+                self._current_bytes -= self._entries.pop(key)[1]
+            if size_bytes > self.max_bytes:
+                return
+            self._entries[key] = (value, size_bytes)
+            self._current_bytes += size_bytes
+            self._evict()
+
+    def set_max_bytes(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _evict(self):
+        while self._current_bytes > self.max_bytes and len(self._entries) > 0:
+            self._current_bytes -= self._entries.popitem(last=False)[1][1]
+
+
+class PreparedWatermarkCache(LRUCache):
+    """
+    Bounded least recently used cache of prepared watermark layers, see watermark.prepare_watermark_layer.
+
+    Layers are keyed on the id() of their source watermark image, which each entry keeps alive.
+    """
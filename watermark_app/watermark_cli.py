@@ -1,26 +1,38 @@
 import argparse
-import glob
+import contextlib
+import itertools
 import os
 import sys
 from types import SimpleNamespace
 
-from PIL import Image
-
-from watermark_config import WatermarkConfig
-from watermark import apply_watermark
-
-VALID_VERTICAL = ["bottom", "top", "center", "random"]
-VALID_HORIZONTAL = ["right", "left", "center", "random"]
+from watermark_config import (
+    VALID_HORIZONTAL,
+    VALID_JPEG_SUBSAMPLING,
+    VALID_OUTPUT_FORMATS,
+    VALID_RESIZE_MODES,
+    VALID_VERTICAL,
+    WatermarkConfig,
+)
+from watermark import (
+    OUTPUT_EXTENSIONS,
+    apply_watermark,
+    get_output_name,
+    preload_watermark_and_text_images,
+    watermark_in_memory,
+)
+from watermark_discovery import discover_images
 
 
 def config_from_arguments(arguments):
     config = SimpleNamespace(watermark_config=WatermarkConfig(), input_file_regex=None)
-    config.input_file_regex = arguments.input_images
-    config.watermark_config.output_folder = arguments.output_folder
+    # Services (see watermark_server) take no input or output paths.
+    config.input_file_regex = getattr(arguments, "input_images", None)
+    config.watermark_config.output_folder = getattr(arguments, "output_folder", None)
     if arguments.watermark_image is not None and len(arguments.watermark_image) > 0:
         config.watermark_config.watermark_file = arguments.watermark_image
     if arguments.watermark_text is not None and len(arguments.watermark_text) > 0:
         config.watermark_config.watermark_text = arguments.watermark_text
+    config.watermark_config.watermark_font_path = arguments.font
 
     config.watermark_config.show_generated_images = arguments.show
     watermark_placement = ["top", "left"]
@@ -32,6 +44,34 @@ def config_from_arguments(arguments):
     config.watermark_config.minimal_watermark_height_percentage = arguments.min_vertical_ratio
     config.watermark_config.minimal_watermark_width_percentage = arguments.min_horizontal_ratio
     config.watermark_config.watermark_locations.append("-".join(watermark_placement))
+    config.watermark_config.workers = arguments.workers
+    config.watermark_config.watermark_cache_max_mb = arguments.watermark_cache_mb
+    config.watermark_config.resize_mode = arguments.resize_mode
+    config.watermark_config.output_variants = arguments.output_variants
+    config.watermark_config.heif_decode_threads = arguments.heif_decode_threads
+    config.watermark_config.heif_thumbnails = not arguments.no_heif_thumbnails
+    config.watermark_config.large_image_pixel_threshold = arguments.large_image_pixels
+    config.watermark_config.large_image_tile_size = arguments.large_image_tile_size
+    config.watermark_config.max_image_memory_mb = arguments.max_image_memory_mb
+    config.watermark_config.pipeline_mode = arguments.pipeline
+    config.watermark_config.continue_on_error = arguments.continue_on_error
+    config.watermark_config.result_report_file = arguments.report
+    config.watermark_config.profile_report_file = arguments.profile
+    config.watermark_config.profile_cprofile_file = arguments.profile_cprofile
+    config.watermark_config.profile_memory = arguments.profile_memory
+    config.watermark_config.resume = arguments.resume
+    config.watermark_config.manifest_hash_contents = arguments.hash_inputs
+    config.watermark_config.deduplicate = arguments.deduplicate
+    config.watermark_config.pipeline_queue_depth = arguments.pipeline_queue_depth
+    config.watermark_config.output_format = arguments.output_format
+    config.watermark_config.png_compress_level = arguments.png_compress_level
+    config.watermark_config.png_optimize = not arguments.no_png_optimize
+    config.watermark_config.jpeg_quality = arguments.jpeg_quality
+    config.watermark_config.jpeg_subsampling = arguments.jpeg_subsampling
+    config.watermark_config.jpeg_lossless_regions = arguments.jpeg_lossless_regions
+    config.watermark_config.webp_lossless = arguments.webp_lossless
+    config.watermark_config.webp_quality = arguments.webp_quality
+    config.watermark_config.webp_method = arguments.webp_method
     try:
         config.watermark_config.alpha_scale = float(arguments.alpha_scale)
     except ValueError:
@@ -40,31 +80,17 @@ def config_from_arguments(arguments):
     return config
 
 
-def is_valid_image(file_path):
-    try:
-        with Image.open(file_path) as img:
-            img.verify()
-            return True
-    except (IOError, SyntaxError):
-        return False
-
-
-def find_files(file_search_path):
-    file_list = []
-    for filename in glob.glob(file_search_path):
-        if os.path.isfile(filename):
-            if is_valid_image(filename):
-                file_list.append(filename)
-
-    if len(file_list) == 0:
+def find_files(file_search_path, recursive=False, discovery_threads=16):
+    # Returns a lazy iterable of the images to process, so processing starts while discovery is still running.
+    files = discover_images(file_search_path, recursive=recursive, threads=discovery_threads)
+    first_file = next(files, None)
+    if first_file is None:
         print("No files matching pattern: %s" % (file_search_path))
         sys.exit(1)
     else:
-        print("will process the following images:")
-        for image in file_list:
-            print("", image)
+        print("will process the images matching: %s" % (file_search_path))
 
-    return file_list
+    return itertools.chain([first_file], files)
 
 
 def create_folder(output_folder_path):
@@ -84,10 +110,25 @@ def create_folder(output_folder_path):
     return error_messages
 
 
-def parse_arguments():
-    parser = argparse.ArgumentParser(description="Applies a watermark to a set of images.")
-    parser.add_argument("input_images", type=str, help="Input images pattern")
-    parser.add_argument("output_folder", type=str, help="Output folder")
+def create_argument_parser(
+    description="Applies a watermark to a set of images.",
+    input_help="Input images pattern, or a folder. - reads one image from stdin",
+):
+    # Shared with watermark_watch and watermark_server, which take the same watermark options. Without input_help
+    # there are no input and output arguments.
+    parser = argparse.ArgumentParser(description=description)
+    if input_help is not None:
+        # "-" reads a single image from stdin, or writes it to stdout, see watermark_stream.
+        parser.add_argument("input_images", type=str, help=input_help)
+        parser.add_argument("output_folder", type=str, help="Output folder. - writes the image to stdout")
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="Include images in sub folders of an input folder, or let '**' match sub folders in a pattern",
+    )
+    parser.add_argument(
+        "--discovery_threads", type=int, default=16, help="Number of files whose headers are checked concurrently"
+    )
     parser.add_argument("--show", action="store_true", help="Whether to show each generated image")
     parser.add_argument(
         "--vertical_anchor", type=str, choices=VALID_VERTICAL, help="Where to anchor the watermark vertically"
@@ -113,23 +154,234 @@ def parse_arguments():
         default=None,
         help="Minimum ratio between vertical sizes of watermark and base images",
     )
+    parser.add_argument(
+        "--resize_mode",
+        type=str,
+        choices=VALID_RESIZE_MODES,
+        default="quality",
+        help="When scaling, 'speed' decodes large images at a reduced resolution (e.g. JPEG DCT scaling) first",
+    )
+    parser.add_argument(
+        "--output_variants",
+        type=int,
+        nargs="+",
+        default=[],
+        help="Also write smaller copies with these longest sides in pixels, e.g. 2048 1024 256",
+    )
+    parser.add_argument(
+        "--heif_decode_threads",
+        type=int,
+        default=0,
+        help="Threads decoding each HEIC/HEIF image. 0 shares the cores between the workers",
+    )
+    parser.add_argument(
+        "--no_heif_thumbnails",
+        action="store_true",
+        help="Always decode HEIC/HEIF images in full, even when the embedded thumbnail is large enough",
+    )
     parser.add_argument(
         "--watermark_image", type=str, help="Image watermark to apply. One of image or text must be provided."
     )
     parser.add_argument(
         "--watermark_text", type=str, help="Text watermark to apply. One of image or text must be provided."
     )
-    return parser.parse_args()
+    parser.add_argument("--font", type=str, default=None, help="TrueType font used for the text watermark")
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=VALID_OUTPUT_FORMATS,
+        default="png",
+        help="Format of the watermarked images. 'source' keeps the format of each input where possible",
+    )
+    parser.add_argument(
+        "--png_compress_level", type=int, default=6, help="zlib level (0-9) of png outputs. Needs --no_png_optimize"
+    )
+    parser.add_argument(
+        "--no_png_optimize", action="store_true", help="Skip the (slow) search for the smallest png encoding"
+    )
+    parser.add_argument("--jpeg_quality", type=int, default=90, help="Quality (1-95) of jpeg outputs")
+    parser.add_argument(
+        "--jpeg_subsampling",
+        type=str,
+        choices=VALID_JPEG_SUBSAMPLING,
+        default="4:2:0",
+        help="Chroma subsampling of jpeg outputs",
+    )
+    parser.add_argument(
+        "--jpeg_lossless_regions",
+        action="store_true",
+        help="For jpeg inputs and outputs, re-encode only the blocks under the watermark (uses jpegtran if installed)",
+    )
+    parser.add_argument("--webp_lossless", action="store_true", help="Write lossless webp outputs")
+    parser.add_argument("--webp_quality", type=int, default=80, help="Quality (0-100) of webp outputs")
+    parser.add_argument(
+        "--webp_method", type=int, default=4, help="webp encoder effort, from 0 (fast) to 6 (small files)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to watermark images in parallel. 0 uses every available core.",
+    )
+    parser.add_argument(
+        "--large_image_pixels",
+        type=int,
+        default=100_000_000,
+        help="Images with more pixels are watermarked tile by tile to save memory. 0 disables tiling",
+    )
+    parser.add_argument(
+        "--large_image_tile_size", type=int, default=1024, help="Tile width and height used for large images"
+    )
+    parser.add_argument(
+        "--max_image_memory_mb",
+        type=float,
+        default=4096,
+        help="Skip images estimated to need more memory than this, instead of running out of memory. 0 disables",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep a manifest in the output folder and skip inputs whose output is already up to date",
+    )
+    parser.add_argument(
+        "--hash_inputs",
+        action="store_true",
+        help="With --resume, also compare input content hashes so touched but unchanged files are skipped",
+    )
+    parser.add_argument(
+        "--deduplicate",
+        action="store_true",
+        help="Watermark inputs with identical contents once and link the outputs of the copies, across batches too",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Overlap decoding, compositing and encoding on separate threads. Used when --workers is 1",
+    )
+    parser.add_argument(
+        "--pipeline_queue_depth",
+        type=int,
+        default=4,
+        help="Number of images each pipeline stage may queue for the next one. Bounds memory use",
+    )
+    parser.add_argument(
+        "--continue_on_error",
+        action="store_true",
+        help="Keep going past files that fail to watermark, and exit with an error at the end if any did",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Write the status, error, duration, output and size of every file to this file (.csv or .json)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Write a JSON report of per file and per stage timings (with p50/p95/p99) to this file",
+    )
+    parser.add_argument(
+        "--profile_cprofile", type=str, default=None, help="With --profile, also dump cProfile statistics here"
+    )
+    parser.add_argument(
+        "--profile_memory", action="store_true", help="With --profile, also report the largest Python allocations"
+    )
+    parser.add_argument(
+        "--watermark_cache_mb",
+        type=float,
+        default=256,
+        help="Memory cap (in MB) of the cache of prepared watermark layers. 0 disables the cache.",
+    )
+    return parser
+
+
+def parse_arguments():
+    return create_argument_parser().parse_args()
+
+
+def watermark_stream(
+    watermark_config, input_images, output_folder, recursive=False, discovery_threads=16, output_stream=None
+):
+    """
+    Watermark a single image read from stdin (input_images "-") or written to stdout (output_folder "-").
+
+    Nothing but the image is written to output_stream (stdout by default), and no temporary files are used
+    other than those of jpeg_lossless_regions, see watermark.encode_jpeg_regions. Only the full size image is
+    written, so output_variants are refused.
+
+    Returns:
+        list: Error messages.
+    """
+    if len(watermark_config.output_variants) > 0:
+        return ["Output variants can not be written when reading from stdin or writing to stdout"]
+    if input_images == "-":
+        source = sys.stdin.buffer
+        output_name = "stdin"
+    else:
+        files = list(itertools.islice(discover_images(input_images, recursive, discovery_threads), 2))
+        if len(files) != 1:
+            return ["Writing to stdout needs exactly one input image, %s matched %d" % (input_images, len(files))]
+        source = open(files[0], "rb")
+        output_name = get_output_name(files[0])
+
+    with source:
+        watermark_image, text_image, text, errors = preload_watermark_and_text_images(watermark_config)
+        if len(errors) > 0:
+            return errors
+        output_data, output_format, errors = watermark_in_memory(
+            watermark_config, source, watermark_image, text_image, text
+        )
+    if len(errors) > 0:
+        return errors
+
+    if output_folder == "-":
+        output_stream = output_stream or sys.stdout.buffer
+        output_stream.write(output_data)
+        output_stream.flush()
+        return []
+    errors = create_folder(output_folder)
+    if len(errors) > 0:
+        return errors
+    output_filename = os.path.join(output_folder, "%s_watermarked%s" % (output_name, OUTPUT_EXTENSIONS[output_format]))
+    if os.path.exists(output_filename) and os.stat(output_filename).st_nlink > 1:
+        # Hardlinked to the output of a duplicate input (see watermark_dedup), which must not change with it.
+        os.remove(output_filename)
+    with open(output_filename, "wb") as output_file:
+        output_file.write(output_data)
+    return []
 
 
 def main():
     arguments = parse_arguments()
 
+    if arguments.input_images == "-" or arguments.output_folder == "-":
+        # stdout carries the image, so everything we print goes to stderr.
+        output_stream = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr):
+            config = config_from_arguments(arguments)
+            errors = config.watermark_config.check_valid(check_paths=False)
+            if len(errors) == 0:
+                errors = watermark_stream(
+                    config.watermark_config,
+                    arguments.input_images,
+                    arguments.output_folder,
+                    arguments.recursive,
+                    arguments.discovery_threads,
+                    output_stream,
+                )
+            if len(errors) > 0:
+                print("\n".join(errors))
+                sys.exit(1)
+        return
+
     # Load config
     config = config_from_arguments(arguments)
 
     # Load the files to watermark
-    config.watermark_config.files_to_watermark = find_files(config.input_file_regex)
+    config.watermark_config.files_to_watermark = find_files(
+        config.input_file_regex, arguments.recursive, arguments.discovery_threads
+    )
 
     # Create output folder
     error_messages = create_folder(config.watermark_config.output_folder)
@@ -142,8 +394,16 @@ def main():
     assert len(error_messages) == 0, f"Config had errors {error_messages}"
     result, errors = apply_watermark(config.watermark_config)
     if len(errors) > 0:
+        if config.watermark_config.continue_on_error:
+            print("\n".join(errors))
+            sys.exit(1)
         raise RuntimeError(f"Errors: {errors}")
 
 
 if __name__ == "__main__":
+    if getattr(sys, "frozen", False):
+        # Needed for the worker processes of frozen (pyinstaller) builds. Not imported otherwise to start faster.
+        import multiprocessing
+
+        multiprocessing.freeze_support()
     main()
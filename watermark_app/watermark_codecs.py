@@ -0,0 +1,117 @@
+import struct
+import threading
+
+from PIL import Image
+
+from watermark_heic import get_heif_opener_options
+
+# Number of leading bytes needed to recognise the formats below.
+HEADER_SIZE = 32
+
+# Sizes of the DIB header following the 14 byte file header of BMP images, one per version of the format.
+BMP_INFO_HEADER_SIZES = [12, 16, 40, 52, 56, 64, 108, 124]
+
+# ISO base media file format brands of HEIF (HEIC and AVIF) images.
+HEIF_BRANDS = [b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"hevm", b"hevs", b"mif1", b"msf1", b"avif"]
+
+_heif_lock = threading.Lock()
+_heif_registered = False
+
+
+def read_header(file_path: str):
+    # Returns the first HEADER_SIZE bytes of file_path, or b"" if it can't be read.
+    try:
+        with open(file_path, "rb") as image_file:
+            return image_file.read(HEADER_SIZE)
+    except OSError:
+        return b""
+
+
+def is_heif_header(header: bytes):
+    return len(header) >= 12 and header[4:8] == b"ftyp" and header[8:12] in HEIF_BRANDS
+
+
+def sniff_image_format(header: bytes):
+    """
+    Recognise an image format from the first bytes of a file, without decoding it.
+
+    Returns:
+        str: The Pillow format name, or None if header isn't one of these formats. Other formats Pillow reads have
+            no magic bytes to check, see identify_image_format.
+    """
+    if header.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if header.startswith(b"GIF87a") or header.startswith(b"GIF89a"):
+        return "GIF"
+    if (
+        header.startswith(b"BM")
+        and len(header) >= 18
+        and struct.unpack_from("<I", header, 14)[0] in BMP_INFO_HEADER_SIZES
+    ):
+        return "BMP"
+    if header.startswith(b"II*\x00") or header.startswith(b"MM\x00*"):
+        return "TIFF"
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return "WEBP"
+    if is_heif_header(header):
+        return "HEIF"
+    return None
+
+
+def identify_image_format(file_path: str):
+    """
+    Recognise the format of an image file without decoding it.
+
+    The common formats are recognised from their first bytes, see sniff_image_format. Other files are opened with
+    Pillow, which only reads the header, so the formats it supports without magic bytes (TGA, ICO, PPM, JPEG 2000...)
+    are still found.
+
+    Returns:
+        str: The Pillow format name, or None if the file isn't an image Pillow can open.
+    """
+    header = read_header(file_path)
+    image_format = sniff_image_format(header)
+    if image_format is not None or len(header) == 0:
+        return image_format
+    try:
+        with Image.open(file_path) as image:
+            return image.format
+    except Exception:
+        # Unidentified, or refused by the plugin that claimed the header.
+        return None
+
+
+def register_heif_opener():
+    """
+    Register the pillow_heif plugin with Pillow, the first time it is needed.
+
+    pillow_heif is heavy to import, so it is only loaded once a HEIF file is actually seen. It is set up as configured
+    with watermark_heic.configure_heif_decoder.
+
+    Returns:
+        list: Error messages, if pillow_heif is not available.
+    """
+    global _heif_registered
+    with _heif_lock:
+        if _heif_registered:
+            return []
+        try:
+            from pillow_heif import register_heif_opener as register_pillow_heif_opener
+        except ImportError:
+            return ["pillow_heif is needed to read HEIF images"]
+        register_pillow_heif_opener(**get_heif_opener_options())
+        _heif_registered = True
+    return []
+
+
+def prepare_codecs_for_header(header: bytes):
+    # Registers any codec Pillow doesn't ship with that the image starting with header needs.
+    if is_heif_header(header):
+        return register_heif_opener()
+    return []
+
+
+def prepare_codecs_for_file(file_path: str):
+    return prepare_codecs_for_header(read_header(file_path))
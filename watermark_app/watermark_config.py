@@ -1,7 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from PyQt5.QtCore import QObject
+import os
+
+# "quality" fully decodes images before resizing them, "speed" decodes at a reduced scale where the format allows.
+VALID_RESIZE_MODES = ["quality", "speed"]
+# "source" keeps the format of each input image where it can be encoded, and falls back to png otherwise.
+VALID_OUTPUT_FORMATS = ["png", "source", "jpeg", "webp"]
+VALID_JPEG_SUBSAMPLING = ["4:4:4", "4:2:2", "4:2:0"]
+# Watermark locations are a vertical and a horizontal anchor joined by "-", such as "top-left".
+VALID_VERTICAL = ["bottom", "top", "center", "random"]
+VALID_HORIZONTAL = ["right", "left", "center", "random"]
 
 
 class WatermarkConfig:
@@ -9,11 +18,12 @@ class WatermarkConfig:
         """
         Initializes the configuration for the watermark application.
         Attributes:
-            files_to_watermark (list): List of files to be watermarked.
+            files_to_watermark (list): List (or iterable) of files to be watermarked.
             output_folder (str): Directory where watermarked files will be saved.
             watermark_file (str): Path to the watermark image file.
             watermark_text (str): Text to be used as a watermark.
             watermark_text_color (tuple): RGBA color tuple for the watermark text.
+            watermark_font_path (str): TrueType font of the watermark text. None uses a bold system font.
             watermark_locations (list): List of locations where the watermark will be applied.
             minimal_watermark_width_percentage (float): Minimum width % of the watermark relative to the image.
             minimal_watermark_height_percentage (float): Minimum height % of the watermark relative to the image.
@@ -21,12 +31,52 @@ class WatermarkConfig:
             do_image_scaling (bool): Flag to determine if image scaling should be performed.
             alpha_scale (float): Alpha transparency scale for the watermark.
             show_generated_images (bool): Flag to determine if generated images should be displayed.
+            workers (int): Number of worker processes used to watermark files. 0 uses one per available core.
+            watermark_cache_max_mb (float): Memory cap of the prepared watermark layer cache. 0 disables it.
+            region_compositing (bool): Blend only the regions covered by the watermark instead of the whole frame.
+            large_image_pixel_threshold (int): Images with more pixels are composited tile by tile in their own
+                mode, without full-size RGBA copies. 0 disables tiling.
+            large_image_tile_size (int): Width and height of the tiles of large images.
+            max_image_memory_mb (float): Images whose estimated pixel memory exceeds this fail before being
+                decoded. 0 disables the check.
+            resize_mode (str): One of VALID_RESIZE_MODES. Trades resize quality against decode speed.
+            output_variants (list): Longest side, in pixels, of smaller copies written next to each output, e.g.
+                [2048, 1024, 256] for name_watermarked_2048.png and so on. Built from the same decode.
+            heif_decode_threads (int): Threads decoding each HEIF image. 0 shares the cores between the workers.
+            heif_thumbnails (bool): Decode the thumbnail embedded in HEIF images instead of the full image, when it
+                is at least as large as the resized image.
+            pipeline_mode (bool): With a single worker, decode, composite and encode on separate threads.
+            pipeline_queue_depth (int): Number of images each pipeline stage may queue for the next one.
+            output_format (str): One of VALID_OUTPUT_FORMATS.
+            png_compress_level (int): zlib compression level (0-9) of png outputs.
+            png_optimize (bool): Search for the smallest png encoding. Slow, and overrides png_compress_level.
+            jpeg_quality (int): Quality (1-95) of jpeg outputs.
+            jpeg_subsampling (str): Chroma subsampling of jpeg outputs, one of VALID_JPEG_SUBSAMPLING.
+            jpeg_lossless_regions (bool): Write jpeg outputs of unresized jpeg inputs by re-encoding only the blocks
+                the watermark covers, keeping the coded data of the others (needs jpegtran with -drop). Without
+                jpegtran, or when the block layout can't be matched, the whole image is re-encoded with the
+                quantization tables and subsampling of the input instead of jpeg_quality and jpeg_subsampling.
+            webp_lossless (bool): Write lossless instead of lossy webp outputs.
+            webp_quality (int): Quality (0-100) of webp outputs. For lossless outputs, the compression effort.
+            webp_method (int): Speed (0, fast) against size (6, small) trade off of webp outputs.
+            resume (bool): Keep a manifest in the output folder and skip inputs whose output is already current.
+            manifest_hash_contents (bool): Also compare content hashes of inputs, not only their size and mtime.
+            deduplicate (bool): Watermark inputs with the same contents once, and hardlink (else reflink, else copy)
+                the outputs for the others. An index in the output folder carries this over to later batches.
+            continue_on_error (bool): Keep watermarking the other files when one fails, instead of stopping.
+            result_report_file (str): Where to write the status, error, duration, output and size of every file, as
+                CSV if it ends with .csv and JSON otherwise. None to skip the report.
+            profile_report_file (str): Where to write a JSON report of per file and per stage timings, or None.
+            profile_cprofile_file (str): With a profile report, where to also dump cProfile statistics, or None.
+            profile_memory (bool): With a profile report, also capture the largest allocations with tracemalloc.
+                Needs a single worker, tracemalloc does not see worker processes.
         """
         self.files_to_watermark = []
         self.output_folder = None
         self.watermark_file = None
         self.watermark_text = None
         self.watermark_text_color = (220, 220, 34, 255)
+        self.watermark_font_path = None
         self.watermark_locations = []
         self.minimal_watermark_width_percentage = 0.1
         self.minimal_watermark_height_percentage = 0.1
@@ -34,29 +84,99 @@ class WatermarkConfig:
         self.do_image_scaling = True
         self.alpha_scale = 1.0
         self.show_generated_images = False
+        self.workers = 1
+        self.watermark_cache_max_mb = 256
+        self.region_compositing = True
+        self.large_image_pixel_threshold = 100_000_000
+        self.large_image_tile_size = 1024
+        self.max_image_memory_mb = 4096
+        self.resize_mode = "quality"
+        self.output_variants = []
+        self.heif_decode_threads = 0
+        self.heif_thumbnails = True
+        self.pipeline_mode = False
+        self.pipeline_queue_depth = 4
+        self.output_format = "png"
+        self.png_compress_level = 6
+        self.png_optimize = True
+        self.jpeg_quality = 90
+        self.jpeg_subsampling = "4:2:0"
+        self.jpeg_lossless_regions = False
+        self.webp_lossless = False
+        self.webp_quality = 80
+        self.webp_method = 4
+        self.resume = False
+        self.manifest_hash_contents = False
+        self.deduplicate = False
+        self.continue_on_error = False
+        self.result_report_file = None
+        self.profile_report_file = None
+        self.profile_cprofile_file = None
+        self.profile_memory = False
 
     def reset(self):
         self.files_to_watermark = []
         self.output_folder = None
         self.watermark_file = None
         self.watermark_text = None
+        self.watermark_font_path = None
         self.watermark_locations = []
         self.minimal_watermark_width_percentage = 0.1
         self.minimal_watermark_height_percentage = 0.1
         self.do_image_scaling = True
         self.alpha_scale = 1.0
         self.show_generated_images = False
+        self.workers = 1
+        self.watermark_cache_max_mb = 256
+        self.region_compositing = True
+        self.large_image_pixel_threshold = 100_000_000
+        self.large_image_tile_size = 1024
+        self.max_image_memory_mb = 4096
+        self.resize_mode = "quality"
+        self.output_variants = []
+        self.heif_decode_threads = 0
+        self.heif_thumbnails = True
+        self.pipeline_mode = False
+        self.pipeline_queue_depth = 4
+        self.output_format = "png"
+        self.png_compress_level = 6
+        self.png_optimize = True
+        self.jpeg_quality = 90
+        self.jpeg_subsampling = "4:2:0"
+        self.jpeg_lossless_regions = False
+        self.webp_lossless = False
+        self.webp_quality = 80
+        self.webp_method = 4
+        self.resume = False
+        self.manifest_hash_contents = False
+        self.deduplicate = False
+        self.continue_on_error = False
+        self.result_report_file = None
+        self.profile_report_file = None
+        self.profile_cprofile_file = None
+        self.profile_memory = False
 
-    def check_valid(self):
+    def check_valid(self, check_paths=True):
+        # check_paths=False skips the input files and output folder, for services that get images as they come.
         error_messages = []
-        if not len(self.files_to_watermark) > 0:
+        # files_to_watermark may also be a lazy iterable, see watermark_discovery.
+        if check_paths and not self.files_to_watermark:
             error_messages.append("You must choose files to watermark")
-        if not self.output_folder:
+        if check_paths and not self.output_folder:
             error_messages.append("You must choose an output folder")
         if self.watermark_file is None and self.watermark_text is None:
             error_messages.append("You must choose a watermark file or set text to apply")
+        if self.watermark_font_path is not None and not os.path.isfile(self.watermark_font_path):
+            error_messages.append("Font file %s does not exist" % self.watermark_font_path)
         if not len(self.watermark_locations) > 0:
             error_messages.append("You must choose at least one location to watermark")
+        for location in self.watermark_locations:
+            anchors = location.split("-") if isinstance(location, str) else []
+            if len(anchors) != 2 or anchors[0] not in VALID_VERTICAL or anchors[1] not in VALID_HORIZONTAL:
+                error_messages.append(
+                    "location %s must be one of %s and one of %s joined by -"
+                    % (location, ", ".join(VALID_VERTICAL), ", ".join(VALID_HORIZONTAL))
+                )
         if self.do_image_scaling:
             if self.minimal_watermark_width_percentage is not None and not (
                 self.minimal_watermark_width_percentage > 0 and self.minimal_watermark_width_percentage < 100
@@ -66,8 +186,70 @@ class WatermarkConfig:
                 self.minimal_watermark_height_percentage > 0 and self.minimal_watermark_height_percentage < 100
             ):
                 error_messages.append("height percentage must be between 1 and 100 or None")
+        if self.workers is not None and not (isinstance(self.workers, int) and self.workers >= 0):
+            error_messages.append("workers must be 0 (all cores) or a positive number")
+        if self.watermark_cache_max_mb < 0:
+            error_messages.append("watermark cache size can not be negative")
+        if self.large_image_pixel_threshold < 0:
+            error_messages.append("large image pixel threshold can not be negative")
+        if self.large_image_tile_size < 16:
+            error_messages.append("large image tile size must be at least 16")
+        if self.max_image_memory_mb < 0:
+            error_messages.append("image memory cap can not be negative")
+        if self.resize_mode not in VALID_RESIZE_MODES:
+            error_messages.append("resize mode must be one of %s" % ", ".join(VALID_RESIZE_MODES))
+        if self.heif_decode_threads < 0:
+            error_messages.append("heif decode threads can not be negative")
+        if any(not isinstance(variant, int) or variant < 1 for variant in self.output_variants):
+            error_messages.append("output variants must be positive sizes in pixels")
+        if self.pipeline_queue_depth < 1:
+            error_messages.append("pipeline queue depth must be at least 1")
+        if self.output_format not in VALID_OUTPUT_FORMATS:
+            error_messages.append("output format must be one of %s" % ", ".join(VALID_OUTPUT_FORMATS))
+        if not (0 <= self.png_compress_level <= 9):
+            error_messages.append("png compress level must be between 0 and 9")
+        if not (1 <= self.jpeg_quality <= 95):
+            error_messages.append("jpeg quality must be between 1 and 95")
+        if self.jpeg_subsampling not in VALID_JPEG_SUBSAMPLING:
+            error_messages.append("jpeg subsampling must be one of %s" % ", ".join(VALID_JPEG_SUBSAMPLING))
+        if not (0 <= self.webp_quality <= 100):
+            error_messages.append("webp quality must be between 0 and 100")
+        if not (0 <= self.webp_method <= 6):
+            error_messages.append("webp method must be between 0 and 6")
+        if self.profile_report_file is not None and self.profile_memory and self.workers != 1:
+            error_messages.append("memory profiling only covers this process, it needs a single worker")
         return error_messages
 
+    def get_output_settings(self):
+        # Settings that change the pixels or encoding of the outputs. Two runs with equal settings produce
+        # equivalent outputs for the same input.
+        return {
+            "watermark_file": self.watermark_file,
+            "watermark_text": self.watermark_text,
+            "watermark_text_color": list(self.watermark_text_color),
+            "watermark_font_path": self.watermark_font_path,
+            "watermark_locations": list(self.watermark_locations),
+            "minimal_watermark_width_percentage": self.minimal_watermark_width_percentage,
+            "minimal_watermark_height_percentage": self.minimal_watermark_height_percentage,
+            "watermark_text_to_image_ratio": self.watermark_text_to_image_ratio,
+            "do_image_scaling": self.do_image_scaling,
+            "alpha_scale": self.alpha_scale,
+            "resize_mode": self.resize_mode,
+            "output_variants": sorted(self.output_variants, reverse=True),
+            "heif_thumbnails": self.heif_thumbnails,
+            # Tiled images keep their own mode instead of becoming RGBA.
+            "large_image_pixel_threshold": self.large_image_pixel_threshold,
+            "output_format": self.output_format,
+            "png_compress_level": self.png_compress_level,
+            "png_optimize": self.png_optimize,
+            "jpeg_quality": self.jpeg_quality,
+            "jpeg_subsampling": self.jpeg_subsampling,
+            "jpeg_lossless_regions": self.jpeg_lossless_regions,
+            "webp_lossless": self.webp_lossless,
+            "webp_quality": self.webp_quality,
+            "webp_method": self.webp_method,
+        }
+
     def __str__(self):
         return (
             "WaterMarkConfig:\n"
@@ -76,49 +258,40 @@ class WatermarkConfig:
             f"-watermark_file: {self.watermark_file}\n"
             f"-watermark_text: {self.watermark_text}\n"
             f"-watermark_text_color: {self.watermark_text_color}\n"
+            f"-watermark_font_path: {self.watermark_font_path}\n"
             f"-watermark_locations: {self.watermark_locations}\n"
             f"-width_percentage: {self.minimal_watermark_width_percentage}\n"
             f"-height_percentage: {self.minimal_watermark_height_percentage}\n"
             f"-do_image_scaling: {self.do_image_scaling}\n"
             f"-alpha_scale: {self.alpha_scale}\n"
-            f"-show_generated_images: {self.show_generated_images}"
+            f"-show_generated_images: {self.show_generated_images}\n"
+            f"-workers: {self.workers}\n"
+            f"-watermark_cache_max_mb: {self.watermark_cache_max_mb}\n"
+            f"-region_compositing: {self.region_compositing}\n"
+            f"-large_image_pixel_threshold: {self.large_image_pixel_threshold}\n"
+            f"-large_image_tile_size: {self.large_image_tile_size}\n"
+            f"-max_image_memory_mb: {self.max_image_memory_mb}\n"
+            f"-resize_mode: {self.resize_mode}\n"
+            f"-output_variants: {self.output_variants}\n"
+            f"-heif_decode_threads: {self.heif_decode_threads}\n"
+            f"-heif_thumbnails: {self.heif_thumbnails}\n"
+            f"-pipeline_mode: {self.pipeline_mode}\n"
+            f"-pipeline_queue_depth: {self.pipeline_queue_depth}\n"
+            f"-output_format: {self.output_format}\n"
+            f"-png_compress_level: {self.png_compress_level}\n"
+            f"-png_optimize: {self.png_optimize}\n"
+            f"-jpeg_quality: {self.jpeg_quality}\n"
+            f"-jpeg_subsampling: {self.jpeg_subsampling}\n"
+            f"-jpeg_lossless_regions: {self.jpeg_lossless_regions}\n"
+            f"-webp_lossless: {self.webp_lossless}\n"
+            f"-webp_quality: {self.webp_quality}\n"
+            f"-webp_method: {self.webp_method}\n"
+            f"-resume: {self.resume}\n"
+            f"-manifest_hash_contents: {self.manifest_hash_contents}\n"
+            f"-deduplicate: {self.deduplicate}\n"
+            f"-continue_on_error: {self.continue_on_error}\n"
+            f"-result_report_file: {self.result_report_file}\n"
+            f"-profile_report_file: {self.profile_report_file}\n"
+            f"-profile_cprofile_file: {self.profile_cprofile_file}\n"
+            f"-profile_memory: {self.profile_memory}"
         )
-
-
-class WatermarkConfigQt(QObject):
-    def __init__(self):
-        super().__init__()
-        self.watermark_config = WatermarkConfig()
-
-    def width_changed(self, value):
-        try:
-            self.watermark_config.minimal_watermark_width_percentage = float(value) / 100.0
-            print(f"width changed {self.watermark_config.minimal_watermark_width_percentage}")
-        except ValueError:
-            pass
-
-    def height_changed(self, value):
-        try:
-            self.watermark_config.minimal_watermark_height_percentage = float(value) / 100.0
-            print(f"height changed {self.watermark_config.minimal_watermark_height_percentage}")
-        except ValueError:
-            pass
-
-    def watermark_location_changed(self, button, checked):
-        value = button.text()
-        if not checked and value in self.watermark_config.watermark_locations:
-            self.watermark_config.watermark_locations.remove(value)
-        elif checked and value not in self.watermark_config.watermark_locations:
-            self.watermark_config.watermark_locations.append(value)
-        print("VALUE!", value, "state", checked)
-
-    def text_changed(self, value):
-        print(f"text changed {value}")
-        if len(value) == 0:
-            self.watermark_config.watermark_text = None
-        else:
-            self.watermark_config.watermark_text = value
-
-    def do_image_scale_changed(self, checked):
-        self.watermark_config.do_image_scaling = checked == 2
-        print(f"Scaling changed {self.watermark_config.do_image_scaling}")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Kept apart from watermark_config so the command line tools don't have to import Qt.
+from PyQt5.QtCore import QObject
+
+from watermark_config import WatermarkConfig
+
+
+class WatermarkConfigQt(QObject):
+    def __init__(self):
+        super().__init__()
+        self.watermark_config = WatermarkConfig()
+
+    def width_changed(self, value):
+        try:
+            self.watermark_config.minimal_watermark_width_percentage = float(value) / 100.0
+            print(f"width changed {self.watermark_config.minimal_watermark_width_percentage}")
+        except ValueError:
+            pass
+
+    def height_changed(self, value):
+        try:
+            self.watermark_config.minimal_watermark_height_percentage = float(value) / 100.0
+            print(f"height changed {self.watermark_config.minimal_watermark_height_percentage}")
+        except ValueError:
+            pass
+
+    def watermark_location_changed(self, button, checked):
+        value = button.text()
+        if not checked and value in self.watermark_config.watermark_locations:
+            self.watermark_config.watermark_locations.remove(value)
+        elif checked and value not in self.watermark_config.watermark_locations:
+            self.watermark_config.watermark_locations.append(value)
+        print("VALUE!", value, "state", checked)
+
+    def text_changed(self, value):
+        print(f"text changed {value}")
+        if len(value) == 0:
+            self.watermark_config.watermark_text = None
+        else:
+            self.watermark_config.watermark_text = value
+
+    def do_image_scale_changed(self, checked):
+        self.watermark_config.do_image_scaling = checked == 2
+        print(f"Scaling changed {self.watermark_config.do_image_scaling}")
+
+    def output_format_changed(self, value):
+        self.watermark_config.output_format = value
+        print(f"Output format changed {self.watermark_config.output_format}")
+
+    def output_quality_changed(self, value):
+        # The quality setting is shared by the lossy jpeg and webp encoders.
+        self.watermark_config.jpeg_quality = min(max(value, 1), 95)
+        self.watermark_config.webp_quality = value
+        print(f"Output quality changed {value}")
+
+    def png_compress_level_changed(self, value):
+        # An explicit level only applies when optimize is off, optimize always uses the maximum level.
+        self.watermark_config.png_compress_level = value
+        self.watermark_config.png_optimize = False
+        print(f"PNG compress level changed {self.watermark_config.png_compress_level}")
+
+    def webp_lossless_changed(self, checked):
+        self.watermark_config.webp_lossless = checked == 2
+        print(f"WebP lossless changed {self.watermark_config.webp_lossless}")
+
+    def workers_changed(self, value):
+        # 0 uses every core, see watermark.get_worker_count.
+        self.watermark_config.workers = value
+        print(f"Workers changed {self.watermark_config.workers}")
@@ -0,0 +1,222 @@
+import json
+import os
+import shutil
+import sys
+import time
+from types import SimpleNamespace
+
+from watermark_config import WatermarkConfig
+from watermark_manifest import get_config_hash, hash_file
+
+DEDUP_INDEX_FILENAME = ".watermark_dedup.jsonl"
+
+# ioctl(2) cloning a whole file on Linux filesystems with copy on write (btrfs, XFS), from <linux/fs.h>.
+_FICLONE = 0x40049409
+
+
+def get_output_files(output_file: str, output_variants: list):
+    # The full size output and its variants, see watermark.save_watermarked_image.
+    base, extension = os.path.splitext(output_file)
+    return [output_file] + ["%s_%d%s" % (base, variant, extension) for variant in sorted(set(output_variants))]
+
+
+def reflink_file(source_path: str, destination_path: str):
+    # Copy on write clone of source_path. Raises OSError where the platform or filesystem can't.
+    if not sys.platform.startswith("linux"):
+        raise OSError("reflinks are only attempted on Linux")
+    # Imported here, fcntl does not exist on Windows.
+    import fcntl
+
+    with open(source_path, "rb") as source_file, open(destination_path, "wb") as destination_file:
+        fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+
+
+def link_output(source_path: str, destination_path: str):
+    """
+    Make destination_path a copy of source_path as cheaply as possible: a hardlink, else a reflink, else a copy.
+
+    An existing destination_path is replaced.
+    Returns:
+        str: How the copy was made, "hardlink", "reflink" or "copy".
+    """
+    temporary_path = destination_path + ".tmp"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    try:
+        os.link(source_path, temporary_path)
+        method = "hardlink"
+    except OSError:
+        try:
+            reflink_file(source_path, temporary_path)
+            method = "reflink"
+        except OSError:
+            shutil.copyfile(source_path, temporary_path)
+            method = "copy"
+    os.replace(temporary_path, destination_path)
+    return method
+
+
+class WatermarkDedup:
+    def __init__(self, watermark_config: WatermarkConfig):
+        """
+        Watermarks each distinct input content once per settings, and links the outputs of its copies.
+
+        Inputs are identified by a streamed hash of their bytes. The first file with some content is watermarked,
+        later ones get a hardlink (or reflink, or copy) of its outputs, named after them. The outputs of every
+        batch are kept in an append-only index in the output folder, so content seen by an earlier batch with the
+        same settings isn't watermarked again either. Like the manifest, entries are only trusted while their
+        output is still there with the same size.
+
+        Attributes:
+            path (str): Location of the index file.
+            config_hash (str): Hash of the settings of the current run, see watermark_manifest.get_config_hash.
+            entries (dict): Latest entry per (content hash, config hash).
+            duplicates (int): Number of inputs whose outputs were linked rather than watermarked.
+        """
+        self.watermark_config = watermark_config
+        self.path = os.path.join(watermark_config.output_folder, DEDUP_INDEX_FILENAME)
+        self.config_hash = get_config_hash(watermark_config)
+        self.entries = {}
+        self.duplicates = 0
+        self._index_file = None
+        # Content hash of the inputs being watermarked, and the copies waiting for their outputs.
+        self._hashes = {}
+        self._waiting = {}
+        # Results of copies linked to known outputs, not reported yet.
+        self._ready = []
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as index_file:
+            for line in index_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run.
+                    continue
+                self.entries[(entry["content_hash"], entry["config_hash"])] = entry
+
+    def get_output_file(self, content_hash: str):
+        # The full size output of content_hash made with the current settings, None if there is no current one.
+        entry = self.entries.get((content_hash, self.config_hash))
+        if entry is None:
+            return None
+        try:
+            if os.path.getsize(entry["output_file"]) != entry["output_size"]:
+                return None
+        except OSError:
+            return None
+        if not all(
+            os.path.exists(path)
+            for path in get_output_files(entry["output_file"], self.watermark_config.output_variants)
+        ):
+            return None
+        return entry["output_file"]
+
+    def filter_files(self, files):
+        # Yields the files to watermark, lazily so that streamed inputs stay streamed. The others are reported by
+        # resolve, once the outputs they copy are there.
+        for input_file in files:
+            try:
+                content_hash = hash_file(input_file)
+            except OSError:
+                # Watermarking reports the error.
+                yield input_file
+                continue
+            output_file = self.get_output_file(content_hash)
+            if output_file is not None:
+                self._ready.append(self.link_duplicate(input_file, output_file))
+            elif content_hash in self._waiting:
+                self._waiting[content_hash].append(input_file)
+            else:
+                self._hashes[input_file] = content_hash
+                self._waiting[content_hash] = []
+                yield input_file
+
+    def link_duplicate(self, input_file: str, output_file: str, errors: list = None):
+        """
+        Give input_file the outputs of an identical input.
+
+        Returns:
+            SimpleNamespace: The result of input_file, like watermark.watermark_file's.
+        """
+        start = time.perf_counter()
+        result = SimpleNamespace(input_file=input_file, output_file=None, errors=[], duration=None, stages={})
+        if errors is not None:
+            result.errors = ["Duplicate of a file that failed: %s" % error for error in errors]
+        else:
+            # Imported here, the watermark module imports this one.
+            from watermark import get_output_name
+
+            extension = os.path.splitext(output_file)[1]
+            destination = os.path.join(
+                self.watermark_config.output_folder, "%s_watermarked%s" % (get_output_name(input_file), extension)
+            )
+            variants = self.watermark_config.output_variants
+            try:
+                # Not when the output is its own, from an earlier batch.
+                if os.path.abspath(destination) != os.path.abspath(output_file):
+                    for source_path, destination_path in zip(
+                        get_output_files(output_file, variants), get_output_files(destination, variants)
+                    ):
+                        link_output(source_path, destination_path)
+                    self.duplicates += 1
+                    print("duplicate of %s: %s" % (output_file, input_file))
+                result.output_file = destination
+            except OSError as e:
+                result.errors = ["Unable to link the output of %s. Error was: %s" % (input_file, str(e))]
+        result.duration = time.perf_counter() - start
+        return result
+
+    def resolve(self, result):
+        """
+        Record the result of a watermarked file and link its outputs to the copies waiting for them.
+
+        Returns:
+            list: The results of those copies, and of copies of earlier outputs found since the last call.
+        """
+        content_hash = self._hashes.pop(result.input_file, None)
+        results, self._ready = self._ready, []
+        if content_hash is None:
+            return results
+        waiting = self._waiting.pop(content_hash, [])
+        if len(result.errors) > 0:
+            return results + [self.link_duplicate(input_file, None, result.errors) for input_file in waiting]
+        self.record(content_hash, result.output_file)
+        return results + [self.link_duplicate(input_file, result.output_file) for input_file in waiting]
+
+    def flush(self):
+        # Results of copies not reported yet, once every file was watermarked.
+        results, self._ready = self._ready, []
+        return results
+
+    def record(self, content_hash: str, output_file: str):
+        entry = {
+            "content_hash": content_hash,
+            "config_hash": self.config_hash,
+            "output_file": os.path.abspath(output_file),
+            "output_size": os.path.getsize(output_file),
+        }
+        self.entries[(content_hash, self.config_hash)] = entry
+        if self._index_file is None:
+            self._index_file = open(self.path, "a", encoding="utf-8")
+        self._index_file.write(json.dumps(entry) + "\n")
+        self._index_file.flush()
+
+    def compact(self):
+        # Rewrites the index with only the latest entry of each content and settings, dropping missing outputs.
+        self.close()
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as index_file:
+            for entry in self.entries.values():
+                if os.path.exists(entry["output_file"]):
+                    index_file.write(json.dumps(entry) + "\n")
+        os.replace(temporary_path, self.path)
+
+    def close(self):
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
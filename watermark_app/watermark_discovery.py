@@ -0,0 +1,69 @@
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from watermark import ordered_map
+from watermark_codecs import identify_image_format
+
+
+def walk_files(folder: str, recursive: bool = False):
+    # Yields the files of folder (and its sub folders when recursive) with os.scandir, which avoids a stat per entry.
+    try:
+        entries = os.scandir(folder)
+    except OSError:
+        return
+    with entries:
+        sub_folders = []
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    yield entry.path
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    sub_folders.append(entry.path)
+            except OSError:
+                continue
+    for sub_folder in sorted(sub_folders):
+        yield from walk_files(sub_folder, recursive)
+
+
+def find_candidate_files(file_search_path: str, recursive: bool = False):
+    # A folder is walked, anything else is a glob pattern ("**" matches sub folders when recursive).
+    if os.path.isdir(file_search_path):
+        yield from walk_files(file_search_path, recursive)
+        return
+    for filename in glob.iglob(file_search_path, recursive=recursive):
+        if os.path.isfile(filename):
+            yield filename
+
+
+def _check_image_header(file_path: str):
+    return file_path if identify_image_format(file_path) is not None else None
+
+
+def discover_images(file_search_path: str, recursive: bool = False, threads: int = 16):
+    """
+    Lazily find the images matching file_search_path.
+
+    Files are recognised from their header, see watermark_codecs.identify_image_format, without being verified or
+    decoded by Pillow. Headers are read by a pool of threads, which hides the latency of network mounted folders,
+    and images are yielded (in discovery order) as soon as they are checked, so processing can start before the
+    whole tree has been walked.
+    Args:
+        file_search_path (str): A folder or a glob pattern.
+        recursive (bool): Walk sub folders of a folder, or let "**" match sub folders in a pattern.
+        threads (int): Number of files checked concurrently.
+
+    Yields:
+        str: Paths of the images found.
+    """
+    candidates = find_candidate_files(file_search_path, recursive)
+    if threads <= 1:
+        for candidate in candidates:
+            if _check_image_header(candidate) is not None:
+                yield candidate
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for image_path in ordered_map(executor, _check_image_header, candidates, threads * 4):
+            if image_path is not None:
+                yield image_path
@@ -0,0 +1,62 @@
+import os
+from functools import lru_cache
+
+from PIL import ImageFont
+
+# Font size used when no target ratio is given.
+DEFAULT_FONT_SIZE = 36
+
+
+def get_default_font_path():
+    if os.name == "nt":
+        return r"c:\WINDOWS\Fonts\ARIALBD.TTF"
+    return "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+
+@lru_cache(maxsize=128)
+def get_font(font_path: str, font_size: int):
+    # Loading a FreeType face is costly, so faces are shared per (path, size).
+    return ImageFont.truetype(font_path, font_size)
+
+
+def measure_text(text: str, font_path: str, font_size: int):
+    # Size of the layer create_text_layer draws text on, at font_size.
+    return get_font(font_path, font_size).getbbox(text)[2:]
+
+
+def _fits(text: str, font_path: str, font_size: int, target_width: int, target_height: int):
+    text_width, text_height = measure_text(text, font_path, font_size)
+    return text_width <= target_width and text_height <= target_height
+
+
+@lru_cache(maxsize=1024)
+def fit_font_size(text: str, font_path: str, target_width: int, target_height: int):
+    """
+    Find the largest font size at which text fits in a target_width x target_height box.
+
+    Grows the size exponentially until the text no longer fits, then bisects, so only a handful of sizes are
+    measured. Results are cached, since every image of the same size asks for the same box.
+    Args:
+        text (str): The text to render.
+        font_path (str): Path of the TrueType font.
+        target_width (int): Maximal width of the rendered text.
+        target_height (int): Maximal height of the rendered text.
+
+    Returns:
+        int: The font size. At least 1, even if nothing fits.
+    """
+    low = 1
+    if not _fits(text, font_path, low, target_width, target_height):
+        return low
+    high = 2
+    while _fits(text, font_path, high, target_width, target_height):
+        low = high
+        high *= 2
+    # Invariant: low fits, high does not.
+    while high - low > 1:
+        middle = (low + high) // 2
+        if _fits(text, font_path, middle, target_width, target_height):
+            low = middle
+        else:
+            high = middle
+    return low
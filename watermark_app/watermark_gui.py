@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 
-from PyQt5 import QtWidgets
+from PyQt5 import QtCore, QtGui, QtWidgets
 
+from gui.watermark_file_list import FileListModel, ThumbnailCache, create_file_list_view, get_thumbnail_folder
+from gui.watermark_preview import PREVIEW_DEBOUNCE_MS, PREVIEW_SIZE, PreviewThread
 from gui.watermark_progress_dialog import ProgressDialog
 from gui.watermark_window_ui import Ui_MainWindow
-from watermark_config import WatermarkConfigQt
+from watermark_config import VALID_OUTPUT_FORMATS
+from watermark_config_qt import WatermarkConfigQt
 
 
 class ApplicationWindow(QtWidgets.QMainWindow):
@@ -20,6 +24,14 @@ class ApplicationWindow(QtWidgets.QMainWindow):
         self.watermark_config = WatermarkConfigQt()
         self.checkboxes = {}
 
+        # The files to watermark, in a view that only loads the rows it shows, with their thumbnails.
+        self.file_list_model = FileListModel(ThumbnailCache(get_thumbnail_folder()), parent=self)
+        file_list = create_file_list_view(self.ui.centralwidget, self.file_list_model)
+        file_list.setObjectName("toWatermarkList")
+        self.ui.horizontalLayout.replaceWidget(self.ui.toWatermarkList, file_list)
+        self.ui.toWatermarkList.deleteLater()
+        self.ui.toWatermarkList = file_list
+
         # Add Checkboxes for watermark pairings
         self.checkbox_button_group = QtWidgets.QButtonGroup(self.ui.centralwidget)
         self.checkbox_button_group.setExclusive(False)
@@ -48,6 +60,63 @@ class ApplicationWindow(QtWidgets.QMainWindow):
         self.ui.watermarkButton.clicked.connect(self.DoWatermarks)
         self.ui.doScaleCheckbox.stateChanged.connect(self.watermark_config.do_image_scale_changed)
 
+        # Add output encoder settings, above the watermark button.
+        self.output_format_layout = QtWidgets.QHBoxLayout()
+        self.output_format_combo = QtWidgets.QComboBox(self.ui.centralwidget)
+        self.output_format_combo.addItems(VALID_OUTPUT_FORMATS)
+        self.output_format_combo.setCurrentText(self.watermark_config.watermark_config.output_format)
+        self.output_format_layout.addWidget(self.output_format_combo)
+        self.output_format_layout.addWidget(QtWidgets.QLabel("Quality:", self.ui.centralwidget))
+        self.output_quality_spinbox = QtWidgets.QSpinBox(self.ui.centralwidget)
+        self.output_quality_spinbox.setRange(1, 100)
+        self.output_quality_spinbox.setValue(self.watermark_config.watermark_config.jpeg_quality)
+        self.output_format_layout.addWidget(self.output_quality_spinbox)
+        self.output_format_layout.addWidget(QtWidgets.QLabel("PNG level:", self.ui.centralwidget))
+        self.png_compress_level_spinbox = QtWidgets.QSpinBox(self.ui.centralwidget)
+        self.png_compress_level_spinbox.setRange(0, 9)
+        self.png_compress_level_spinbox.setValue(self.watermark_config.watermark_config.png_compress_level)
+        self.output_format_layout.addWidget(self.png_compress_level_spinbox)
+        self.webp_lossless_checkbox = QtWidgets.QCheckBox("Lossless WebP", self.ui.centralwidget)
+        self.output_format_layout.addWidget(self.webp_lossless_checkbox)
+        self.ui.formLayout.insertRow(6, "Output Format", self.output_format_layout)
+        self.output_format_combo.currentTextChanged.connect(self.watermark_config.output_format_changed)
+        self.output_quality_spinbox.valueChanged.connect(self.watermark_config.output_quality_changed)
+        self.png_compress_level_spinbox.valueChanged.connect(self.watermark_config.png_compress_level_changed)
+        self.webp_lossless_checkbox.stateChanged.connect(self.watermark_config.webp_lossless_changed)
+
+        # Worker processes watermarking the batch, 0 for every core.
+        self.workers_spinbox = QtWidgets.QSpinBox(self.ui.centralwidget)
+        self.workers_spinbox.setRange(0, os.cpu_count() or 1)
+        self.workers_spinbox.setSpecialValueText("All cores")
+        self.workers_spinbox.setValue(self.watermark_config.watermark_config.workers)
+        self.ui.formLayout.insertRow(7, "Workers", self.workers_spinbox)
+        self.workers_spinbox.valueChanged.connect(self.watermark_config.workers_changed)
+
+        # Live preview of the selected image, next to the settings.
+        self.preview_label = QtWidgets.QLabel("Select an image to preview", self.ui.centralwidget)
+        self.preview_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.preview_label.setMinimumSize(PREVIEW_SIZE[0] // 2, PREVIEW_SIZE[1] // 2)
+        self.ui.gridLayout.addWidget(self.preview_label, 0, 1, 1, 1)
+        self.preview_thread = PreviewThread()
+        self.preview_thread.preview_signal.connect(self.ShowPreview)
+        self.preview_thread.error_signal.connect(self.ShowPreviewErrors)
+        self.preview_thread.start()
+        # Edits restart the timer, so typing only renders once it pauses.
+        self.preview_timer = QtCore.QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DEBOUNCE_MS)
+        self.preview_timer.timeout.connect(self.RequestPreview)
+        # Connected after the config handlers, so the preview sees the edited config.
+        for signal in [
+            self.ui.widthScale.textEdited,
+            self.ui.heightScale.textEdited,
+            self.ui.watermarkText.textEdited,
+            self.ui.doScaleCheckbox.stateChanged,
+            self.checkbox_button_group.buttonToggled,
+        ]:
+            signal.connect(self.SchedulePreview)
+        self.ui.toWatermarkList.selectionModel().currentRowChanged.connect(self.RequestPreview)
+
     def SetFilesToWatermark(self):
         dlg = QtWidgets.QFileDialog()
         # dlg.setFileMode(QtWidgets.QFileDialog.AnyFile)
@@ -58,10 +127,13 @@ class ApplicationWindow(QtWidgets.QMainWindow):
         if dlg.exec_():
             print("files chosen")
             filenames = dlg.selectedFiles()
-            self.watermark_config.watermark_config.files_to_watermark = filenames
-            self.ui.toWatermarkList.clear()
-            for item in self.watermark_config.watermark_config.files_to_watermark:
-                self.ui.toWatermarkList.addItem(item)
+            self.SetFileList(filenames)
+
+    def SetFileList(self, filenames):
+        self.watermark_config.watermark_config.files_to_watermark = filenames
+        self.file_list_model.set_files(filenames)
+        if len(filenames) > 0:
+            self.ui.toWatermarkList.setCurrentIndex(self.file_list_model.index(0))
 
     def SetWatermarkToApply(self):
         dlg = QtWidgets.QFileDialog()
@@ -73,6 +145,7 @@ class ApplicationWindow(QtWidgets.QMainWindow):
             filename = dlg.selectedFiles()[0]
             self.watermark_config.watermark_config.watermark_file = filename
             self.ui.watermarkFile.setText(self.watermark_config.watermark_config.watermark_file)
+            self.SchedulePreview()
 
     def SetOutputFolder(self):
         dlg = QtWidgets.QFileDialog()
@@ -86,6 +159,33 @@ class ApplicationWindow(QtWidgets.QMainWindow):
             self.watermark_config.watermark_config.output_folder = directory_name[0]
             self.ui.outputFolder.setText(self.watermark_config.watermark_config.output_folder)
 
+    def SchedulePreview(self, *args):
+        self.preview_timer.start()
+
+    def RequestPreview(self, *args):
+        self.preview_timer.stop()
+        index = self.ui.toWatermarkList.currentIndex()
+        if not index.isValid():
+            return
+        self.preview_thread.request(self.watermark_config.watermark_config, self.file_list_model.file_at(index.row()))
+
+    def ShowPreview(self, generation, image):
+        # Older renders can still arrive while a newer one is on its way.
+        if self.preview_thread.is_stale(generation):
+            return
+        self.preview_label.setPixmap(QtGui.QPixmap.fromImage(image))
+
+    def ShowPreviewErrors(self, generation, errors):
+        if self.preview_thread.is_stale(generation):
+            return
+        self.preview_label.setPixmap(QtGui.QPixmap())
+        self.preview_label.setText("\n".join(errors))
+
+    def closeEvent(self, event):
+        self.preview_thread.stop()
+        self.file_list_model.close()
+        QtWidgets.QMainWindow.closeEvent(self, event)
+
     def ErrorDialog(self, messages):
         print("errors", "\n".join(messages))
         error_box = QtWidgets.QMessageBox()
@@ -110,6 +210,11 @@ class ApplicationWindow(QtWidgets.QMainWindow):
 
 
 if __name__ == "__main__":
+    if getattr(sys, "frozen", False):
+        # Needed for the worker processes of frozen (pyinstaller) builds. Not imported otherwise to start faster.
+        import multiprocessing
+
+        multiprocessing.freeze_support()
     app = QtWidgets.QApplication(sys.argv)
     application = ApplicationWindow()
     application.show()
@@ -0,0 +1,63 @@
+import os
+import sys
+
+# Options pillow_heif is registered with, see configure_heif_decoder and watermark_codecs.register_heif_opener.
+_decoder_options = {
+    "decode_threads": 4,
+    "thumbnails": True,
+    # Depth maps and auxiliary images (portrait mattes and the like) are never used, so they aren't read.
+    "depth_images": False,
+    "aux_images": False,
+}
+
+
+def get_decode_threads(decode_threads: int, workers: int = 1):
+    # 0 shares the cores between the workers, each of them decoding one image at a time.
+    if decode_threads > 0:
+        return decode_threads
+    return max(1, (os.cpu_count() or 1) // max(workers, 1))
+
+
+def configure_heif_decoder(decode_threads: int, thumbnails: bool = True):
+    """
+    Set how HEIF images are decoded.
+
+    Applies when pillow_heif gets registered, or straight away if it already is. pillow_heif is not imported here.
+    Args:
+        decode_threads (int): Threads libheif may use to decode the tiles of one image.
+        thumbnails (bool): Read the embedded thumbnails, so draft_heif_thumbnail can decode one instead.
+    """
+    _decoder_options["decode_threads"] = decode_threads
+    _decoder_options["thumbnails"] = thumbnails
+    options = sys.modules.get("pillow_heif.options")
+    if options is not None:
+        options.DECODE_THREADS = decode_threads
+        options.THUMBNAILS = thumbnails
+
+
+def get_heif_opener_options():
+    # Keyword arguments of pillow_heif.register_heif_opener.
+    return dict(_decoder_options)
+
+
+def is_heif_image(image):
+    return image.format == "HEIF"
+
+
+def draft_heif_thumbnail(image, size: tuple):
+    """
+    Make an opened, not yet decoded, HEIF image decode an embedded thumbnail instead of the full image.
+
+    Phones embed a small thumbnail in their HEIC files, which decodes in a fraction of the time of the full image.
+    The smallest thumbnail that is at least size, and a scaled copy of the image, is used. pillow_heif versions
+    without thumbnail support in draft() decode the full image as before.
+    Args:
+        image (Image): The opened image.
+        size (tuple): The size the image will be reduced to.
+
+    Returns:
+        bool: Whether a thumbnail will be decoded, image.size is then the size of the thumbnail.
+    """
+    if not is_heif_image(image) or len(image.info.get("thumbnails", [])) == 0:
+        return False
+    return image.draft(image.mode, size) is not None
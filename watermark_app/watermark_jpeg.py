@@ -0,0 +1,154 @@
+import os
+import shutil
+import subprocess
+from functools import lru_cache
+
+from PIL import JpegImagePlugin
+
+# Source modes whose blocks we can re-encode to match: the JPEG decodes to them without conversion.
+_REGION_MODES = ["RGB", "L"]
+
+
+@lru_cache(maxsize=1)
+def find_jpegtran():
+    """
+    Find a jpegtran supporting -drop (libjpeg 9 and recent libjpeg-turbo), which region mode needs.
+
+    Returns:
+        str: Path of jpegtran, or None if there is none or it can't drop images into others.
+    """
+    jpegtran = shutil.which("jpegtran")
+    if jpegtran is None:
+        return None
+    try:
+        # The usage, printed for unknown switches, lists -drop when it is supported.
+        usage = subprocess.run([jpegtran, "-help"], capture_output=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if b"-drop" not in usage.stdout + usage.stderr:
+        return None
+    return jpegtran
+
+
+def get_source_encoder_options(source_image):
+    """
+    Pillow save() options re-encoding pixels with the quantization tables and chroma subsampling of a JPEG.
+
+    Like quality="keep", which Pillow only allows when saving the source image itself.
+    Returns:
+        dict: The options, empty if source_image is not a JPEG.
+    """
+    if source_image.format != "JPEG" or not getattr(source_image, "quantization", None):
+        return {}
+    options = {"qtables": source_image.quantization}
+    sampling = JpegImagePlugin.get_sampling(source_image)
+    if sampling != -1:
+        options["subsampling"] = sampling
+    return options
+
+
+def get_mcu_size(source_image):
+    # Size of the minimum coded unit of a JPEG: the blocks of the most sampled component, 8x8 pixels each.
+    if len(source_image.layer) == 1:
+        return (8, 8)
+    return (8 * max(layer[1] for layer in source_image.layer), 8 * max(layer[2] for layer in source_image.layer))
+
+
+def can_drop_regions(source_image):
+    # Whether region mode can re-encode blocks of source_image exactly as its encoder laid them out.
+    if source_image.format != "JPEG" or source_image.mode not in _REGION_MODES:
+        return False
+    return source_image.mode == "L" or JpegImagePlugin.get_sampling(source_image) != -1
+
+
+def align_box(box: tuple, mcu_size: tuple, image_size: tuple):
+    # Grows box to whole MCUs, without going past the image edges.
+    return (
+        box[0] - box[0] % mcu_size[0],
+        box[1] - box[1] % mcu_size[1],
+        min(image_size[0], -(-box[2] // mcu_size[0]) * mcu_size[0]),
+        min(image_size[1], -(-box[3] // mcu_size[1]) * mcu_size[1]),
+    )
+
+
+def merge_boxes(boxes: list):
+    """
+    Merge overlapping boxes, so that each pixel is dropped in by a single region.
+
+    Returns:
+        list: (box, indices) tuples, where indices are the positions in boxes of the boxes merged into box.
+    """
+    regions = []
+    for index, box in enumerate(boxes):
+        indices = [index]
+        merged = True
+        while merged:
+            merged = False
+            for region in regions:
+                region_box, region_indices = region
+                if (
+                    box[0] < region_box[2]
+                    and region_box[0] < box[2]
+                    and box[1] < region_box[3]
+                    and region_box[1] < box[3]
+                ):
+                    regions.remove(region)
+                    box = (
+                        min(box[0], region_box[0]),
+                        min(box[1], region_box[1]),
+                        max(box[2], region_box[2]),
+                        max(box[3], region_box[3]),
+                    )
+                    indices = region_indices + indices
+                    merged = True
+                    break
+        regions.append((box, indices))
+    return [(box, sorted(indices)) for box, indices in regions]
+
+
+def drop_regions(source_path: str, regions: list, output_path: str, encoder_options: dict, jpegtran: str = None):
+    """
+    Write a copy of the JPEG source_path with regions replaced, keeping the coded data of every other block.
+
+    Each region is encoded on its own with encoder_options (see get_source_encoder_options), then dropped into the
+    source with jpegtran -drop. Only the blocks of the regions are re-encoded: the rest of the image is copied
+    without being decoded, as are the metadata markers of the source.
+    Args:
+        source_path (str): The source JPEG.
+        regions (list): (left, top, image) of each region. left and top must be multiples of the MCU size.
+        output_path (str): Where to write the result. Intermediate files are written next to it.
+        encoder_options (dict): Pillow save() options of the regions.
+        jpegtran (str): jpegtran to use, found with find_jpegtran by default.
+
+    Returns:
+        list: Errors, empty on success.
+    """
+    jpegtran = jpegtran or find_jpegtran()
+    if jpegtran is None:
+        return ["jpegtran with -drop support is not available"]
+    current_path = source_path
+    temporary_paths = []
+    try:
+        for index, (left, top, region_image) in enumerate(regions):
+            region_path = "%s.region%d.jpg" % (output_path, index)
+            temporary_paths.append(region_path)
+            region_image.save(region_path, format="jpeg", **encoder_options)
+            next_path = "%s.drop%d.jpg" % (output_path, index)
+            temporary_paths.append(next_path)
+            command = [jpegtran, "-copy", "all", "-drop", "+%d+%d" % (left, top), region_path]
+            completed = subprocess.run(command + ["-outfile", next_path, current_path], capture_output=True)
+            if completed.returncode != 0:
+                error = completed.stderr.decode("utf-8", "replace").strip()
+                return ["jpegtran failed with exit code %d: %s" % (completed.returncode, error)]
+            current_path = next_path
+        if current_path == source_path:
+            shutil.copyfile(source_path, output_path)
+        else:
+            os.replace(current_path, output_path)
+    except (OSError, ValueError) as e:
+        return ["Unable to write %s. Error was: %s" % (output_path, str(e))]
+    finally:
+        for temporary_path in temporary_paths:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+    return []
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+
+from watermark_config import WatermarkConfig
+
+MANIFEST_FILENAME = ".watermark_manifest.jsonl"
+
+# Read size used when hashing file contents.
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path: str):
+    # Streams the file through sha256, without holding it in memory.
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(_HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_config_hash(watermark_config: WatermarkConfig):
+    """
+    Hash the settings that affect the outputs of watermark_config.
+
+    The watermark file is identified by its size and mtime as well as its path, so replacing it invalidates every
+    output made with the old one.
+    """
+    settings = watermark_config.get_output_settings()
+    if watermark_config.watermark_file is not None and os.path.exists(watermark_config.watermark_file):
+        stat = os.stat(watermark_config.watermark_file)
+        settings["watermark_file_stat"] = [stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class WatermarkManifest:
+    def __init__(self, watermark_config: WatermarkConfig):
+        """
+        Records which inputs already have a current output in watermark_config.output_folder.
+
+        The manifest is an append-only JSON lines file, one line per watermarked input, so it survives a run being
+        killed part way through: every file recorded before the interruption is skipped by the next run. Later lines
+        override earlier ones for the same input. compact() rewrites it with only the latest entries.
+
+        Attributes:
+            path (str): Location of the manifest file.
+            config_hash (str): Hash of the settings of the current run, see get_config_hash.
+            hash_contents (bool): Also store and compare content hashes of inputs.
+            entries (dict): Latest entry per absolute input path.
+        """
+        self.path = os.path.join(watermark_config.output_folder, MANIFEST_FILENAME)
+        self.config_hash = get_config_hash(watermark_config)
+        self.hash_contents = watermark_config.manifest_hash_contents
+        self.entries = {}
+        self._manifest_file = None
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run.
+                    continue
+                self.entries[entry["input_file"]] = entry
+
+    def get_input_signature(self, input_file: str, content_hash: str = None):
+        stat = os.stat(input_file)
+        signature = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if self.hash_contents:
+            signature["content_hash"] = content_hash or hash_file(input_file)
+        return signature
+
+    def is_current(self, input_file: str):
+        """
+        Whether input_file already has an output made from its current contents with the current settings.
+        """
+        entry = self.entries.get(os.path.abspath(input_file))
+        if entry is None or entry["config_hash"] != self.config_hash:
+            return False
+        if entry["output_file"] is None or not os.path.exists(entry["output_file"]):
+            return False
+        try:
+            stat = os.stat(input_file)
+        except OSError:
+            return False
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime_ns == entry["mtime_ns"]:
+            return True
+        # A touched file may still have the same contents.
+        return self.hash_contents and entry.get("content_hash") == hash_file(input_file)
+
+    def filter_files(self, files):
+        # Yields the files that need (re)processing, lazily so that streamed inputs stay streamed.
+        for input_file in files:
+            if self.is_current(input_file):
+                print("up to date: %s" % input_file)
+                continue
+            yield input_file
+
+    def record(self, input_file: str, output_file: str):
+        entry = {"input_file": os.path.abspath(input_file), "config_hash": self.config_hash, "output_file": output_file}
+        entry.update(self.get_input_signature(input_file))
+        self.entries[entry["input_file"]] = entry
+        if self._manifest_file is None:
+            self._manifest_file = open(self.path, "a", encoding="utf-8")
+        self._manifest_file.write(json.dumps(entry) + "\n")
+        self._manifest_file.flush()
+
+    def compact(self):
+        # Rewrites the manifest with only the latest entry of each input. The rename keeps the old one if we die.
+        self.close()
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as manifest_file:
+            for entry in self.entries.values():
+                manifest_file.write(json.dumps(entry) + "\n")
+        os.replace(temporary_path, self.path)
+
+    def close(self):
+        if self._manifest_file is not None:
+            self._manifest_file.close()
+            self._manifest_file = None
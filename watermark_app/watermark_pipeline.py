@@ -0,0 +1,300 @@
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+from PIL import Image
+
+import watermark
+from watermark_config import WatermarkConfig
+from watermark_profile import profile_file, profile_stage
+
+# Marks the end of the stream of items passed between stages.
+_END_OF_STREAM = object()
+
+# How often blocked stages check whether the pipeline was stopped, in seconds.
+_POLL_INTERVAL = 0.1
+
+
+class PipelineStage:
+    def __init__(self, name: str, function, input_queue, output_queue, stop_event, source=None):
+        """
+        A single stage of the pipeline, running function over every item on its own thread.
+
+        Items come from input_queue, or from the source iterable for the first stage.
+
+        Attributes:
+            name (str): Name of the stage, used in the stats.
+            items (int): Number of items processed so far.
+            busy_seconds (float): Time spent running function.
+            waiting_seconds (float): Time spent waiting for an item from the previous stage (or the source).
+            blocked_seconds (float): Time spent waiting for room in the queue of the next stage.
+            max_queue_depth (int): Deepest the input queue has been when taking an item from it.
+            finished (bool): Whether the stage passed the end of the stream on.
+            error (Exception): What stopped the stage, raised again by WatermarkPipeline.run. None if nothing did.
+        """
+        self.name = name
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.stop_event = stop_event
+        self.source = source
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.waiting_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.max_queue_depth = 0
+        self._queue_depth_total = 0
+        self.finished = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="watermark-%s" % name, daemon=True)
+
+    def run(self):
+        try:
+            for item in self._items():
+                start = time.perf_counter()
+                item = self.function(item)
+                self.busy_seconds += time.perf_counter() - start
+                self.items += 1
+
+                start = time.perf_counter()
+                stopped = not self._put(item)
+                self.blocked_seconds += time.perf_counter() - start
+                if stopped:
+                    return
+            self.finished = self._put(_END_OF_STREAM)
+        except Exception as e:
+            # The source iterator or function failed. Ending the stream lets the next stages finish the items
+            # already passed on, then WatermarkPipeline.run raises the error.
+            self.error = e
+            self.finished = self._put(_END_OF_STREAM)
+
+    def stats(self):
+        elapsed = self.busy_seconds + self.waiting_seconds + self.blocked_seconds
+        return {
+            "items": self.items,
+            "busy_seconds": self.busy_seconds,
+            "waiting_seconds": self.waiting_seconds,
+            "blocked_seconds": self.blocked_seconds,
+            "utilization": self.busy_seconds / elapsed if elapsed > 0 else 0.0,
+            "mean_queue_depth": self._queue_depth_total / self.items if self.items > 0 else 0.0,
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+    def _items(self):
+        # Yields input items until the end of the stream, or until the pipeline is stopped.
+        if self.source is not None:
+            source = iter(self.source)
+            while not self.stop_event.is_set():
+                start = time.perf_counter()
+                item = next(source, _END_OF_STREAM)
+                self.waiting_seconds += time.perf_counter() - start
+                if item is _END_OF_STREAM:
+                    return
+                yield item
+            return
+
+        while not self.stop_event.is_set():
+            depth = self.input_queue.qsize()
+            start = time.perf_counter()
+            try:
+                item = self.input_queue.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            finally:
+                self.waiting_seconds += time.perf_counter() - start
+            if item is _END_OF_STREAM:
+                return
+            self._queue_depth_total += depth
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+            yield item
+
+    def _put(self, item):
+        # Returns False if the pipeline was stopped before the item could be queued.
+        while not self.stop_event.is_set():
+            try:
+                self.output_queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class WatermarkPipeline:
+    def __init__(
+        self,
+        watermark_config: WatermarkConfig,
+        watermark_image=None,
+        text_image=None,
+        text: str = None,
+    ):
+        """
+        Watermarks a stream of files with decoding, compositing and encoding overlapping on separate threads.
+
+        The reader decodes (and resizes) images, the compositor applies the watermark and the writer encodes the
+        outputs. Pillow releases the GIL while decoding and encoding, so I/O and CPU work overlap. Stages are joined
+        by queues of watermark_config.pipeline_queue_depth items, which bounds how many decoded images are in memory.
+
+        Attributes:
+            stages (list): The reader, compositor and writer PipelineStage, once run has started.
+        """
+        self.watermark_config = watermark_config
+        self.watermark_image = watermark_image
+        self.text_image = text_image
+        self.text = text
+        self.stages = []
+
+    def run(self, files):
+        """
+        Watermark files, yielding one result per file in input order, see watermark.watermark_file.
+
+        Closing the generator early stops every stage.
+        """
+        stop_event = threading.Event()
+        queue_depth = max(1, self.watermark_config.pipeline_queue_depth)
+        decoded_queue = queue.Queue(maxsize=queue_depth)
+        composited_queue = queue.Queue(maxsize=queue_depth)
+        results_queue = queue.Queue(maxsize=queue_depth)
+
+        reader = PipelineStage("reader", self._decode, None, decoded_queue, stop_event, source=files)
+        compositor = PipelineStage("compositor", self._composite, decoded_queue, composited_queue, stop_event)
+        writer = PipelineStage("writer", self._write, composited_queue, results_queue, stop_event)
+        self.stages = [reader, compositor, writer]
+        for stage in self.stages:
+            stage.thread.start()
+
+        try:
+            while True:
+                try:
+                    result = results_queue.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    self._check_stages()
+                    continue
+                if result is _END_OF_STREAM:
+                    self._check_stages(ended=True)
+                    break
+                yield result
+        finally:
+            stop_event.set()
+            for stage in self.stages:
+                stage.thread.join()
+            print("pipeline stats: %s" % self.stats())
+
+    def _check_stages(self, ended: bool = False):
+        # Raises what stopped a stage: once the stream has ended, or straight away when the stage could not end it,
+        # as no more results will come.
+        for stage in self.stages:
+            stopped = not stage.thread.is_alive() and not stage.finished
+            if stage.error is not None and (ended or stopped):
+                raise stage.error
+            if stopped:
+                raise RuntimeError("Watermark pipeline %s stopped unexpectedly" % stage.name)
+
+    def stats(self):
+        # Per stage occupancy. The stage with the highest utilization is the bottleneck.
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def _decode(self, image_path: str):
+        print("processing: %s" % image_path)
+        item = SimpleNamespace(
+            result=SimpleNamespace(input_file=image_path, output_file=None, errors=[], duration=None, stages={}),
+            start=time.perf_counter(),
+            image=None,
+            outputs=None,
+            name=None,
+            format=None,
+            exif=None,
+            encoder_options=None,
+            mcu_size=None,
+            regions=None,
+        )
+        with profile_file(image_path, item.result.stages):
+            with profile_stage("open"):
+                base_image, errors = watermark.load_image(image_path)
+            if len(errors) > 0:
+                item.result.errors = errors
+                return item
+            try:
+                item.name = watermark.get_output_name(base_image.filename)
+                item.format = base_image.format
+                # Before resizing, see watermark.get_jpeg_source_options.
+                item.encoder_options = watermark.get_jpeg_source_options(self.watermark_config, base_image)
+                mcu_size = watermark.get_jpeg_region_mcu_size(item.encoder_options, base_image)
+                base_size = base_image.size
+                errors = watermark.check_image_memory(self.watermark_config, base_image, self.watermark_image)
+                if len(errors) > 0:
+                    item.result.errors = errors
+                    return item
+                with profile_stage("exif"):
+                    item.exif = base_image.getexif()
+                item.image, errors = watermark.maybe_resize_image(
+                    self.watermark_config, base_image, self.watermark_image
+                )
+                # Decode here, on the reader thread, rather than lazily in the compositor.
+                with profile_stage("decode"):
+                    item.image.load()
+                if mcu_size is not None and item.image.size == base_size:
+                    # Only the regions the watermark covers are re-encoded, see
+                    # watermark.apply_watermark_to_jpeg_regions.
+                    item.mcu_size = mcu_size
+            except Exception as e:
+                errors = ["Image failed to decode. Is %s a valid file? Error was: %s" % (image_path, str(e))]
+        item.result.errors = errors
+        return item
+
+    def _composite(self, item):
+        if len(item.result.errors) > 0:
+            return item
+        with profile_file(item.result.input_file, item.result.stages):
+            try:
+                if item.mcu_size is not None:
+                    item.regions, item.result.errors = watermark.composite_jpeg_regions(
+                        self.watermark_config,
+                        item.image,
+                        item.mcu_size,
+                        self.watermark_image,
+                        self.text_image,
+                        self.text,
+                    )
+                if len(item.result.errors) == 0:
+                    item.outputs, item.result.errors = watermark.composite_watermark_variants(
+                        self.watermark_config,
+                        item.image,
+                        self.watermark_image,
+                        self.text_image,
+                        self.text,
+                        include_full_size=item.mcu_size is None,
+                    )
+            except Exception as e:
+                item.outputs = None
+                item.result.errors = ["Failed to watermark %s. Error was: %s" % (item.result.input_file, str(e))]
+        item.image = None
+        if len(item.result.errors) == 0 and item.mcu_size is None and self.watermark_config.show_generated_images:
+            item.outputs[0][1].show()
+        return item
+
+    def _write(self, item):
+        if len(item.result.errors) == 0:
+            with profile_file(item.result.input_file, item.result.stages):
+                if item.mcu_size is not None:
+                    item.result.output_file, item.result.errors = watermark.save_watermarked_jpeg_regions(
+                        self.watermark_config,
+                        item.result.input_file,
+                        item.regions,
+                        item.encoder_options,
+                        item.outputs,
+                        item.name,
+                        item.exif,
+                    )
+                    if len(item.result.errors) == 0 and self.watermark_config.show_generated_images:
+                        Image.open(item.result.output_file).show()
+                else:
+                    item.result.output_file, item.result.errors = watermark.save_watermarked_variants(
+                        self.watermark_config, item.outputs, item.name, item.format, item.exif, item.encoder_options
+                    )
+        # Release the images as soon as they are written.
+        item.outputs = None
+        item.regions = None
+        # Wall time from the start of decoding, including the time spent queued between stages.
+        item.result.duration = time.perf_counter() - item.start
+        return item.result
@@ -0,0 +1,190 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Stage timings of the file being processed by the current thread, see profile_file.
+_current = threading.local()
+
+# Callables notified with (input_file, stages) once a file is done, see add_profile_hook.
+_hooks = []
+_hooks_lock = threading.Lock()
+
+
+@contextmanager
+def profile_file(input_file: str, stages: dict = None):
+    """
+    Collect the timings of every profile_stage run by this thread into stages, for input_file.
+
+    Args:
+        input_file (str): The file being processed.
+        stages (dict): Timings to add to, for files processed in several steps (or on several threads).
+
+    Yields:
+        dict: Seconds spent per stage name.
+    """
+    if stages is None:
+        stages = {}
+    previous = getattr(_current, "stages", None)
+    _current.stages = stages
+    try:
+        yield stages
+    finally:
+        _current.stages = previous
+
+
+@contextmanager
+def profile_stage(name: str):
+    # Times the enclosed block as stage `name` of the current file. Does nothing outside of profile_file.
+    stages = getattr(_current, "stages", None)
+    if stages is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def add_profile_hook(hook):
+    """
+    Register hook(input_file, stages) to be called after each file of a batch, with its seconds per stage.
+
+    Hooks are called in the process running the batch, also when files are watermarked by worker processes.
+    """
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_profile_hook(hook):
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+def notify_profile_hooks(input_file: str, stages: dict):
+    with _hooks_lock:
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(input_file, stages)
+
+
+def get_cprofile_stats(profile):
+    # The statistics of a cProfile.Profile as a picklable dict, to send them from a worker process to the batch.
+    import pstats
+
+    return pstats.Stats(profile).stats
+
+
+def percentile(values: list, percent: float):
+    # Linearly interpolated percentile of values, like numpy's default.
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return None
+    position = (len(ordered) - 1) * percent / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class WatermarkProfiler:
+    def __init__(self, cprofile_file: str = None, trace_memory: bool = False):
+        """
+        Collects per file stage timings of a batch, and optionally a cProfile and tracemalloc capture.
+
+        The captures cover the process running the batch. Worker processes profile each file themselves and send the
+        statistics with its result, which are merged into the cProfile dump, see record.
+
+        Attributes:
+            cprofile_file (str): Where to dump cProfile statistics of the batch, None to skip cProfile.
+            trace_memory (bool): Record the largest Python allocations with tracemalloc.
+            files (list): Input file, duration and seconds per stage of every recorded file.
+        """
+        self.cprofile_file = cprofile_file
+        self.trace_memory = trace_memory
+        self.files = []
+        self._profile = None
+        self._worker_stats = None
+        self._memory_snapshot = None
+        self._memory_peak = None
+
+    def start(self):
+        if self.cprofile_file is not None:
+            import cProfile
+
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        if self.trace_memory:
+            import tracemalloc
+
+            tracemalloc.start()
+
+    def stop(self):
+        if self._profile is not None:
+            import pstats
+
+            self._profile.disable()
+            stats = pstats.Stats(self._profile)
+            if self._worker_stats is not None:
+                stats.add(self._worker_stats)
+            stats.dump_stats(self.cprofile_file)
+            self._profile = None
+        if self.trace_memory:
+            import tracemalloc
+
+            if tracemalloc.is_tracing():
+                self._memory_peak = tracemalloc.get_traced_memory()[1]
+                self._memory_snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+
+    def record(self, input_file: str, duration: float, stages: dict, cprofile_stats: dict = None):
+        # cprofile_stats are the statistics of a file watermarked by a worker process, see get_cprofile_stats.
+        self.files.append({"input_file": input_file, "duration": duration, "stages": dict(stages)})
+        if cprofile_stats is not None and self.cprofile_file is not None:
+            import pstats
+
+            worker_stats = pstats.Stats()
+            worker_stats.stats = cprofile_stats
+            worker_stats.get_top_level_stats()
+            if self._worker_stats is None:
+                self._worker_stats = worker_stats
+            else:
+                self._worker_stats.add(worker_stats)
+
+    def report(self):
+        """
+        Summarize the recorded files.
+
+        Returns:
+            dict: The per file timings, and per stage count, total, mean, p50, p95 and p99 in seconds.
+        """
+        samples = {"total": [entry["duration"] for entry in self.files if entry["duration"] is not None]}
+        for entry in self.files:
+            for stage, seconds in entry["stages"].items():
+                samples.setdefault(stage, []).append(seconds)
+        aggregate = {}
+        for stage, values in samples.items():
+            if len(values) == 0:
+                continue
+            aggregate[stage] = {
+                "count": len(values),
+                "total": sum(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+            }
+        report = {"files": self.files, "aggregate": aggregate}
+        if self._memory_snapshot is not None:
+            report["memory"] = {
+                "python_peak_bytes": self._memory_peak,
+                "top_allocations": [
+                    {"location": str(statistic.traceback), "bytes": statistic.size, "count": statistic.count}
+                    for statistic in self._memory_snapshot.statistics("lineno")[:20]
+                ],
+            }
+        return report
+
+    def write_report(self, report_file: str):
+        with open(report_file, "w") as output_file:
+            json.dump(self.report(), output_file, indent=2)
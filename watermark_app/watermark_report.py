@@ -0,0 +1,88 @@
+import csv
+import json
+import os
+
+from watermark_dedup import get_output_files
+
+# Columns of the per file report, in order.
+REPORT_FIELDS = ["input_file", "status", "output_file", "bytes_written", "duration", "error"]
+
+
+def get_result_entry(result, output_variants: list = None):
+    """
+    Turn a result of watermark.watermark_files into a report entry.
+
+    Args:
+        result: The result of a file.
+        output_variants (list): The output variants of the batch, see WatermarkConfig.output_variants.
+
+    Returns:
+        dict: The REPORT_FIELDS of the result. status is "ok" or "failed", error joins the error messages and
+            bytes_written sums the full size output and its variants.
+    """
+    failed = len(result.errors) > 0
+    bytes_written = None
+    if not failed and result.output_file is not None:
+        bytes_written = 0
+        for output_file in get_output_files(result.output_file, output_variants or []):
+            try:
+                bytes_written += os.path.getsize(output_file)
+            except OSError:
+                pass
+    return {
+        "input_file": result.input_file,
+        "status": "failed" if failed else "ok",
+        "output_file": result.output_file,
+        "bytes_written": bytes_written,
+        "duration": result.duration,
+        "error": "\n".join(result.errors) if failed else None,
+    }
+
+
+class WatermarkReport:
+    def __init__(self, output_variants: list = None):
+        """
+        Collects the outcome of every file of a batch, for a summary and a JSON or CSV report.
+
+        Attributes:
+            output_variants (list): The output variants written for every file, counted in bytes_written.
+            entries (list): One entry per file, see get_result_entry.
+        """
+        self.output_variants = list(output_variants or [])
+        self.entries = []
+
+    def record(self, result):
+        entry = get_result_entry(result, self.output_variants)
+        self.entries.append(entry)
+        return entry
+
+    def get_errors(self):
+        # The error of every failed file, prefixed with the file.
+        return [
+            "%s: %s" % (entry["input_file"], entry["error"]) for entry in self.entries if entry["status"] == "failed"
+        ]
+
+    def summary(self):
+        succeeded = [entry for entry in self.entries if entry["status"] == "ok"]
+        return {
+            "total": len(self.entries),
+            "succeeded": len(succeeded),
+            "failed": len(self.entries) - len(succeeded),
+            "bytes_written": sum(entry["bytes_written"] or 0 for entry in succeeded),
+            "duration": sum(entry["duration"] or 0.0 for entry in self.entries),
+        }
+
+    def format_summary(self):
+        summary = self.summary()
+        return "%d of %d files watermarked, %d failed" % (summary["succeeded"], summary["total"], summary["failed"])
+
+    def write(self, report_file: str):
+        # CSV if report_file ends with .csv, JSON with the summary otherwise.
+        if report_file.lower().endswith(".csv"):
+            with open(report_file, "w", newline="", encoding="utf-8") as output_file:
+                writer = csv.DictWriter(output_file, fieldnames=REPORT_FIELDS)
+                writer.writeheader()
+                writer.writerows(self.entries)
+            return
+        with open(report_file, "w", encoding="utf-8") as output_file:
+            json.dump({"summary": self.summary(), "files": self.entries}, output_file, indent=2)
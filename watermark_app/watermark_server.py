@@ -0,0 +1,259 @@
+import copy
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import watermark
+from watermark_cli import config_from_arguments, create_argument_parser
+from watermark_config import WatermarkConfig
+
+CONTENT_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+# Query parameters a request may override, with the config field they set and how to parse them.
+REQUEST_OVERRIDES = {
+    "text": ("watermark_text", str),
+    "locations": ("watermark_locations", lambda value: value.split(",")),
+    "alpha_scale": ("alpha_scale", float),
+    "width_ratio": ("minimal_watermark_width_percentage", float),
+    "height_ratio": ("minimal_watermark_height_percentage", float),
+    "output_format": ("output_format", str),
+    "jpeg_quality": ("jpeg_quality", int),
+    "webp_quality": ("webp_quality", int),
+}
+
+
+def get_request_config(watermark_config: WatermarkConfig, query: str):
+    """
+    Apply the overrides of a request query string to a copy of watermark_config.
+
+    Returns:
+        tuple: The config of the request (None if invalid) and a list of errors.
+    """
+    request_config = copy.copy(watermark_config)
+    request_config.watermark_locations = list(watermark_config.watermark_locations)
+    errors = []
+    for name, values in parse_qs(query).items():
+        if name not in REQUEST_OVERRIDES:
+            errors.append("Unknown parameter %s, expected one of %s" % (name, ", ".join(REQUEST_OVERRIDES)))
+            continue
+        field, parse = REQUEST_OVERRIDES[name]
+        try:
+            setattr(request_config, field, parse(values[-1]))
+        except ValueError:
+            errors.append("Invalid value %s for %s" % (values[-1], name))
+    errors += request_config.check_valid(check_paths=False)
+    if len(errors) > 0:
+        return None, errors
+    return request_config, []
+
+
+class WatermarkServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # socketserver's default listen backlog of 5 resets connections during bursts, before we can answer a 503.
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        server_address: tuple,
+        watermark_config: WatermarkConfig,
+        workers: int = 1,
+        max_queue: int = 16,
+        max_request_bytes: int = 64 * 1024 * 1024,
+    ):
+        """
+        HTTP service watermarking the images POSTed to /watermark, in memory.
+
+        The watermark and text layer are loaded once, and prepared layers stay in the process wide cache, so a
+        request only pays for decoding, compositing and encoding its image. Requests overriding the text load the
+        watermark again, to lay the text out the same way. Requests are watermarked by a pool of
+        `workers` threads (Pillow releases the GIL while decoding, compositing and encoding). At most max_queue
+        more requests wait for a worker; further requests get a 503 straight away, without being decoded.
+
+        Attributes:
+            watermark_config (WatermarkConfig): Default settings of every request.
+            max_request_bytes (int): Larger request bodies are refused with a 413.
+            errors (list): Errors loading the watermark. Requests fail with a 500 while there are any.
+            served (int): Number of requests answered with a watermarked image.
+            rejected (int): Number of requests refused because every worker and queue slot was taken.
+        """
+        ThreadingHTTPServer.__init__(self, server_address, WatermarkRequestHandler)
+        self.watermark_config = watermark_config
+        self.max_request_bytes = max_request_bytes
+        self.served = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._lock = threading.Lock()
+
+        self.watermark_image, self.text_image, self.text, self.errors = watermark.preload_watermark_and_text_images(
+            watermark_config
+        )
+        # Images are opened lazily. Load them now rather than concurrently from the first requests.
+        for image in [self.watermark_image, self.text_image]:
+            if image is not None:
+                image.load()
+
+    def try_acquire(self):
+        # Takes a worker or queue slot, False when the server is saturated.
+        if self._slots.acquire(blocking=False):
+            return True
+        with self._lock:
+            self.rejected += 1
+        return False
+
+    def release(self):
+        self._slots.release()
+
+    def watermark_data(self, request_config: WatermarkConfig, data: bytes):
+        # Watermarks data on the worker pool. Returns the encoded image, its format and a list of errors. Raises what
+        # the watermarking raised beyond the errors it reports.
+        if len(self.errors) > 0:
+            return None, None, self.errors
+        watermark_image, text_image, text = self.watermark_image, self.text_image, self.text
+        if request_config.watermark_text != self.watermark_config.watermark_text:
+            # Laid out like the default text, see watermark_text_to_image_ratio, at the cost of loading the watermark.
+            watermark_image, text_image, text, errors = watermark.preload_watermark_and_text_images(request_config)
+            if len(errors) > 0:
+                return None, None, errors
+        future = self._executor.submit(
+            watermark.watermark_in_memory, request_config, data, watermark_image, text_image, text
+        )
+        output_data, output_format, errors = future.result()
+        if len(errors) == 0:
+            with self._lock:
+                self.served += 1
+        return output_data, output_format, errors
+
+    def stats(self):
+        return {
+            "served": self.served,
+            "rejected": self.rejected,
+            "watermark_cache": watermark.PREPARED_WATERMARK_CACHE.stats(),
+        }
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self._executor.shutdown(wait=True)
+
+
+class WatermarkRequestHandler(BaseHTTPRequestHandler):
+    # POST /watermark with the image as body and REQUEST_OVERRIDES as query parameters. GET /health for stats.
+
+    def send_json(self, status: int, content: dict, headers: dict = None):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def discard_body(self, length: int):
+        while length > 0:
+            chunk = self.rfile.read(min(length, 64 * 1024))
+            if not chunk:
+                break
+            length -= len(chunk)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self.send_json(404, {"errors": ["Not found"]})
+            return
+        self.send_json(200, self.server.stats())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/watermark":
+            self.send_json(404, {"errors": ["Not found"]})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = 0
+        if length <= 0:
+            self.close_connection = True
+            self.send_json(411, {"errors": ["The image must be sent as the request body, with a Content-Length"]})
+            return
+        if length > self.server.max_request_bytes:
+            # Not worth reading. Clients still sending may see the connection reset instead of the 413.
+            self.close_connection = True
+            self.send_json(413, {"errors": ["Images are limited to %d bytes" % self.server.max_request_bytes]})
+            return
+        request_config, errors = get_request_config(self.server.watermark_config, url.query)
+        if len(errors) > 0:
+            self.discard_body(length)
+            self.send_json(400, {"errors": errors})
+            return
+        if not self.server.try_acquire():
+            # Cheap compared to watermarking it, and the client gets to see the 503 rather than a reset connection.
+            self.discard_body(length)
+            self.send_json(503, {"errors": ["Too many requests in progress"]}, {"Retry-After": "1"})
+            return
+        status = 500 if self.server.errors else 400
+        try:
+            data = self.rfile.read(length)
+            output_data, output_format, errors = self.server.watermark_data(request_config, data)
+        except Exception as e:
+            # Such as a decoder choking on a malformed image. Answer rather than drop the connection.
+            self.log_error("Failed to watermark image: %r", e)
+            status = 500
+            errors = ["Failed to watermark image. Error was: %s" % str(e)]
+        finally:
+            self.server.release()
+        if len(errors) > 0:
+            self.send_json(status, {"errors": errors})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES[output_format])
+        self.send_header("Content-Length", str(len(output_data)))
+        self.end_headers()
+        self.wfile.write(output_data)
+
+
+def parse_arguments():
+    parser = create_argument_parser(
+        description="Serves watermarking over HTTP: POST an image to /watermark to get it back watermarked.",
+        input_help=None,
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument(
+        "--max_queue", type=int, default=16, help="Requests that may wait for a worker before new ones get a 503"
+    )
+    parser.add_argument("--max_request_mb", type=float, default=64, help="Largest accepted image, in MB")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    config = config_from_arguments(arguments)
+    error_messages = config.watermark_config.check_valid(check_paths=False)
+    if len(error_messages) > 0:
+        print("\n".join(error_messages))
+        sys.exit(1)
+
+    server = WatermarkServer(
+        (arguments.host, arguments.port),
+        config.watermark_config,
+        workers=watermark.get_worker_count(config.watermark_config),
+        max_queue=arguments.max_queue,
+        max_request_bytes=int(arguments.max_request_mb * 1024 * 1024),
+    )
+    if len(server.errors) > 0:
+        print("\n".join(server.errors))
+        sys.exit(1)
+    print("serving on http://%s:%d/watermark" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,48 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import copy
+import csv
+import http.client
+import io
+import json
 import os
+import pstats
+import shutil
+import subprocess
+import sys
+import threading
+import time
 
-from PIL import Image
+import pytest
+from PIL import Image, ImageChops, ImageStat
+from PyQt5 import QtCore
 
 import watermark
+import watermark_benchmark
+import watermark_cli
+import watermark_dedup
+import watermark_discovery
+import watermark_fonts
+import watermark_jpeg
+import watermark_profile
+import watermark_server
+import watermark_watch
+from watermark_cache import LRUCache
 from watermark_config import WatermarkConfig
+from watermark_manifest import WatermarkManifest
+from watermark_pipeline import WatermarkPipeline
+from gui.watermark_file_list import FileListModel, ThumbnailCache
+from gui.watermark_preview import PreviewThread, render_preview
 from gui.watermark_progress_dialog import ProgressDialog, WatermarkThread
 
 WATERMARK_FILE = os.path.abspath("./test/watermark_image/watermark_image.png")
 TEST_FILE = os.path.abspath("./test/base_image.png")
 OUT_DIRECTORY = os.path.abspath("./test/")
+HEIC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "IMG_5219.HEIC")
+
+# Budget for importing the command line tool. Catches heavy imports (Qt, codecs) creeping back in.
+MAX_CLI_IMPORT_SECONDS = 0.5
 
 
 def _CreateBaseConfig():
@@ -23,12 +54,96 @@ def _CreateBaseConfig():
     return config
 
 
+def _CreateTestImages(directory, count=3, size=(320, 240), mode="RGB"):
+    # Writes a small watermark and `count` noisy base images to directory. Returns a config using them.
+    watermark_file = os.path.join(directory, "watermark.png")
+    watermark_image = Image.new("RGBA", (40, 20), (255, 0, 0, 160))
+    watermark_image.save(watermark_file)
+    files = []
+    for index in range(count):
+        path = os.path.join(directory, "base_%d.png" % index)
+        Image.effect_noise(size, 40 + index).convert(mode).save(path)
+        files.append(path)
+    config = WatermarkConfig()
+    config.watermark_file = watermark_file
+    config.files_to_watermark = files
+    config.watermark_locations = ["top-left", "bottom-right"]
+    config.do_image_scaling = False
+    return config
+
+
+def _ReadOutputs(directory):
+    outputs = {}
+    for filename in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, filename), "rb") as output_file:
+            outputs[filename] = output_file.read()
+    return outputs
+
+
 def test_load_image():
     config = _CreateBaseConfig()
     watermark_image, errors = watermark.load_image(WATERMARK_FILE)
     assert len(errors) == 0
 
 
+def test_CliImportTime():
+    # Measured in a fresh interpreter, this test module already imports Qt.
+    script = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import watermark_cli\n"
+        "print(time.perf_counter() - start)\n"
+        "print(sorted(module for module in ['PyQt5', 'pillow_heif'] if module in sys.modules))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.splitlines()
+    assert output[1] == "[]"
+    assert float(output[0]) < MAX_CLI_IMPORT_SECONDS
+
+
+def test_LoadHeicImage():
+    image, errors = watermark.load_image(HEIC_FILE)
+    assert len(errors) == 0
+    assert image.format == "HEIF"
+
+
+def test_HeicThumbnailDecode():
+    config = WatermarkConfig()
+    config.do_image_scaling = True
+    # A 100 pixel wide watermark at half the image width needs a 200 pixel wide image.
+    config.minimal_watermark_height_percentage = 0.5
+    watermark_image = Image.new("RGBA", (100, 50))
+    watermark.preload_watermark_and_text_images(config)
+    image, errors = watermark.load_image(HEIC_FILE)
+    if len(image.info.get("thumbnails", [])) == 0:
+        pytest.skip("pillow_heif does not read HEIF thumbnails")
+    resized_image, errors = watermark.maybe_resize_image(config, image, watermark_image)
+    assert resized_image.size == (200, 150)
+    # Decoded from the 320x240 thumbnail rather than the 4032x3024 image.
+    assert image.size == (320, 240)
+
+    preview, full_size, errors = watermark.load_preview_image(HEIC_FILE, (256, 256))
+    assert len(errors) == 0 and preview.size == (256, 192) and full_size == (4032, 3024)
+    timings = watermark_benchmark.time_heic_decode(HEIC_FILE, repeats=1)
+    assert timings["thumbnail_size"] == [320, 240]
+    assert timings["thumbnail_decode_seconds"] < timings["decode_seconds"]
+
+    config.heif_thumbnails = False
+    watermark.preload_watermark_and_text_images(config)
+    try:
+        image, errors = watermark.load_image(HEIC_FILE)
+        watermark.maybe_resize_image(config, image, watermark_image)
+        assert image.size == (4032, 3024)
+    finally:
+        config.heif_thumbnails = True
+        watermark.preload_watermark_and_text_images(config)
+
+
 def test_ImageResize():
     config = _CreateBaseConfig()
     watermark_image, errors = watermark.load_image(WATERMARK_FILE)
@@ -36,6 +151,45 @@ def test_ImageResize():
     watermark.maybe_resize_image(config, base_image, watermark_image)
 
 
+def test_ResizeModeSpeed(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=0)
+    config.do_image_scaling = True
+    image_path = str(tmp_path / "large.jpg")
+    Image.linear_gradient("L").resize((1600, 1200)).convert("RGB").save(image_path, quality=95)
+    watermark_image, errors = watermark.load_image(config.watermark_file)
+
+    resized = {}
+    for resize_mode in ["quality", "speed"]:
+        config.resize_mode = resize_mode
+        base_image, errors = watermark.load_image(image_path)
+        resized[resize_mode], errors = watermark.maybe_resize_image(config, base_image, watermark_image)
+        assert len(errors) == 0
+        if resize_mode == "speed":
+            # Decoded with DCT scaling rather than at full resolution.
+            assert base_image.size == (400, 300)
+    assert resized["quality"].size == resized["speed"].size == (266, 200)
+    difference = ImageChops.difference(resized["quality"], resized["speed"]).convert("L")
+    assert ImageStat.Stat(difference).mean[0] < 2
+
+
+def test_CreateTextLayerFitsTarget():
+    text = "Copyright 2024"
+    for image_size in [(320, 240), (4000, 3000), (3000, 4000)]:
+        text_layer, errors = watermark.create_text_layer(text, image_size, width_ratio=0.3, height_ratio=0.1)
+        assert len(errors) == 0
+        target = (int(image_size[0] * 0.3), int(image_size[1] * 0.1))
+        assert text_layer.width <= target[0] and text_layer.height <= target[1]
+        # The next size up would not fit anymore.
+        font_path = watermark_fonts.get_default_font_path()
+        font_size = watermark_fonts.fit_font_size(text, font_path, *target)
+        larger_width, larger_height = watermark_fonts.measure_text(text, font_path, font_size + 1)
+        assert larger_width > target[0] or larger_height > target[1]
+    assert watermark_fonts.get_font(font_path, 20) is watermark_fonts.get_font(font_path, 20)
+
+    text_layer, errors = watermark.create_text_layer(text, (320, 240), font_path="/does/not/exist.ttf")
+    assert text_layer is None and len(errors) == 1
+
+
 def test_GetWatermarkPosition():
     config = _CreateBaseConfig()
     watermark_image, errors = watermark.load_image(WATERMARK_FILE)
@@ -53,6 +207,707 @@ def test_ApplyWatermark():
     assert len(errors) == 0
 
 
+def test_ParallelMatchesSerial(tmp_path):
+    config = _CreateTestImages(str(tmp_path))
+    outputs = {}
+    for workers in [1, 2]:
+        config.workers = workers
+        config.output_folder = str(tmp_path / ("out_%d" % workers))
+        os.makedirs(config.output_folder)
+        results = list(watermark.watermark_files(config, *watermark.preload_watermark_and_text_images(config)[:3]))
+        assert [result.input_file for result in results] == config.files_to_watermark
+        assert all(len(result.errors) == 0 for result in results)
+        outputs[workers] = _ReadOutputs(config.output_folder)
+    assert len(outputs[1]) == 3
+    assert outputs[1] == outputs[2]
+
+
+def test_PipelineMatchesSerial(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=5)
+    config.files_to_watermark.insert(2, str(tmp_path / "missing.png"))
+    watermark_image, text_image, text, errors = watermark.preload_watermark_and_text_images(config)
+    outputs = {}
+    for pipeline_mode in [False, True]:
+        config.pipeline_mode = pipeline_mode
+        config.pipeline_queue_depth = 1
+        config.output_folder = str(tmp_path / ("out_%s" % pipeline_mode))
+        os.makedirs(config.output_folder)
+        results = list(watermark.watermark_files(config, watermark_image, text_image, text))
+        assert [result.input_file for result in results] == config.files_to_watermark
+        assert [len(result.errors) > 0 for result in results] == [False, False, True, False, False, False]
+        outputs[pipeline_mode] = _ReadOutputs(config.output_folder)
+    assert outputs[False] == outputs[True]
+
+    pipeline = WatermarkPipeline(config, watermark_image, text_image, text)
+    results = pipeline.run(config.files_to_watermark)
+    next(results)
+    # Stopping early joins every stage.
+    results.close()
+    assert all(not stage.thread.is_alive() for stage in pipeline.stages)
+    assert set(pipeline.stats()) == {"reader", "compositor", "writer"}
+
+
+def test_PipelineSourceError(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=1)
+    config.output_folder = str(tmp_path)
+    watermark_image, text_image, text, errors = watermark.preload_watermark_and_text_images(config)
+
+    def files():
+        yield config.files_to_watermark[0]
+        raise PermissionError("Permission denied: listing")
+
+    # The error reaches the caller, after the files read before it, instead of the pipeline waiting forever.
+    pipeline = WatermarkPipeline(config, watermark_image, text_image, text)
+    results = []
+    with pytest.raises(PermissionError):
+        for result in pipeline.run(files()):
+            results.append(result)
+    assert len(results) == 1 and len(results[0].errors) == 0
+    assert all(not stage.thread.is_alive() for stage in pipeline.stages)
+
+
+def test_OutputVariants(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=2, size=(1200, 800))
+    config.output_variants = [128, 600, 1024]
+    config.png_optimize = False
+    config.png_compress_level = 1
+    # Large enough to spot: 80x40 red at the top left corner.
+    config.watermark_file = str(tmp_path / "large_watermark.png")
+    Image.new("RGBA", (80, 40), (255, 0, 0, 255)).save(config.watermark_file)
+    config.watermark_locations = ["top-left"]
+    watermark_image, text_image, text, errors = watermark.preload_watermark_and_text_images(config)
+    outputs = {}
+    for pipeline_mode in [False, True]:
+        config.pipeline_mode = pipeline_mode
+        config.output_folder = str(tmp_path / ("out_%s" % pipeline_mode))
+        os.makedirs(config.output_folder)
+        watermark.PREPARED_WATERMARK_CACHE.clear()
+        results = list(watermark.watermark_files(config, watermark_image, text_image, text))
+        assert all(len(result.errors) == 0 for result in results)
+        outputs[pipeline_mode] = _ReadOutputs(config.output_folder)
+        # One layer per size, reused by the second image.
+        assert watermark.PREPARED_WATERMARK_CACHE.stats()["entries"] == 4
+    assert outputs[False] == outputs[True]
+
+    expected_sizes = {"": (1200, 800), "_1024": (1024, 683), "_600": (600, 400), "_128": (128, 85)}
+    for suffix, size in expected_sizes.items():
+        output_image = Image.open(str(tmp_path / "out_False" / ("base_0_watermarked%s.png" % suffix)))
+        assert output_image.size == size
+        # The watermark shrinks with the image.
+        scale = size[0] / 1200
+        assert output_image.getpixel((int(70 * scale), int(30 * scale)))[:3] == (255, 0, 0)
+        assert output_image.getpixel((int(90 * scale) + 1, int(50 * scale) + 1))[:3] != (255, 0, 0)
+
+
+def _CreateJpegSource(tmp_path, subsampling="4:2:0"):
+    # A 400x300 jpeg of smooth gradients with a 40x20 watermark at two corners, writing jpeg outputs.
+    config = _CreateTestImages(str(tmp_path), count=0)
+    config.files_to_watermark = [str(tmp_path / "source.jpg")]
+    gradient = Image.linear_gradient("L").resize((400, 300))
+    Image.merge(
+        "RGB", [gradient, Image.radial_gradient("L").resize((400, 300)), gradient.transpose(Image.ROTATE_180)]
+    ).save(config.files_to_watermark[0], quality=70, subsampling=subsampling)
+    config.watermark_locations = ["top-left", "bottom-right"]
+    config.output_format = "source"
+    config.jpeg_lossless_regions = True
+    config.output_folder = str(tmp_path / "out")
+    os.makedirs(config.output_folder)
+    return config
+
+
+def test_JpegRegionHelpers(tmp_path):
+    config = _CreateJpegSource(tmp_path)
+    source = Image.open(config.files_to_watermark[0])
+    assert watermark_jpeg.get_mcu_size(source) == (16, 16) and watermark_jpeg.can_drop_regions(source)
+    assert watermark_jpeg.align_box((17, 5, 40, 33), (16, 16), (400, 300)) == (16, 0, 48, 48)
+    assert watermark_jpeg.align_box((380, 290, 400, 300), (16, 16), (400, 300)) == (368, 288, 400, 300)
+    # Boxes sharing MCUs are merged, boxes only touching are not.
+    merged = watermark_jpeg.merge_boxes([(0, 0, 32, 16), (48, 0, 64, 16), (16, 0, 64, 16), (0, 16, 16, 32)])
+    assert merged == [((0, 0, 64, 16), [0, 1, 2]), ((0, 16, 16, 32), [3])]
+    options = watermark_jpeg.get_source_encoder_options(source)
+    assert options["qtables"] == source.quantization and options["subsampling"] == 2
+
+    # The regions get the pixels of the whole image watermarked.
+    watermark_image, errors = watermark.load_image(config.watermark_file)
+    source.load()
+    expected, errors = watermark.composite_watermark(config, source, watermark_image)
+    regions, errors = watermark.composite_jpeg_regions(config, source, (16, 16), watermark_image)
+    assert [region[:2] for region in regions] == [(0, 0), (352, 272)]
+    assert regions[1][2].size == (48, 28) and regions[1][2].mode == "RGB"
+    for left, top, region in regions:
+        box = (left, top, left + region.width, top + region.height)
+        assert region.tobytes() == expected.convert("RGB").crop(box).tobytes()
+
+
+def test_JpegLosslessRegionsFallback(tmp_path):
+    # Without jpegtran, or with a block layout it can't reproduce, the tables of the source are reused.
+    config = _CreateJpegSource(tmp_path, subsampling="4:2:2")
+    source = Image.open(config.files_to_watermark[0])
+    config.do_image_scaling = False
+    watermark_image, errors = watermark.load_image(config.watermark_file)
+    for pipeline_mode in [False, True]:
+        config.pipeline_mode = pipeline_mode
+        results = list(watermark.watermark_files(config, watermark_image))
+        assert len(results[0].errors) == 0
+        output = Image.open(results[0].output_file)
+        assert output.quantization == source.quantization
+        assert watermark_jpeg.get_mcu_size(output) == (16, 8)
+    with open(config.files_to_watermark[0], "rb") as source_file:
+        data = source_file.read()
+    output_data, output_format, errors = watermark.watermark_in_memory(config, data, watermark_image)
+    assert Image.open(io.BytesIO(output_data)).quantization == source.quantization
+    config.jpeg_lossless_regions = False
+    output_data, output_format, errors = watermark.watermark_in_memory(config, data, watermark_image)
+    assert Image.open(io.BytesIO(output_data)).quantization != source.quantization
+
+
+@pytest.mark.skipif(watermark_jpeg.find_jpegtran() is None, reason="needs jpegtran with -drop")
+def test_JpegLosslessRegions(tmp_path):
+    config = _CreateJpegSource(tmp_path)
+    config.do_image_scaling = False
+    config.output_variants = [200]
+    source = Image.open(config.files_to_watermark[0])
+    result = watermark.watermark_file(
+        config, config.files_to_watermark[0], watermark.load_image(config.watermark_file)[0]
+    )
+    assert len(result.errors) == 0
+    output = Image.open(result.output_file)
+    assert output.quantization == source.quantization
+    assert os.path.exists(os.path.join(config.output_folder, "source_watermarked_200.jpg"))
+    # Blocks away from the watermark decode exactly as in the source, the watermarked ones changed.
+    assert output.crop((64, 64, 336, 240)).tobytes() == source.crop((64, 64, 336, 240)).tobytes()
+    assert output.crop((0, 0, 40, 20)).tobytes() != source.crop((0, 0, 40, 20)).tobytes()
+
+
+def test_JpegRegionsEverywhere(tmp_path, monkeypatch):
+    # The pipeline and in-memory paths drop the regions in too, rather than re-encoding the whole image.
+    config = _CreateJpegSource(tmp_path)
+    config.do_image_scaling = False
+    config.output_variants = [200]
+    watermark_image, errors = watermark.load_image(config.watermark_file)
+    dropped = []
+
+    def drop_regions(source_path, regions, output_filename, encoder_options):
+        # Stands in for jpegtran, which may not be installed.
+        dropped.append([region[:2] for region in regions])
+        output = Image.open(source_path).convert("RGB")
+        for left, top, region in regions:
+            output.paste(region, (left, top))
+        output.save(output_filename, **encoder_options)
+        return []
+
+    monkeypatch.setattr(watermark, "find_jpegtran", lambda: "jpegtran")
+    monkeypatch.setattr(watermark, "drop_regions", drop_regions)
+    config.pipeline_mode = True
+    results = list(watermark.watermark_files(config, watermark_image))
+    assert len(results[0].errors) == 0 and dropped == [[(0, 0), (352, 272)]]
+    assert os.path.exists(os.path.join(config.output_folder, "source_watermarked_200.jpg"))
+
+    with open(config.files_to_watermark[0], "rb") as source_file:
+        data = source_file.read()
+    for source in [data, io.BytesIO(data), Image.open(config.files_to_watermark[0])]:
+        output_data, output_format, errors = watermark.watermark_in_memory(config, source, watermark_image)
+        assert len(errors) == 0 and output_format == "jpeg"
+        assert Image.open(io.BytesIO(output_data)).size == (400, 300)
+    assert len(dropped) == 4
+    # Decoded images may have been changed since, so they are re-encoded in full.
+    decoded = Image.open(config.files_to_watermark[0])
+    decoded.load()
+    output_data, output_format, errors = watermark.watermark_in_memory(config, decoded, watermark_image)
+    assert len(errors) == 0 and len(dropped) == 4
+
+
+def test_ResumeWithManifest(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=3)
+    config.output_folder = str(tmp_path / "out")
+    os.makedirs(config.output_folder)
+    config.resume = True
+    config.manifest_hash_contents = True
+    result, errors = watermark.apply_watermark(config)
+    assert result and len(errors) == 0
+    manifest = WatermarkManifest(config)
+    assert all(manifest.is_current(image) for image in config.files_to_watermark)
+
+    # Touched but unchanged files stay current, changed inputs, missing outputs and new settings do not.
+    os.utime(config.files_to_watermark[0], ns=(0, 0))
+    Image.new("RGB", (320, 240), (0, 0, 255)).save(config.files_to_watermark[1])
+    os.remove(os.path.join(config.output_folder, "base_2_watermarked.png"))
+    manifest = WatermarkManifest(config)
+    assert list(manifest.filter_files(config.files_to_watermark)) == config.files_to_watermark[1:]
+    config.alpha_scale = 0.5
+    manifest = WatermarkManifest(config)
+    assert list(manifest.filter_files(config.files_to_watermark)) == config.files_to_watermark
+
+
+def test_Deduplicate(tmp_path, capsys):
+    config = _CreateTestImages(str(tmp_path), count=2)
+    first, second = config.files_to_watermark
+    copies = [str(tmp_path / "copy_a.png"), str(tmp_path / "copy_b.png"), str(tmp_path / "copy_c.png")]
+    for copy_path, source_path in zip(copies, [first, first, second]):
+        shutil.copyfile(source_path, copy_path)
+    config.files_to_watermark = [first, copies[0], second, copies[1]]
+    config.output_folder = str(tmp_path / "out")
+    os.makedirs(config.output_folder)
+    config.output_variants = [100]
+    config.deduplicate = True
+    result, errors = watermark.apply_watermark(config)
+    assert result and len(errors) == 0
+    # Each content was watermarked once, the copies share its outputs.
+    assert capsys.readouterr().out.count("processing:") == 2
+    first_output = os.path.join(config.output_folder, "base_0_watermarked.png")
+    for name, original in [
+        ("copy_a_watermarked.png", "base_0_watermarked.png"),
+        ("copy_b_watermarked.png", "base_0_watermarked.png"),
+        ("copy_b_watermarked_100.png", "base_0_watermarked_100.png"),
+    ]:
+        assert os.path.samefile(os.path.join(config.output_folder, name), os.path.join(config.output_folder, original))
+
+    # A later batch reuses the outputs of the index.
+    config.files_to_watermark = [copies[2]]
+    result, errors = watermark.apply_watermark(config)
+    assert result and capsys.readouterr().out.count("processing:") == 0
+    assert os.path.samefile(
+        os.path.join(config.output_folder, "copy_c_watermarked.png"),
+        os.path.join(config.output_folder, "base_1_watermarked.png"),
+    )
+    with open(os.path.join(config.output_folder, watermark_dedup.DEDUP_INDEX_FILENAME)) as index_file:
+        assert len(index_file.readlines()) == 2
+
+    # Rewriting an output leaves the outputs linked to it alone.
+    with open(os.path.join(config.output_folder, "copy_a_watermarked.png"), "rb") as output_file:
+        copy_output = output_file.read()
+    config.deduplicate = False
+    config.alpha_scale = 0.5
+    config.files_to_watermark = [first]
+    result, errors = watermark.apply_watermark(config)
+    with open(os.path.join(config.output_folder, "copy_a_watermarked.png"), "rb") as output_file:
+        assert output_file.read() == copy_output
+    assert not os.path.samefile(first_output, os.path.join(config.output_folder, "copy_a_watermarked.png"))
+    # As does writing one from the command line, for a single image, which has no variants.
+    config.output_variants = []
+    errors = watermark_cli.watermark_stream(config, copies[0], config.output_folder)
+    assert len(errors) == 0
+    with open(os.path.join(config.output_folder, "copy_b_watermarked.png"), "rb") as output_file:
+        assert output_file.read() == copy_output
+
+
+def test_ContinueOnErrorReport(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=2)
+    # A file that isn't an image, and one cut short that only fails once decoded.
+    not_an_image = str(tmp_path / "notes.png")
+    with open(not_an_image, "w") as text_file:
+        text_file.write("not an image")
+    truncated = str(tmp_path / "truncated.png")
+    with open(config.files_to_watermark[0], "rb") as image_file:
+        data = image_file.read()
+    with open(truncated, "wb") as image_file:
+        image_file.write(data[: len(data) // 2])
+    config.files_to_watermark = [not_an_image, config.files_to_watermark[0], truncated, config.files_to_watermark[1]]
+    config.output_folder = str(tmp_path / "out")
+    os.makedirs(config.output_folder)
+
+    result, errors = watermark.apply_watermark(config)
+    assert not result and len(errors) == 1
+    assert os.listdir(config.output_folder) == []
+
+    config.continue_on_error = True
+    config.output_variants = [16]
+    for report_file in ["report.json", "report.csv"]:
+        config.result_report_file = str(tmp_path / report_file)
+        result, errors = watermark.apply_watermark(config)
+        assert not result and len(errors) == 2
+        assert len(os.listdir(config.output_folder)) == 4
+    with open(str(tmp_path / "report.json")) as report_file:
+        report = json.load(report_file)
+    assert report["summary"]["succeeded"] == 2 and report["summary"]["failed"] == 2
+    assert [entry["status"] for entry in report["files"]] == ["failed", "ok", "failed", "ok"]
+    # Counting the variants of the file.
+    output_files = watermark_dedup.get_output_files(report["files"][1]["output_file"], config.output_variants)
+    assert report["files"][1]["bytes_written"] == sum(os.path.getsize(output_file) for output_file in output_files)
+    assert report["files"][2]["error"] is not None
+    with open(str(tmp_path / "report.csv")) as report_file:
+        rows = list(csv.DictReader(report_file))
+    assert [row["status"] for row in rows] == ["failed", "ok", "failed", "ok"]
+
+    thread = WatermarkThread(config)
+    summaries = []
+    thread.summary_signal.connect(lambda summary, errors: summaries.append((summary, errors)))
+    thread.run()
+    assert len(thread.errors) == 0
+    assert summaries[0][0]["failed"] == 2 and len(summaries[0][1]) == 2
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_WatchFolder(tmp_path, use_inotify):
+    config = _CreateTestImages(str(tmp_path), count=2)
+    watch_folder = str(tmp_path / "drop")
+    os.makedirs(watch_folder)
+    existing_file = os.path.join(watch_folder, "existing.png")
+    Image.open(config.files_to_watermark[0]).save(existing_file)
+    # Outputs go to the watched folder, they must not be watermarked again.
+    config.output_folder = watch_folder
+    folder_watcher = watermark_watch.FolderWatcher(
+        config, watch_folder, settle_seconds=0.05, poll_interval=0.05, use_inotify=use_inotify
+    )
+    assert len(folder_watcher.errors) == 0
+    folder_watcher.add_existing_files()
+
+    # Written in two steps, the second after the first has been seen.
+    new_file = os.path.join(watch_folder, "new.png")
+    with open(config.files_to_watermark[1], "rb") as image_file:
+        data = image_file.read()
+    with open(new_file, "wb") as image_file:
+        image_file.write(data[:100])
+    folder_watcher.run_once()
+    with open(new_file, "wb") as image_file:
+        image_file.write(data)
+    with open(os.path.join(watch_folder, "notes.txt"), "w") as text_file:
+        text_file.write("not an image")
+
+    results = []
+    deadline = time.monotonic() + 5
+    while len(results) < 2 and time.monotonic() < deadline:
+        results += folder_watcher.run_once()
+    for _ in range(5):
+        results += folder_watcher.run_once()
+    folder_watcher.close()
+    assert sorted(os.path.basename(result.input_file) for result in results) == ["existing.png", "new.png"]
+    assert all(len(result.errors) == 0 for result in results)
+    assert Image.open(os.path.join(watch_folder, "new_watermarked.png")).size == (320, 240)
+
+
+def test_WatchFolderBatch(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=2)
+    watch_folder = str(tmp_path / "drop")
+    os.makedirs(watch_folder)
+    for index, image_path in enumerate(config.files_to_watermark):
+        shutil.copyfile(image_path, os.path.join(watch_folder, "photo_%d.png" % index))
+    config.output_folder = str(tmp_path / "out")
+    os.makedirs(config.output_folder)
+    config.workers = 2
+    config.result_report_file = str(tmp_path / "report.json")
+    folder_watcher = watermark_watch.FolderWatcher(config, watch_folder, settle_seconds=0, use_inotify=False)
+    try:
+        folder_watcher.add_existing_files()
+        results = folder_watcher.process_settled_files()
+        assert [len(result.errors) for result in results] == [0, 0]
+        with open(config.result_report_file) as report_file:
+            assert json.load(report_file)["summary"]["succeeded"] == 2
+
+        # Files that left the folder are forgotten.
+        os.remove(os.path.join(watch_folder, "photo_0.png"))
+        folder_watcher.prune()
+        assert list(folder_watcher._processed) == [os.path.join(watch_folder, "photo_1.png")]
+
+        # Without continue_on_error, a file that fails stops the watcher.
+        with open(os.path.join(watch_folder, "broken.png"), "wb") as image_file:
+            image_file.write(b"\x89PNG\r\n\x1a\n" + b"\0" * 64)
+        folder_watcher.add_existing_files()
+        results = folder_watcher.process_settled_files()
+        assert len(results) == 1 and len(folder_watcher.errors) > 0
+        folder_watcher.run()
+    finally:
+        folder_watcher.close()
+    with open(config.result_report_file) as report_file:
+        assert json.load(report_file)["summary"]["failed"] == 1
+
+
+def test_WatermarkServer(tmp_path, monkeypatch):
+    config = _CreateTestImages(str(tmp_path), count=1)
+    config.watermark_text_to_image_ratio = 0.5
+    server = watermark_server.WatermarkServer(("127.0.0.1", 0), config, workers=2, max_queue=0)
+    assert len(server.errors) == 0
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    with open(config.files_to_watermark[0], "rb") as image_file:
+        data = image_file.read()
+
+    def post(path, body):
+        connection = http.client.HTTPConnection(*server.server_address[:2], timeout=10)
+        connection.request("POST", path, body=body)
+        response = connection.getresponse()
+        content = response.read()
+        connection.close()
+        return response, content
+
+    try:
+        # The same pixels as a file watermarked from disk.
+        config.output_folder = str(tmp_path)
+        watermark_image, errors = watermark.load_image(config.watermark_file)
+        expected_file = watermark.watermark_file(config, config.files_to_watermark[0], watermark_image).output_file
+        response, content = post("/watermark", data)
+        assert response.status == 200 and response.getheader("Content-Type") == "image/png"
+        assert Image.open(io.BytesIO(content)).tobytes() == Image.open(expected_file).tobytes()
+
+        response, content = post("/watermark?output_format=jpeg&text=served&locations=center-center", data)
+        assert response.status == 200 and Image.open(io.BytesIO(content)).format == "JPEG"
+        response, content = post("/watermark?alpha_scale=lots", data)
+        assert response.status == 400
+        response, content = post("/watermark", b"not an image")
+        assert response.status == 400 and len(json.loads(content)["errors"]) == 1
+        response, content = post("/watermark?locations=foo", data)
+        assert response.status == 400 and "location foo" in json.loads(content)["errors"][0]
+
+        # Text overrides are laid out next to the watermark, like the default text.
+        text_config = copy.copy(config)
+        text_config.watermark_text = "served"
+        expected = watermark.watermark_in_memory(
+            text_config, data, *watermark.preload_watermark_and_text_images(text_config)[:3]
+        )[0]
+        response, content = post("/watermark?text=served", data)
+        assert response.status == 200
+        assert Image.open(io.BytesIO(content)).tobytes() == Image.open(io.BytesIO(expected)).tobytes()
+
+        # Unexpected failures still get an answer.
+        def fail(*args):
+            raise SyntaxError("broken decoder")
+
+        monkeypatch.setattr(watermark, "watermark_in_memory", fail)
+        response, content = post("/watermark", data)
+        assert response.status == 500 and "broken decoder" in json.loads(content)["errors"][0]
+        monkeypatch.undo()
+
+        # With every worker busy (and no queue), requests are turned away.
+        assert server.try_acquire() and server.try_acquire()
+        response, content = post("/watermark", data)
+        assert response.status == 503 and response.getheader("Retry-After") is not None
+        server.release()
+        server.release()
+        assert server.stats()["served"] == 3 and server.stats()["rejected"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+
+
+def test_WatermarkInMemory(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=1)
+    config.output_folder = str(tmp_path)
+    # As the CLI places it by default.
+    config.watermark_locations = ["top-left"]
+    watermark_image, errors = watermark.load_image(config.watermark_file)
+    expected = Image.open(watermark.watermark_file(config, config.files_to_watermark[0], watermark_image).output_file)
+    with open(config.files_to_watermark[0], "rb") as image_file:
+        data = image_file.read()
+
+    base_image = Image.open(io.BytesIO(data))
+    base_image.load()
+    original_pixels = base_image.tobytes()
+    for source in [base_image, data, io.BytesIO(data)]:
+        output_data, output_format, errors = watermark.watermark_in_memory(config, source, watermark_image)
+        assert len(errors) == 0 and output_format == "png"
+        assert Image.open(io.BytesIO(output_data)).tobytes() == expected.tobytes()
+    # The caller's image is left alone.
+    assert base_image.tobytes() == original_pixels
+    output_image, output_format, errors = watermark.watermark_in_memory(config, data, watermark_image, encode=False)
+    assert output_image.tobytes() == expected.tobytes()
+    assert watermark.watermark_in_memory(config, b"not an image", watermark_image)[0] is None
+
+    # "-" pipes the image through stdin and stdout, with messages on stderr.
+    command = [sys.executable, "watermark_cli.py", "-", "-", "--watermark_image", config.watermark_file]
+    output = subprocess.run(command, input=data, capture_output=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.returncode == 0, output.stderr
+    assert Image.open(io.BytesIO(output.stdout)).tobytes() == expected.tobytes()
+    # Only one image goes through the pipe, so variants are refused rather than dropped.
+    command += ["--output_variants", "100"]
+    output = subprocess.run(command, input=data, capture_output=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.returncode == 1 and b"Output variants" in output.stderr and output.stdout == b""
+
+
+def test_DiscoverImages(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=2)
+    os.makedirs(str(tmp_path / "nested" / "deeper"))
+    nested_file = str(tmp_path / "nested" / "deeper" / "photo.jpg")
+    Image.new("RGB", (32, 32)).save(nested_file)
+    # Files are recognised by their header, not by their name.
+    renamed_file = str(tmp_path / "nested" / "no_extension")
+    Image.new("RGB", (32, 32)).save(renamed_file, format="png")
+    with open(str(tmp_path / "notes.png"), "w") as text_file:
+        text_file.write("not an image")
+    with open(str(tmp_path / "notes.bmp"), "w") as text_file:
+        text_file.write("BMP files start with BM")
+    # Formats without magic bytes are identified by Pillow.
+    headerless_files = [str(tmp_path / "photo.tga"), str(tmp_path / "photo.ppm")]
+    for headerless_file in headerless_files:
+        Image.new("RGB", (32, 32)).save(headerless_file)
+
+    images = [config.watermark_file] + config.files_to_watermark + headerless_files
+    assert sorted(watermark_discovery.discover_images(str(tmp_path))) == sorted(images)
+    assert sorted(watermark_discovery.discover_images(str(tmp_path), recursive=True)) == sorted(
+        images + [nested_file, renamed_file]
+    )
+    pattern = os.path.join(str(tmp_path), "**", "*.jpg")
+    for threads in [1, 4]:
+        discovered = watermark_discovery.discover_images(pattern, recursive=True, threads=threads)
+        assert list(discovered) == [nested_file]
+
+
+def test_PreparedWatermarkCache(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=1)
+    config.alpha_scale = 0.5
+    watermark.PREPARED_WATERMARK_CACHE.clear()
+    watermark_image, errors = watermark.load_image(config.watermark_file)
+    first, errors = watermark.prepare_watermark_layer(config, (320, 240), watermark_image, "text")
+    second, errors = watermark.prepare_watermark_layer(config, (320, 240), watermark_image, "text")
+    third, errors = watermark.prepare_watermark_layer(config, (640, 480), watermark_image, "text")
+    assert first is second
+    assert third is not first
+    stats = watermark.PREPARED_WATERMARK_CACHE.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 2)
+
+    # Shrinking the cap evicts the least recently used layer first.
+    config.watermark_cache_max_mb = stats["bytes"] / (1024 * 1024) - 0.000001
+    watermark.get_prepared_watermark_cache(config)
+    assert watermark.PREPARED_WATERMARK_CACHE.stats()["entries"] == 1
+    third_again, errors = watermark.prepare_watermark_layer(config, (640, 480), watermark_image, "text")
+    assert third_again is third
+
+    # The generic cache under it, as used for thumbnails and previews.
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", 1, 4)
+    cache.put("b", 2, 4)
+    assert cache.get("a") == 1
+    cache.put("c", 3, 4)
+    assert cache.get("b") is None and cache.get("a") == 1 and cache.stats()["entries"] == 2
+    cache.put("d", 4, 11)
+    assert cache.get("d") is None
+
+
+def test_RegionCompositingMatchesFullFrame(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=1, mode="RGBA")
+    config.alpha_scale = 0.6
+    watermark_image, errors = watermark.load_image(config.watermark_file)
+    base_image, errors = watermark.load_image(config.files_to_watermark[0])
+    prepared, errors = watermark.prepare_watermark_layer(config, base_image.size, watermark_image, "overlap")
+    positions = [[0, 0], [10, 5], [200, 150], [250, 200]]
+    regions = watermark.get_watermark_regions(positions, prepared.image.size)
+    assert sum(len(region_positions) for box, region_positions in regions) == len(positions)
+    full_frame = watermark.composite_watermark_full_frame(base_image, prepared, positions)
+    regions = watermark.composite_watermark_regions(base_image, prepared, positions)
+    assert full_frame.tobytes() == regions.tobytes()
+
+
+def test_LargeImageTiles(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=1)
+    config.alpha_scale = 0.6
+    watermark_image, errors = watermark.load_image(config.watermark_file)
+    base_image, errors = watermark.load_image(config.files_to_watermark[0])
+    prepared, errors = watermark.prepare_watermark_layer(config, base_image.size, watermark_image, "tiles")
+    # Placements straddling tile borders, overlapping each other and the image edges.
+    positions = [[-5, -3], [10, 5], [30, 14], [300, 230]]
+    expected = watermark.composite_watermark_regions(base_image, prepared, positions)
+    for mode in ["RGB", "L"]:
+        tiled = watermark.composite_watermark_tiles(base_image.convert(mode), prepared, positions, 16)
+        assert tiled.mode == "RGB"
+        assert tiled.tobytes() == expected.convert("RGB").tobytes()
+
+    # Chosen automatically above the pixel threshold.
+    config.large_image_pixel_threshold = 1000
+    config.output_folder = str(tmp_path)
+    output_file, errors = watermark.apply_watermark_to_image(config, base_image, watermark_image)
+    assert len(errors) == 0
+    assert Image.open(output_file).mode == "RGB"
+
+    # Images over the memory cap fail before being decoded.
+    config.max_image_memory_mb = 0.1
+    base_image, errors = watermark.load_image(config.files_to_watermark[0])
+    output_file, errors = watermark.apply_watermark_to_image(config, base_image, watermark_image)
+    assert output_file is None and len(errors) == 1
+    assert len(base_image.tile) > 0
+
+
+def test_OutputFormats(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=1)
+    jpeg_file = str(tmp_path / "photo.jpg")
+    Image.open(config.files_to_watermark[0]).save(jpeg_file)
+    config.files_to_watermark.append(jpeg_file)
+    watermark_image, errors = watermark.load_image(config.watermark_file)
+    expected_formats = {
+        "png": ["PNG", "PNG"],
+        "source": ["PNG", "JPEG"],
+        "jpeg": ["JPEG", "JPEG"],
+        "webp": ["WEBP", "WEBP"],
+    }
+    for output_format, formats in expected_formats.items():
+        config.output_format = output_format
+        config.output_folder = str(tmp_path / output_format)
+        os.makedirs(config.output_folder)
+        for image_path, expected_format in zip(config.files_to_watermark, formats):
+            base_image, errors = watermark.load_image(image_path)
+            output_file, errors = watermark.apply_watermark_to_image(config, base_image, watermark_image)
+            assert len(errors) == 0
+            assert Image.open(output_file).format == expected_format
+            assert output_file.endswith(watermark.OUTPUT_EXTENSIONS[expected_format.lower()])
+
+    # Lossless webp keeps the exact pixels of the png output.
+    config.output_format = "webp"
+    config.webp_lossless = True
+    config.output_folder = str(tmp_path / "webp_lossless")
+    os.makedirs(config.output_folder)
+    base_image, errors = watermark.load_image(config.files_to_watermark[0])
+    output_file, errors = watermark.apply_watermark_to_image(config, base_image, watermark_image)
+    png_file = os.path.join(str(tmp_path / "png"), "base_0_watermarked.png")
+    assert Image.open(output_file).convert("RGBA").tobytes() == Image.open(png_file).tobytes()
+
+
+def test_ProfileReport(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=3)
+    config.watermark_text = "profiled"
+    config.output_folder = str(tmp_path / "out")
+    os.makedirs(config.output_folder)
+    config.profile_report_file = str(tmp_path / "profile.json")
+    config.profile_cprofile_file = str(tmp_path / "profile.prof")
+    config.profile_memory = True
+    hooked = []
+
+    def hook(input_file, stages):
+        hooked.append((input_file, set(stages)))
+
+    watermark_profile.add_profile_hook(hook)
+    try:
+        result, errors = watermark.apply_watermark(config)
+    finally:
+        watermark_profile.remove_profile_hook(hook)
+    assert result and len(errors) == 0
+    assert [input_file for input_file, stages in hooked] == config.files_to_watermark
+    assert {"open", "decode", "composite", "encode"} <= hooked[0][1]
+
+    with open(config.profile_report_file) as report_file:
+        report = json.load(report_file)
+    assert len(report["files"]) == 3
+    assert report["aggregate"]["total"]["count"] == 3
+    assert report["aggregate"]["encode"]["p50"] <= report["aggregate"]["encode"]["p99"]
+    assert "top_allocations" in report["memory"]
+    assert os.path.exists(config.profile_cprofile_file)
+    assert watermark_profile.percentile([1, 2, 3, 4], 50) == 2.5
+
+    # Worker processes profile the files and send the statistics back. Memory profiling can't see them.
+    config.workers = 2
+    assert len(config.check_valid()) == 1
+    config.profile_memory = False
+    os.remove(config.profile_cprofile_file)
+    result, errors = watermark.apply_watermark(config)
+    assert result and len(errors) == 0
+    profiled_functions = {function for _, _, function in pstats.Stats(config.profile_cprofile_file).stats}
+    assert {"_initialize_worker", "composite_watermark"} & profiled_functions == {"composite_watermark"}
+
+
+def test_Benchmark():
+    results = watermark_benchmark.run_benchmarks(["png"], ["RGB"], [0.05], images=2, repeats=1, isolate=False)
+    case = results["cases"]["png-RGB-0.05MP"]
+    for function_name in watermark_benchmark.BENCHMARKED_FUNCTIONS:
+        assert case[function_name]["images_per_second"] > 0
+
+    baseline = copy.deepcopy(results)
+    assert watermark_benchmark.compare_results(results, baseline, tolerance=0.1) == []
+    baseline["cases"]["png-RGB-0.05MP"]["load_image"]["images_per_second"] *= 2
+    if case["peak_rss_mb"] is not None:
+        baseline["cases"]["png-RGB-0.05MP"]["peak_rss_mb"] /= 2
+    regressions = watermark_benchmark.compare_results(results, baseline, tolerance=0.1)
+    assert len(regressions) == (1 if case["peak_rss_mb"] is None else 2)
+    assert watermark_benchmark.compare_results(results, baseline, tolerance=1.5) == []
+
+
 def test_ConstructProgressdialog(qtbot):
     config = _CreateBaseConfig()
     progress_dialog = ProgressDialog(config)
@@ -65,6 +920,156 @@ def test_WatermarkThread(qtbot):
     thread.run()
 
 
+def test_WatermarkThreadCancel(qtbot, tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=5)
+    config.output_folder = str(tmp_path / "output")
+    os.makedirs(config.output_folder)
+    config.result_report_file = str(tmp_path / "report.json")
+    # Throttled, only the start, the first file and the end of the batch are signalled.
+    thread = WatermarkThread(config, progress_interval=3600)
+    statuses = []
+    thread.signal.connect(lambda status, progress, errors: statuses.append(progress))
+    hooked = []
+    hook = lambda input_file, stages: hooked.append(input_file)
+    watermark_profile.add_profile_hook(hook)
+    try:
+        thread.run()
+    finally:
+        watermark_profile.remove_profile_hook(hook)
+    assert statuses == [0, 1, 5] and not thread.cancelled
+    assert hooked == config.files_to_watermark
+
+    # Cancelled after the first file, serially and on a pool. The files already handed to the workers are finished
+    # and reported, the others are skipped.
+    for workers in [1, 2]:
+        config.workers = workers
+        config.files_to_watermark = config.files_to_watermark[:5] + [
+            shutil.copyfile(config.files_to_watermark[index], str(tmp_path / ("copy_%d.png" % index)))
+            for index in range(5)
+        ]
+        shutil.rmtree(config.output_folder)
+        os.makedirs(config.output_folder)
+        thread = WatermarkThread(config, progress_interval=0)
+        summaries = []
+        thread.signal.connect(lambda status, progress, errors: progress > 0 and thread.cancel())
+        thread.summary_signal.connect(lambda summary, errors: summaries.append(summary))
+        thread.run()
+        thread.signal.disconnect()
+        assert thread.cancelled and thread.step_text.startswith("Cancelled")
+        written = len(os.listdir(config.output_folder))
+        assert summaries[0]["cancelled"] and summaries[0]["total"] == written < 10
+        assert summaries[0]["skipped"] == 10 - written
+        if workers == 1:
+            assert written == 1
+        with open(config.result_report_file) as report_file:
+            assert len(json.load(report_file)["files"]) == written
+
+
+def test_RenderPreview(tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=1)
+    config.output_folder = str(tmp_path)
+    watermark_image, errors = watermark.load_image(config.watermark_file)
+    expected = Image.open(watermark.watermark_file(config, config.files_to_watermark[0], watermark_image).output_file)
+
+    # Large enough for the whole image, the preview is the output.
+    proxy, full_size, errors = watermark.load_preview_image(config.files_to_watermark[0], (640, 480))
+    preview, errors = render_preview(config, proxy, full_size, watermark_image, max_size=(640, 480))
+    assert preview.tobytes() == expected.tobytes()
+    # Downsampled, the watermark shrinks with the image.
+    proxy, full_size, errors = watermark.load_preview_image(config.files_to_watermark[0], (160, 120))
+    original_proxy = proxy.tobytes()
+    preview, errors = render_preview(config, proxy, full_size, watermark_image, max_size=(160, 120))
+    assert preview.size == (160, 120) and proxy.tobytes() == original_proxy
+    assert preview.getpixel((10, 5))[:3] != proxy.getpixel((10, 5))[:3]
+    assert preview.getpixel((21, 11))[:3] == proxy.getpixel((21, 11))[:3]
+
+
+def test_PreviewThread(qtbot, tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=2)
+    preview_thread = PreviewThread(max_size=(160, 120))
+    preview_thread.start()
+    try:
+        # Only the latest request is rendered and shown.
+        preview_thread.request(config, config.files_to_watermark[0])
+        config.watermark_locations = ["center-center"]
+        with qtbot.waitSignal(preview_thread.preview_signal, check_params_cb=lambda generation, image: generation == 2):
+            generation = preview_thread.request(config, config.files_to_watermark[1])
+        assert generation == 2 and not preview_thread.is_stale(2)
+        with qtbot.waitSignal(preview_thread.preview_signal) as blocker:
+            preview_thread.request(config, config.files_to_watermark[1])
+        assert blocker.args[1].size().width() == 160
+        # The proxy of the second image was reused.
+        assert preview_thread.proxy_cache.hits >= 1
+        with qtbot.waitSignal(preview_thread.error_signal):
+            preview_thread.request(config, str(tmp_path / "missing.png"))
+    finally:
+        preview_thread.stop()
+
+
+def test_FileListModel(qtbot, tmp_path):
+    config = _CreateTestImages(str(tmp_path), count=3, size=(640, 480))
+    thumbnail_cache = ThumbnailCache(str(tmp_path / "thumbnails"))
+    model = FileListModel(thumbnail_cache)
+    try:
+        model.set_files(config.files_to_watermark + [str(tmp_path / "missing.png")])
+        assert model.rowCount() == 4 and model.data(model.index(1)) == config.files_to_watermark[1]
+        # Only the rows asked for get a thumbnail, made in the background.
+        with qtbot.waitSignal(model.dataChanged) as blocker:
+            assert model.data(model.index(1), QtCore.Qt.DecorationRole) is None
+        assert blocker.args[0].row() == 1
+        assert model.data(model.index(1), QtCore.Qt.DecorationRole).width() == 64
+        assert thumbnail_cache.misses == 1 and len(os.listdir(thumbnail_cache.folder)) == 1
+        with qtbot.waitSignal(model.thumbnail_signal):
+            assert model.data(model.index(3), QtCore.Qt.DecorationRole) is None
+        assert model.data(model.index(3), QtCore.Qt.DecorationRole) is None
+        # Setting the files again retries the ones that failed.
+        shutil.copyfile(config.files_to_watermark[0], str(tmp_path / "missing.png"))
+        model.set_files(config.files_to_watermark + [str(tmp_path / "missing.png")])
+        with qtbot.waitSignal(model.dataChanged):
+            assert model.data(model.index(3), QtCore.Qt.DecorationRole) is None
+        assert model.data(model.index(3), QtCore.Qt.DecorationRole).width() == 64
+    finally:
+        model.close()
+
+    # Reopened, the thumbnail comes from the disk until its image changes.
+    thumbnail, errors = thumbnail_cache.get(config.files_to_watermark[1])
+    assert thumbnail.size == (64, 48) and thumbnail_cache.hits == 1
+    stat = os.stat(config.files_to_watermark[1])
+    os.utime(config.files_to_watermark[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    thumbnail, errors = thumbnail_cache.get(config.files_to_watermark[1])
+    assert thumbnail_cache.misses == 3 and len(os.listdir(thumbnail_cache.folder)) == 3
+
+
+def test_ApplicationWindowPreview(qtbot, tmp_path):
+    # Imported here, the window module is the GUI entry point.
+    from watermark_gui import ApplicationWindow
+
+    config = _CreateTestImages(str(tmp_path), count=1)
+    # Thumbnails go to a test cache folder rather than the user's.
+    QtCore.QStandardPaths.setTestModeEnabled(True)
+    window = ApplicationWindow()
+    qtbot.addWidget(window)
+    try:
+        window.watermark_config.watermark_config.watermark_file = config.watermark_file
+        window.checkboxes["top-left"][0].setChecked(True)
+        with qtbot.waitSignal(window.preview_thread.preview_signal):
+            window.SetFileList(config.files_to_watermark)
+        qtbot.waitUntil(
+            lambda: window.preview_label.pixmap() is not None and not window.preview_label.pixmap().isNull()
+        )
+        # Typing is debounced into a single render.
+        generation = window.preview_thread.generation
+        for text in ["a", "ab", "abc"]:
+            window.ui.watermarkText.setText(text)
+            window.ui.watermarkText.textEdited.emit(text)
+        assert window.preview_thread.generation == generation
+        with qtbot.waitSignal(window.preview_thread.preview_signal):
+            pass
+        assert window.preview_thread.generation == generation + 1
+    finally:
+        window.close()
+
+
 def test_RunProgressDialog():
     config = _CreateBaseConfig()
     progress_dialog = ProgressDialog(config)
@@ -0,0 +1,343 @@
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import sys
+import threading
+import time
+
+import watermark
+from watermark_cli import config_from_arguments, create_argument_parser, create_folder
+from watermark_codecs import identify_image_format
+from watermark_config import WatermarkConfig
+from watermark_discovery import walk_files
+
+# inotify(7) constants, from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0o2000000
+# Layout of struct inotify_event, followed by `len` bytes of NUL padded name.
+_INOTIFY_EVENT = struct.Struct("iIII")
+# Names of watermarked outputs, see watermark.save_watermarked_image.
+_OUTPUT_NAME = re.compile(r"_watermarked(_\d+)?$")
+# Seconds between two passes forgetting the files that left the watched folder, see FolderWatcher.prune.
+_PRUNE_INTERVAL = 60.0
+
+
+class InotifyWatcher:
+    def __init__(self, folder: str):
+        """
+        Reports files of folder that were closed after writing, or moved in, using Linux inotify through ctypes.
+
+        Raises OSError where inotify is not available, see create_watcher.
+        """
+        self.folder = folder
+        library = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or library is None:
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(library, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if self._libc.inotify_add_watch(self._fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, "inotify_add_watch failed for %s" % folder)
+
+    def wait(self, timeout: float):
+        # Blocks until files change or timeout seconds pass. Returns the paths of the changed files.
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+        data = os.read(self._fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, name_length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = data[offset : offset + name_length].rstrip(b"\0")
+            offset += name_length
+            if name:
+                paths.append(os.path.join(self.folder, os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class PollingWatcher:
+    def __init__(self, folder: str, poll_interval: float = 1.0):
+        """
+        Reports new or changed files of folder by listing it every poll_interval seconds.
+
+        Attributes:
+            folder (str): The watched folder.
+            poll_interval (float): Seconds between two listings.
+        """
+        self.folder = folder
+        self.poll_interval = poll_interval
+        # Files already there are not reported, like with inotify.
+        self._signatures = {file_path: get_file_signature(file_path) for file_path in walk_files(folder)}
+
+    def wait(self, timeout: float):
+        time.sleep(min(timeout, self.poll_interval))
+        signatures = {}
+        changed = []
+        for file_path in walk_files(self.folder):
+            signature = get_file_signature(file_path)
+            if signature is None:
+                continue
+            signatures[file_path] = signature
+            if self._signatures.get(file_path) != signature:
+                changed.append(file_path)
+        self._signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(folder: str, poll_interval: float = 1.0, use_inotify: bool = True):
+    # inotify where we can, listing the folder otherwise (other platforms, network mounts without inotify).
+    if use_inotify:
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError) as e:
+            print("inotify unavailable (%s), polling every %gs" % (str(e), poll_interval))
+    return PollingWatcher(folder, poll_interval)
+
+
+def get_file_signature(file_path: str):
+    # (size, mtime) of file_path, or None if it is gone.
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class FolderWatcher:
+    def __init__(
+        self,
+        watermark_config: WatermarkConfig,
+        folder: str,
+        settle_seconds: float = 0.2,
+        poll_interval: float = 1.0,
+        use_inotify: bool = True,
+    ):
+        """
+        Watermarks the images dropped into folder as they arrive, with the watermark assets loaded once.
+
+        A file is processed once its size and mtime have not changed for settle_seconds, so files still being
+        written (or copied in chunks) are not picked up half way. Outputs are never watermarked again, even when
+        the output folder is the watched folder.
+
+        Settled files go through a watermark.WatermarkBatch kept for the life of the watcher, so workers, the
+        pipeline, resume, deduplicate, the result and profile reports and continue_on_error work as in a batch.
+        The worker pool stays up between files. Without continue_on_error, the first failed file stops the watcher.
+
+        Attributes:
+            watermark_config (WatermarkConfig): Configuration object containing watermark settings.
+            folder (str): The watched folder.
+            settle_seconds (float): How long a file must stay unchanged before it is processed.
+            errors (list): Errors loading the watermark assets, or of the file that stopped the watcher. Nothing is
+                processed while there are any.
+            batch (watermark.WatermarkBatch): Watermarks the files and records their results.
+        """
+        self.watermark_config = watermark_config
+        self.folder = folder
+        self.settle_seconds = settle_seconds
+        self.errors = []
+        self._watcher = create_watcher(folder, poll_interval, use_inotify)
+        self._poll_interval = poll_interval
+        self._stop_event = threading.Event()
+        # Path to (signature, time it was last seen changing) of files waiting to settle.
+        self._pending = {}
+        # Path to signature of the files already processed, and the outputs we wrote. Files that left the folder
+        # are dropped every _PRUNE_INTERVAL seconds.
+        self._processed = {}
+        self._outputs = set()
+        self._last_prune_time = time.monotonic()
+        self.batch = watermark.WatermarkBatch(watermark_config)
+        self._watermark_file_signature = None
+        self.load_watermark()
+
+    def load_watermark(self):
+        # (Re)loads the watermark and text layer, and remembers the watermark file version they come from.
+        if self.watermark_config.watermark_file is not None:
+            self._watermark_file_signature = get_file_signature(self.watermark_config.watermark_file)
+        watermark_image, text_image, text, self.errors = watermark.preload_watermark_and_text_images(
+            self.watermark_config
+        )
+        if len(self.errors) > 0:
+            print("\n".join(self.errors))
+        self.batch.set_watermark(watermark_image, text_image, text)
+
+    def add_existing_files(self):
+        # Queues the files already in the folder, as a cron run would have processed them.
+        for file_path in walk_files(self.folder):
+            self._add_pending(file_path)
+
+    def _add_pending(self, file_path: str):
+        signature = get_file_signature(file_path)
+        if signature is None or file_path in self._outputs or self._processed.get(file_path) == signature:
+            return
+        pending = self._pending.get(file_path)
+        if pending is None or pending[0] != signature:
+            self._pending[file_path] = (signature, time.monotonic())
+
+    def _is_watermark_input(self, file_path: str):
+        # Outputs of an earlier run (and their output variants), when the output folder is the watched folder.
+        if _OUTPUT_NAME.search(watermark.get_output_name(file_path)) is not None:
+            return False
+        return identify_image_format(file_path) is not None
+
+    def process_settled_files(self):
+        """
+        Watermark the pending files that have stopped changing.
+
+        Returns:
+            list: The results of the files processed, see watermark.watermark_file. Files found up to date by the
+                manifest have none.
+        """
+        if (
+            self.watermark_config.watermark_file is not None
+            and get_file_signature(self.watermark_config.watermark_file) != self._watermark_file_signature
+        ):
+            print("watermark changed, reloading: %s" % self.watermark_config.watermark_file)
+            self.load_watermark()
+        if len(self.errors) > 0:
+            return []
+
+        settled_files = []
+        now = time.monotonic()
+        for file_path, (signature, changed_time) in list(self._pending.items()):
+            current_signature = get_file_signature(file_path)
+            if current_signature is None:
+                del self._pending[file_path]
+                continue
+            if current_signature != signature:
+                self._pending[file_path] = (current_signature, now)
+                continue
+            if now - changed_time < self.settle_seconds:
+                continue
+            del self._pending[file_path]
+            self._processed[file_path] = signature
+            if self._is_watermark_input(file_path):
+                settled_files.append(file_path)
+        if len(settled_files) == 0:
+            return []
+
+        results = []
+        batch_results = self.batch.run(settled_files)
+        try:
+            for result in batch_results:
+                results.append(result)
+                if len(result.errors) > 0:
+                    print("failed: %s\n%s" % (result.input_file, "\n".join(result.errors)))
+                    if not self.watermark_config.continue_on_error:
+                        self.errors = result.errors
+                        self.stop()
+                        break
+                    continue
+                print("watermarked %s in %.3fs" % (result.input_file, result.duration or 0.0))
+                self._outputs.add(result.output_file)
+        finally:
+            batch_results.close()
+        # Kept current while we run, rather than only written on exit.
+        self.batch.write_reports()
+        return results
+
+    def prune(self):
+        # Forgets the files that left the folder, so that a long running watcher does not remember every file it
+        # ever saw.
+        self._processed = {
+            file_path: signature for file_path, signature in self._processed.items() if os.path.exists(file_path)
+        }
+        self._outputs = {output_file for output_file in self._outputs if os.path.exists(output_file)}
+        self._last_prune_time = time.monotonic()
+
+    def run_once(self):
+        # Waits for changes (briefly while files are settling) and processes what is ready.
+        timeout = self.settle_seconds / 2 if len(self._pending) > 0 else self._poll_interval
+        for file_path in self._watcher.wait(timeout):
+            self._add_pending(file_path)
+        if time.monotonic() - self._last_prune_time >= _PRUNE_INTERVAL:
+            self.prune()
+        return self.process_settled_files()
+
+    def run(self):
+        # Processes files until stop() is called.
+        while not self._stop_event.is_set():
+            self.run_once()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def close(self):
+        self._watcher.close()
+        self.batch.close()
+
+
+def parse_arguments():
+    parser = create_argument_parser(
+        description="Watches a folder and watermarks the images dropped into it.", input_help="Folder to watch"
+    )
+    parser.add_argument(
+        "--settle_seconds",
+        type=float,
+        default=0.2,
+        help="How long a new file must stay unchanged before it is watermarked, so partial uploads are skipped",
+    )
+    parser.add_argument("--poll_interval", type=float, default=1.0, help="Seconds between folder listings when polling")
+    parser.add_argument("--polling", action="store_true", help="List the folder instead of using inotify")
+    parser.add_argument("--skip_existing", action="store_true", help="Only watermark files that arrive from now on")
+    arguments = parser.parse_args()
+    if arguments.recursive:
+        # inotify watches a single folder.
+        parser.error("--recursive is not supported when watching a folder")
+    return arguments
+
+
+def main():
+    arguments = parse_arguments()
+    config = config_from_arguments(arguments)
+    if not os.path.isdir(config.input_file_regex):
+        print("Not a folder: %s" % config.input_file_regex)
+        sys.exit(1)
+    error_messages = create_folder(config.watermark_config.output_folder)
+    # Files arrive later, so only the other settings can be checked up front.
+    error_messages += config.watermark_config.check_valid(check_paths=False)
+    if len(error_messages) > 0:
+        print("\n".join(error_messages))
+        sys.exit(1)
+
+    folder_watcher = FolderWatcher(
+        config.watermark_config,
+        config.input_file_regex,
+        arguments.settle_seconds,
+        arguments.poll_interval,
+        use_inotify=not arguments.polling,
+    )
+    if len(folder_watcher.errors) > 0:
+        sys.exit(1)
+    if not arguments.skip_existing:
+        folder_watcher.add_existing_files()
+    print("watching %s" % config.input_file_regex)
+    try:
+        folder_watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        folder_watcher.close()
+    if len(folder_watcher.errors) > 0:
+        # A file failed without --continue_on_error.
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()